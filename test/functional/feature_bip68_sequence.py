@@ -26,7 +26,6 @@ from test_framework.util import (
     assert_raises_rpc_error,
     softfork_active,
 )
-from test_framework import util
 from test_framework.script_util import DUMMY_P2WPKH_SCRIPT
 
 SEQUENCE_LOCKTIME_DISABLE_FLAG = (1<<31)
@@ -57,7 +56,6 @@ class BIP68Test(BitcoinTestFramework):
         self.skip_if_no_wallet()
 
     def run_test(self):
-        util.node_fastmerkle = self.nodes[0]
         self.relayfee = self.nodes[0].getnetworkinfo()["relayfee"]
 
         # Generate some coins
@@ -14,7 +14,6 @@ from test_framework.util import (
     find_vout_for_address,
     assert_greater_than
 )
-from test_framework import util
 from test_framework.messages import (
     COIN,
     CBlock,
@@ -208,7 +207,6 @@ class FedPegTest(BitcoinTestFramework):
 
         for node in self.nodes:
             node.importprivkey(privkey=node.get_deterministic_priv_key().key, label="mining")
-        util.node_fastmerkle = sidechain
 
         self.generate(parent, 101, sync_fun=self.no_op)
         self.generate(sidechain, 101, sync_fun=self.no_op)
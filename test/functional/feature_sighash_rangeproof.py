@@ -31,7 +31,6 @@ from test_framework.messages import (
     from_hex,
 )
 
-from test_framework import util
 from test_framework.util import (
     assert_equal,
     assert_raises_rpc_error,
@@ -215,7 +214,6 @@ class SighashRangeproofTest(BitcoinTestFramework):
             assert pre == post
 
     def run_test(self):
-        util.node_fastmerkle = self.nodes[0]
         ADDRESS_TYPES = ["legacy", "blech32", "p2sh-segwit"]
 
         # Different test scenarios.
@@ -81,6 +81,7 @@ from test_framework.script import (
     SIGHASH_NONE,
     SIGHASH_SINGLE,
     SIGHASH_ANYONECANPAY,
+    PrecomputedTransactionData,
     SegwitV0SignatureMsg,
     TaggedHash,
     TaprootSignatureMsg,
@@ -97,7 +98,6 @@ from test_framework.script_util import (
 )
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import assert_raises_rpc_error, assert_equal
-from test_framework import util
 from test_framework.key import generate_privkey, compute_xonly_pubkey, sign_schnorr, tweak_add_privkey, ECKey
 from test_framework.address import (
     hash160,
@@ -226,6 +226,7 @@ def default_sigmsg(ctx):
     hashtype = get(ctx, "hashtype_actual")
     genesis_hash = get(ctx, "genesis_hash")
     mode = get(ctx, "mode")
+    txdata = get(ctx, "txdata")
     if mode == "taproot":
         # BIP341 signature hash
         utxos = get(ctx, "utxos")
@@ -234,14 +235,14 @@ def default_sigmsg(ctx):
             codeseppos = get(ctx, "codeseppos")
             leaf_ver = get(ctx, "leafversion")
             script = get(ctx, "script_taproot")
-            return TaprootSignatureMsg(tx, utxos, hashtype, genesis_hash, idx, scriptpath=True, script=script, leaf_ver=leaf_ver, codeseparator_pos=codeseppos, annex=annex)
+            return TaprootSignatureMsg(tx, utxos, hashtype, genesis_hash, idx, scriptpath=True, script=script, leaf_ver=leaf_ver, codeseparator_pos=codeseppos, annex=annex, txdata=txdata)
         else:
-            return TaprootSignatureMsg(tx, utxos, hashtype, genesis_hash, idx, scriptpath=False, annex=annex)
+            return TaprootSignatureMsg(tx, utxos, hashtype, genesis_hash, idx, scriptpath=False, annex=annex, txdata=txdata)
     elif mode == "witv0":
         # BIP143 signature hash
         scriptcode = get(ctx, "scriptcode")
         utxos = get(ctx, "utxos")
-        return SegwitV0SignatureMsg(scriptcode, tx, idx, hashtype, utxos[idx].nValue, enable_sighash_rangeproof=False)
+        return SegwitV0SignatureMsg(scriptcode, tx, idx, hashtype, utxos[idx].nValue, enable_sighash_rangeproof=False, txdata=txdata)
     else:
         # Pre-segwit signature hash
         scriptcode = get(ctx, "scriptcode")
@@ -424,6 +425,8 @@ DEFAULT_CONTEXT = {
     "genesis_hash": None,
     # Use deterministic signing nonces
     "deterministic": False,
+    # Transaction-wide sighash data shared between the inputs of tx (None to compute it per input)
+    "txdata": None,
 
     # == Parameters to be set before evaluation: ==
     # - mode: what spending style to use ("taproot", "witv0", or "legacy").
@@ -569,12 +572,12 @@ def make_spender(comment, *, tap=None, witv0=False, script=None, pkh=None, p2sh=
 
     conf = {**conf, **kwargs}
 
-    def sat_fn(tx, idx, utxos, valid):
+    def sat_fn(tx, idx, utxos, valid, txdata=None):
         if valid:
-            return spend(tx, idx, utxos, **conf)
+            return spend(tx, idx, utxos, txdata=txdata, **conf)
         else:
             assert failure is not None
-            return spend(tx, idx, utxos, **{**conf, **failure})
+            return spend(tx, idx, utxos, txdata=txdata, **{**conf, **failure})
 
     return Spender(script=spk, comment=comment, is_standard=standard, sat_function=sat_fn, err_msg=err_msg, sigops_weight=sigops_weight, no_fail=failure is None, need_vin_vout_mismatch=need_vin_vout_mismatch)
 
@@ -1497,12 +1500,14 @@ class TaprootTest(BitcoinTestFramework):
 
             # Precompute one satisfying and one failing scriptSig/witness for each input.
             input_data = []
+            spent_utxos = [utxo.output for utxo in input_utxos]
+            txdata = PrecomputedTransactionData(tx, spent_utxos)
             for i in range(len(input_utxos)):
                 fn = input_utxos[i].spender.sat_function
                 fail = None
-                success = fn(tx, i, [utxo.output for utxo in input_utxos], True)
+                success = fn(tx, i, spent_utxos, True, txdata)
                 if not input_utxos[i].spender.no_fail:
-                    fail = fn(tx, i, [utxo.output for utxo in input_utxos], False)
+                    fail = fn(tx, i, spent_utxos, False, txdata)
                 input_data.append((fail, success))
                 if self.options.dump_tests:
                     dump_json_test(tx, input_utxos, i, success, fail)
@@ -1791,8 +1796,6 @@ class TaprootTest(BitcoinTestFramework):
 
 
     def run_test(self):
-        util.node_fastmerkle = self.nodes[0]
-
         global g_genesis_hash
         g_genesis_hash = uint256_from_str(bytes.fromhex(self.nodes[1].getblockhash(0))[::-1])
 
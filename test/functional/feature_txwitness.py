@@ -17,7 +17,6 @@
 from test_framework.messages import CTransaction, CBlock, ser_uint256, from_hex, uint256_from_str, CTxOut, CTxIn, COutPoint, OUTPOINT_ISSUANCE_FLAG, ser_string
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import assert_equal, assert_raises_rpc_error, assert_greater_than
-from test_framework import util
 from test_framework.blocktools import get_witness_script
 
 from io import BytesIO
@@ -211,7 +210,6 @@ class TxWitnessTest(BitcoinTestFramework):
         assert_raises_rpc_error(-22, "TX decode failed", self.nodes[0].decoderawtransaction, block_witness_stuffed.vtx[0].serialize().hex())
 
     def run_test(self):
-        util.node_fastmerkle = self.nodes[0]
         self.test_coinbase_witness()
         self.test_transaction_serialization()
 
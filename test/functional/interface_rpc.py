@@ -4,10 +4,14 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 """Tests some generic aspects of the RPC interface."""
 
+from decimal import Decimal
+import json
 import os
+from test_framework.async_rpc import run_async, run_async_all
 from test_framework.authproxy import JSONRPCException
+from test_framework.p2p import NetworkThread
 from test_framework.test_framework import BitcoinTestFramework
-from test_framework.util import assert_equal, assert_greater_than_or_equal
+from test_framework.util import assert_equal, assert_greater_than_or_equal, assert_raises_rpc_error
 from threading import Thread
 import subprocess
 
@@ -33,7 +37,7 @@ def test_work_queue_getblock(node, got_exceeded_error):
 
 class RPCInterfaceTest(BitcoinTestFramework):
     def set_test_params(self):
-        self.num_nodes = 1
+        self.num_nodes = 2
         self.setup_clean_chain = True
         self.supports_cli = False
 
@@ -74,12 +78,61 @@ class RPCInterfaceTest(BitcoinTestFramework):
         assert_equal(result_by_id[3]['error'], None)
         assert result_by_id[3]['result'] is not None
 
+        self.log.info("Testing JSON-RPC batch builder...")
+
+        with self.nodes[0].batch() as batch:
+            count = batch.getblockcount()
+            invalid = batch.invalidmethod()
+            blockhash = batch.getblockhash(height=0)
+        assert_equal(count.result(), 0)
+        assert_raises_rpc_error(-32601, "Method not found", invalid.result)
+        assert_equal(blockhash.result(), self.nodes[0].getblockhash(0))
+
     def test_http_status_codes(self):
         self.log.info("Testing HTTP status codes for JSON-RPC requests...")
 
         expect_http_status(404, -32601, self.nodes[0].invalidmethod)
         expect_http_status(500, -8, self.nodes[0].getblockhash, 42)
 
+    def test_call_raw(self):
+        self.log.info("Testing undecoded JSON-RPC responses...")
+        node = self.nodes[0]
+        blockhash = node.getblockhash(0)
+        raw = node.getblock.call_raw(blockhash=blockhash, verbosity=2)
+        assert isinstance(raw, bytes)
+        assert_equal(json.loads(raw, parse_float=Decimal)['result'], node.getblock(blockhash=blockhash, verbosity=2))
+        assert_raises_rpc_error(-8, "Block height out of range", node.getblockhash.call_raw, 42)
+
+    def test_async_rpc(self):
+        self.log.info("Testing asynchronous RPC calls on the network thread event loop...")
+        self.check_async_rpc()
+
+        self.log.info("Testing asynchronous RPC calls on a private event loop...")
+        self.network_thread.close()
+        assert NetworkThread.network_event_loop is None
+        try:
+            self.check_async_rpc()
+        finally:
+            self.network_thread = NetworkThread()
+            self.network_thread.start()
+
+    def check_async_rpc(self):
+        # Run twice, so that the second round reuses the kept-alive connections
+        for _ in range(2):
+            assert_equal(run_async_all(node.async_rpc.getblockhash(0) for node in self.nodes),
+                         [node.getblockhash(0) for node in self.nodes])
+
+        results = run_async(self.nodes[0].async_rpc.batch([
+            {"method": "getblockcount", "id": 1},
+            {"method": "invalidmethod", "id": 2},
+        ]))
+        result_by_id = {res["id"]: res for res in results}
+        assert_equal(result_by_id[1]['result'], 0)
+        assert_equal(result_by_id[2]['error']['code'], -32601)
+
+        assert_raises_rpc_error(-8, "Block height out of range", run_async, self.nodes[0].async_rpc.getblockhash(42))
+        assert_raises_rpc_error(-32601, "Method not found", run_async, self.nodes[1].async_rpc.invalidmethod())
+
     def test_work_queue_exceeded(self):
         self.log.info("Testing work queue exceeded...")
         self.restart_node(0, ['-rpcworkqueue=1', '-rpcthreads=1'])
@@ -96,6 +149,8 @@ class RPCInterfaceTest(BitcoinTestFramework):
         self.test_getrpcinfo()
         self.test_batch_request()
         self.test_http_status_codes()
+        self.test_call_raw()
+        self.test_async_rpc()
         self.test_work_queue_exceeded()
 
 
@@ -61,7 +61,6 @@ from test_framework.script import (
     OP_TRUE,
 )
 from test_framework.test_framework import BitcoinTestFramework
-from test_framework import util
 from test_framework.util import (
     assert_equal,
     softfork_active,
@@ -843,7 +842,6 @@ class CompactBlocksTest(BitcoinTestFramework):
         assert_highbandwidth_states(self.nodes[0], hb_to=True, hb_from=False)
 
     def run_test(self):
-        util.node_fastmerkle = self.nodes[0]
         self.wallet = MiniWallet(self.nodes[0])
 
         # Setup the p2p connections
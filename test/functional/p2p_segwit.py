@@ -92,7 +92,6 @@ from test_framework.util import (
     softfork_active,
     assert_raises_rpc_error,
 )
-from test_framework import util
 
 MAX_SIGOP_COST = 80000
 
@@ -246,7 +245,6 @@ class SegWitTest(BitcoinTestFramework):
         block.solve()
 
     def run_test(self):
-        util.node_fastmerkle = self.nodes[0]
         # Setup the p2p connections
         # self.test_node sets P2P_SERVICES, i.e. NODE_WITNESS | NODE_NETWORK
         self.test_node = self.nodes[0].add_p2p_connection(TestP2PConn(), services=P2P_SERVICES)
@@ -25,7 +25,8 @@ AuthServiceProxy has the following improvements over python-jsonrpc's
 ServiceProxy class:
 
 - HTTP connections persist for the life of the AuthServiceProxy object
-  (if server supports HTTP/1.1)
+  (if server supports HTTP/1.1), and are pooled so that calls can be made
+  concurrently from several threads
 - sends protocol 'version', per JSON-RPC 1.1
 - sends proper, incrementing 'id'
 - sends Basic HTTP authentication headers
@@ -40,12 +41,20 @@ import http.client
 import json
 import logging
 import os
+import re
 import socket
+import threading
 import time
 import urllib.parse
 
 HTTP_TIMEOUT = 30
 USER_AGENT = "AuthServiceProxy/0.1"
+# Maximum number of characters of a request or response written to the debug log
+LOG_SIZE_LIMIT = 10000
+
+# The id at the end of a (non-batch) JSON-RPC response body, found without
+# decoding the body
+RESPONSE_ID_RE = re.compile(rb'"id"\s*:\s*(-?\d+|"[^"]*"|null)\s*}\s*$')
 
 log = logging.getLogger("BitcoinRPC")
 
@@ -65,11 +74,151 @@ def EncodeDecimal(o):
         return str(o)
     raise TypeError(repr(o) + " is not JSON serializable")
 
+def get_result(response, status):
+    """Return the result of a decoded JSON-RPC response, or raise its error."""
+    if response['error'] is not None:
+        raise JSONRPCException(response['error'], status)
+    elif 'result' not in response:
+        raise JSONRPCException({
+            'code': -343, 'message': 'missing JSON-RPC result'}, status)
+    elif status != HTTPStatus.OK:
+        raise JSONRPCException({
+            'code': -342, 'message': 'non-200 HTTP status code but no JSON-RPC error'}, status)
+    else:
+        return response['result']
+
+def response_id_for_log(data):
+    """Return the id of a JSON-RPC response body (bytes) for the log, or an empty string."""
+    match = RESPONSE_ID_RE.search(data[-100:])
+    return match.group(1).decode('utf-8', 'replace') if match else ''
+
+def truncate_for_log(data):
+    """Return (bytes or str) RPC payload data as str, capped to LOG_SIZE_LIMIT characters."""
+    size = len(data)
+    if size > LOG_SIZE_LIMIT:
+        data = data[:LOG_SIZE_LIMIT]
+    if isinstance(data, bytes):
+        data = data.decode('utf8', errors='replace')
+    if size > LOG_SIZE_LIMIT:
+        data += "... (%d bytes total)" % size
+    return data
+
+class HTTPConnectionPool():
+    """Thread-safe pool of keep-alive HTTP connections to one server.
+
+    A connection is handed out to a single request at a time, and put back
+    once its response has been read completely, so that concurrent callers
+    each get their own connection and sequential callers reuse one.
+    """
+    def __init__(self, url, timeout=HTTP_TIMEOUT, connection=None):
+        self.url = url
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = []
+        if connection:
+            self.timeout = connection.timeout
+            self._idle.append(connection)
+
+    def _new_conn(self):
+        port = 80 if self.url.port is None else self.url.port
+        if self.url.scheme == 'https':
+            return http.client.HTTPSConnection(self.url.hostname, port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.url.hostname, port, timeout=self.timeout)
+
+    def get(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._new_conn()
+
+    def put(self, conn):
+        if os.name == 'nt':
+            # Windows somehow does not like to re-use connections
+            # TODO: Find out why the connection would disconnect occasionally and make it reusable on Windows
+            # Avoid "ConnectionAbortedError: [WinError 10053] An established connection was aborted by the software in your host machine"
+            conn.close()
+            return
+        with self._lock:
+            self._idle.append(conn)
+
+class RPCBatchCall():
+    """A call recorded in an RPCBatch, holding its outcome once the batch was sent."""
+    def __init__(self, method, request):
+        self.method = method
+        self.request = request
+        self.done = False
+        self.error = None
+        self._result = None
+
+    def result(self):
+        """Return the result of the call, or raise its error as a JSONRPCException."""
+        assert self.done, "%s was not sent yet" % self.method
+        if self.error is not None:
+            if isinstance(self.error, JSONRPCException):
+                raise self.error
+            raise JSONRPCException(self.error)
+        return self._result
+
+class RPCBatch():
+    """Record RPC calls and send them as a single JSON-RPC batch request.
+
+    Calls are recorded like normal RPC calls, and sent when leaving the
+    context (or on execute()):
+
+        with node.batch() as batch:
+            count = batch.getblockcount()
+            block = batch.getblock(blockhash, 2)
+        count.result(), block.result()
+
+    Errors are reported per call. Works with any RPC connection providing
+    get_request() and batch(), including the bitcoin-cli emulation.
+    """
+    def __init__(self, rpc):
+        self._rpc = rpc
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internal stuff
+            raise AttributeError
+        method = getattr(self._rpc, name)
+
+        def record(*args, **argsn):
+            call = RPCBatchCall(name, method.get_request(*args, **argsn))
+            self.calls.append(call)
+            return call
+        return record
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *_exc_info):
+        if exc_type is None:
+            self.execute()
+
+    def execute(self):
+        """Send the calls recorded so far, and return their RPCBatchCall objects."""
+        calls, self.calls = self.calls, []
+        if not calls:
+            return calls
+        responses = self._rpc.batch([call.request for call in calls])
+        assert len(responses) == len(calls), "batch returned %d responses for %d calls" % (len(responses), len(calls))
+        if 'id' in responses[0]:
+            # JSON-RPC responses may come back in any order
+            by_id = {response['id']: response for response in responses}
+            responses = [by_id[call.request['id']] for call in calls]
+        for call, response in zip(calls, responses):
+            call.done = True
+            call.error = response.get('error')
+            call._result = response.get('result')
+        return calls
+
 class AuthServiceProxy():
     __id_count = 0
+    __id_lock = threading.Lock()
 
     # ensure_ascii: escape unicode as \uXXXX, passed to json.dumps
-    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, ensure_ascii=True):
+    def __init__(self, service_url, service_name=None, timeout=HTTP_TIMEOUT, connection=None, ensure_ascii=True, pool=None):
         self.__service_url = service_url
         self._service_name = service_name
         self.ensure_ascii = ensure_ascii  # can be toggled on the fly by tests
@@ -78,8 +227,12 @@ class AuthServiceProxy():
         passwd = None if self.__url.password is None else self.__url.password.encode('utf8')
         authpair = user + b':' + passwd
         self.__auth_header = b'Basic ' + base64.b64encode(authpair)
-        self.timeout = timeout
-        self._set_conn(connection)
+        self.__headers = {'Host': self.__url.hostname,
+                          'User-Agent': USER_AGENT,
+                          'Authorization': self.__auth_header,
+                          'Content-type': 'application/json'}
+        self.__pool = pool or HTTPConnectionPool(self.__url, timeout, connection)
+        self.timeout = self.__pool.timeout
 
     def __getattr__(self, name):
         if name.startswith('__') and name.endswith('__'):
@@ -87,90 +240,113 @@ class AuthServiceProxy():
             raise AttributeError
         if self._service_name is not None:
             name = "%s.%s" % (self._service_name, name)
-        return AuthServiceProxy(self.__service_url, name, connection=self.__conn)
+        return self._copy(name)
 
-    def _request(self, method, path, postdata):
+    def _copy(self, service_name):
+        """Cheap copy of this proxy for another method, sharing the connection pool."""
+        proxy = object.__new__(AuthServiceProxy)
+        proxy.__dict__.update(self.__dict__)
+        proxy._service_name = service_name
+        return proxy
+
+    def _request(self, method, path, postdata, raw=False):
         '''
         Do a HTTP request, with retry if we get disconnected (e.g. due to a timeout).
         This is a workaround for https://bugs.python.org/issue3566 which is fixed in Python 3.5.
+
+        The connection is taken from the pool for the duration of the request,
+        and only returned to it if the response was read successfully.
         '''
-        headers = {'Host': self.__url.hostname,
-                   'User-Agent': USER_AGENT,
-                   'Authorization': self.__auth_header,
-                   'Content-type': 'application/json'}
-        if os.name == 'nt':
-            # Windows somehow does not like to re-use connections
-            # TODO: Find out why the connection would disconnect occasionally and make it reusable on Windows
-            # Avoid "ConnectionAbortedError: [WinError 10053] An established connection was aborted by the software in your host machine"
-            self._set_conn()
+        conn = self.__pool.get()
         try:
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
-        except (BrokenPipeError, ConnectionResetError):
-            # Python 3.5+ raises BrokenPipeError when the connection was reset
-            # ConnectionResetError happens on FreeBSD
-            self.__conn.close()
-            self.__conn.request(method, path, postdata, headers)
-            return self._get_response()
-        except OSError as e:
-            # Workaround for a bug on macOS. See https://bugs.python.org/issue33450
-            retry = '[Errno 41] Protocol wrong type for socket' in str(e)
-            if retry:
-                self.__conn.close()
-                self.__conn.request(method, path, postdata, headers)
-                return self._get_response()
-            else:
-                raise
+            try:
+                conn.request(method, path, postdata, self.__headers)
+                result = self._get_response(conn, raw)
+            except (BrokenPipeError, ConnectionResetError):
+                # Python 3.5+ raises BrokenPipeError when the connection was reset
+                # ConnectionResetError happens on FreeBSD
+                conn.close()
+                conn.request(method, path, postdata, self.__headers)
+                result = self._get_response(conn, raw)
+            except OSError as e:
+                # Workaround for a bug on macOS. See https://bugs.python.org/issue33450
+                retry = '[Errno 41] Protocol wrong type for socket' in str(e)
+                if retry:
+                    conn.close()
+                    conn.request(method, path, postdata, self.__headers)
+                    result = self._get_response(conn, raw)
+                else:
+                    raise
+        except BaseException:
+            conn.close()
+            raise
+        self.__pool.put(conn)
+        return result
 
     def get_request(self, *args, **argsn):
-        AuthServiceProxy.__id_count += 1
+        with AuthServiceProxy.__id_lock:
+            AuthServiceProxy.__id_count += 1
+            id_count = AuthServiceProxy.__id_count
 
-        log.debug("-{}-> {} {}".format(
-            AuthServiceProxy.__id_count,
-            self._service_name,
-            json.dumps(args or argsn, default=EncodeDecimal, ensure_ascii=self.ensure_ascii),
-        ))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("-{}-> {} {}".format(
+                id_count,
+                self._service_name,
+                truncate_for_log(json.dumps(args or argsn, default=EncodeDecimal, ensure_ascii=self.ensure_ascii)),
+            ))
         if args and argsn:
             raise ValueError('Cannot handle both named and positional arguments')
         return {'version': '1.1',
                 'method': self._service_name,
                 'params': args or argsn,
-                'id': AuthServiceProxy.__id_count}
+                'id': id_count}
 
     def __call__(self, *args, **argsn):
         postdata = json.dumps(self.get_request(*args, **argsn), default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
         response, status = self._request('POST', self.__url.path, postdata.encode('utf-8'))
-        if response['error'] is not None:
-            raise JSONRPCException(response['error'], status)
-        elif 'result' not in response:
-            raise JSONRPCException({
-                'code': -343, 'message': 'missing JSON-RPC result'}, status)
-        elif status != HTTPStatus.OK:
-            raise JSONRPCException({
-                'code': -342, 'message': 'non-200 HTTP status code but no JSON-RPC error'}, status)
-        else:
-            return response['result']
+        return get_result(response, status)
+
+    def call_raw(self, *args, **argsn):
+        """Make the call, but return the undecoded JSON-RPC response body (bytes).
+
+        For RPCs with very large results (like getblock with verbosity 2),
+        this skips decoding the response when the caller only needs part of
+        it or wants to decode it by other means. Errors are raised as usual.
+        """
+        postdata = json.dumps(self.get_request(*args, **argsn), default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
+        response, status = self._request('POST', self.__url.path, postdata.encode('utf-8'), raw=True)
+        if isinstance(response, bytes):
+            return response
+        # Only non-200 responses were decoded, raise their error
+        get_result(response, status)
 
-    def batch(self, rpc_call_list):
+    def batch(self, rpc_call_list=None):
+        """Send a JSON-RPC batch request built from get_request() dicts.
+
+        Without arguments, return an RPCBatch to record calls on instead.
+        """
+        if rpc_call_list is None:
+            return RPCBatch(self)
         postdata = json.dumps(list(rpc_call_list), default=EncodeDecimal, ensure_ascii=self.ensure_ascii)
-        log.debug("--> " + postdata)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("--> " + truncate_for_log(postdata))
         response, status = self._request('POST', self.__url.path, postdata.encode('utf-8'))
         if status != HTTPStatus.OK:
             raise JSONRPCException({
                 'code': -342, 'message': 'non-200 HTTP status code but no JSON-RPC error'}, status)
         return response
 
-    def _get_response(self):
+    def _get_response(self, conn, raw=False):
         req_start_time = time.time()
         try:
-            http_response = self.__conn.getresponse()
+            http_response = conn.getresponse()
         except socket.timeout:
             raise JSONRPCException({
                 'code': -344,
                 'message': '%r RPC took longer than %f seconds. Consider '
                            'using larger timeout for calls that take '
                            'longer to return.' % (self._service_name,
-                                                  self.__conn.timeout)})
+                                                  conn.timeout)})
         if http_response is None:
             raise JSONRPCException({
                 'code': -342, 'message': 'missing HTTP response from server'})
@@ -181,24 +357,17 @@ class AuthServiceProxy():
                 {'code': -342, 'message': 'non-JSON HTTP response with \'%i %s\' from server' % (http_response.status, http_response.reason)},
                 http_response.status)
 
-        responsedata = http_response.read().decode('utf8')
-        response = json.loads(responsedata, parse_float=decimal.Decimal)
+        # json.loads() decodes the UTF-8 bytes itself, without an intermediate str copy
+        responsedata = http_response.read()
         elapsed = time.time() - req_start_time
-        if "error" in response and response["error"] is None:
-            log.debug("<-%s- [%.6f] %s" % (response["id"], elapsed, json.dumps(response["result"], default=EncodeDecimal, ensure_ascii=self.ensure_ascii)))
-        else:
-            log.debug("<-- [%.6f] %s" % (elapsed, responsedata))
+        if log.isEnabledFor(logging.DEBUG):
+            # Log the response as received, instead of re-encoding the decoded
+            # result. Its id is logged separately, as it may be truncated away.
+            log.debug("<-%s- [%.6f] %s" % (response_id_for_log(responsedata), elapsed, truncate_for_log(responsedata)))
+        if raw and http_response.status == HTTPStatus.OK:
+            return responsedata, http_response.status
+        response = json.loads(responsedata, parse_float=decimal.Decimal)
         return response, http_response.status
 
     def __truediv__(self, relative_uri):
-        return AuthServiceProxy("{}/{}".format(self.__service_url, relative_uri), self._service_name, connection=self.__conn)
-
-    def _set_conn(self, connection=None):
-        port = 80 if self.__url.port is None else self.__url.port
-        if connection:
-            self.__conn = connection
-            self.timeout = connection.timeout
-        elif self.__url.scheme == 'https':
-            self.__conn = http.client.HTTPSConnection(self.__url.hostname, port, timeout=self.timeout)
-        else:
-            self.__conn = http.client.HTTPConnection(self.__url.hostname, port, timeout=self.timeout)
+        return AuthServiceProxy("{}/{}".format(self.__service_url, relative_uri), self._service_name, pool=self.__pool, ensure_ascii=self.ensure_ascii)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# Copyright (c) 2023 The Elements Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Cached starting states of the test nodes.
+
+A ChainState describes how to build the datadirs a test starts from: the
+number of nodes, their extra arguments and a function generating the chain.
+States are built once, stored in the cache directory under a hash of their
+description, and cloned into the datadirs of every test declaring them:
+
+    def set_test_params(self):
+        self.num_nodes = 2
+        self.chain_state = ChainState("dynafed", generate=generate_dynafed,
+                                      extra_args=[["-evbparams=dynafed:0:::"]])
+"""
+
+import errno
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+# Whether reflinks may be supported; cleared on the first failure
+try:
+    import fcntl
+    _reflink_supported = hasattr(os, 'O_CLOEXEC')
+except ImportError:
+    _reflink_supported = False
+
+# ioctl cloning a file into another on filesystems supporting reflinks (Linux)
+FICLONE = 0x40049409
+
+
+class ChainState():
+    """A starting state of the test nodes, built once and cached.
+
+    generate(test_framework, nodes) is called with the nodes of the state
+    started (and available as test_framework.nodes), and builds their chain.
+    The nodes are stopped afterwards and only their chainstate, blocks,
+    indexes and wallets are kept. Test nodes beyond the nodes of the state
+    start from a copy of its last node.
+    """
+    def __init__(self, name, *, generate, num_nodes=1, extra_args=None):
+        assert num_nodes >= 1
+        self.name = name
+        self.generate = generate
+        self.num_nodes = num_nodes
+        self.extra_args = extra_args if extra_args is not None else [[]] * num_nodes
+        assert len(self.extra_args) == num_nodes
+
+    def key(self, chain):
+        """Return the cache key of the state: a hash of the chain, its parameters and its generator source."""
+        try:
+            recipe = inspect.getsource(self.generate)
+        except (OSError, TypeError):
+            recipe = self.generate.__qualname__
+        description = json.dumps([chain, self.name, self.num_nodes, self.extra_args, recipe])
+        return "{}-{}".format(self.name, hashlib.sha256(description.encode('utf8')).hexdigest()[:16])
+
+
+def clone_file(src, dst):
+    """Copy a file, sharing its data with the source where the filesystem allows it.
+
+    Files are reflinked where supported. Otherwise, leveldb table files, which
+    are never modified once written, are hardlinked, and other files copied."""
+    global _reflink_supported
+    if _reflink_supported:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return dst
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+                    raise
+                _reflink_supported = False
+        os.remove(dst)
+    if src.endswith('.ldb'):
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+def clone_datadir(src, dst):
+    """Clone a datadir from the cache with clone_file()."""
+    shutil.copytree(src, dst, copy_function=clone_file)
+
+
+class TestFrameworkChainCache(unittest.TestCase):
+    def test_key(self):
+        def generate(test_framework, nodes):
+            pass
+
+        state = ChainState("test", generate=generate)
+        self.assertEqual(state.key("elementsregtest"), ChainState("test", generate=generate).key("elementsregtest"))
+        self.assertNotEqual(state.key("elementsregtest"), state.key("liquidv1test"))
+        self.assertNotEqual(state.key("elementsregtest"), ChainState("test", generate=generate, extra_args=[["-txindex"]]).key("elementsregtest"))
+        self.assertNotEqual(state.key("elementsregtest"), ChainState("test", generate=lambda t, n: None).key("elementsregtest"))
+
+    def test_clone_datadir(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, "src")
+            os.makedirs(os.path.join(src, "chainstate"))
+            files = {os.path.join("chainstate", "000003.ldb"): b"table", os.path.join("chainstate", "MANIFEST-000002"): b"manifest"}
+            for name, data in files.items():
+                path = os.path.join(src, name)
+                with open(path, 'wb') as f:
+                    f.write(data)
+            dst = os.path.join(tmpdir, "dst")
+            clone_datadir(src, dst)
+            for name, data in files.items():
+                path = os.path.join(dst, name)
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(), data)
+            # Writing to a clone must not change the cache
+            path = os.path.join(dst, "chainstate", "MANIFEST-000002")
+            with open(path, 'ab') as f:
+                f.write(b"more")
+            path = os.path.join(src, "chainstate", "MANIFEST-000002")
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b"manifest")
+
+    def test_build_state(self):
+        # Build a state with more nodes than the test, like create_cache.py
+        # (num_nodes = 0), with stand-ins for the nodes
+        import argparse
+        import logging
+        from unittest import mock
+        from . import test_framework as framework_module
+        from .util import PortSeed
+
+        started = []
+
+        class DummyNode():
+            def __init__(self, i, datadir, *, chain, extra_args, **kwargs):
+                self.index = i
+                self.datadir = datadir
+                self.chain = chain
+                self.extra_args = extra_args
+
+            def start(self):
+                os.makedirs(os.path.join(self.datadir, self.chain, "blocks"))
+                with open(os.path.join(self.datadir, self.chain, "debug.log"), 'w', encoding='utf8') as f:
+                    f.write("started\n")
+                started.append(self.extra_args)
+
+            def wait_for_rpc_connection(self):
+                pass
+
+            def stop_node(self, **kwargs):
+                pass
+
+            def wait_until_stopped(self):
+                pass
+
+        def generate(test_framework, nodes):
+            self.assertIs(test_framework.nodes, nodes)
+            self.assertEqual(len(nodes), 2)
+
+        state = ChainState("test", generate=generate, num_nodes=2, extra_args=[["-a"], ["-b"]])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            framework = object.__new__(framework_module.BitcoinTestFramework)
+            framework.chain = "elementsregtest"
+            framework.num_nodes = 0
+            framework.nodes = []
+            framework.rpc_timeout = 60
+            framework.disable_autoconnect = True
+            framework.log = logging.getLogger("TestFramework")
+            framework.options = argparse.Namespace(cachedir=os.path.join(tmpdir, "cache"), tmpdir=tmpdir, timeout_factor=1,
+                                                   bitcoind=None, bitcoincli=None, descriptors=False)
+            state_dir = os.path.join(framework.options.cachedir, state.key(framework.chain))
+            portseed = PortSeed.n
+            PortSeed.n = 1
+            try:
+                with mock.patch.object(framework_module, "TestNode", DummyNode):
+                    framework._build_chain_state(state, state_dir)
+            finally:
+                PortSeed.n = portseed
+            self.assertEqual(started, [["-a"], ["-b"]])
+            self.assertEqual(framework.nodes, [])
+            # Only the chain data is kept in the cache
+            for i in range(2):
+                self.assertEqual(os.listdir(os.path.join(state_dir, "node{}".format(i), framework.chain)), ["blocks"])
@@ -10,7 +10,7 @@ testing.
 
 import os
 
-from .authproxy import AuthServiceProxy
+from .authproxy import AuthServiceProxy, RPCBatch
 
 REFERENCE_FILENAME = 'rpc_interface.txt'
 
@@ -50,6 +50,11 @@ class AuthServiceProxyWrapper():
         self._log_call()
         return return_val
 
+    def call_raw(self, *args, **kwargs):
+        return_val = self.auth_service_proxy_instance.call_raw(*args, **kwargs)
+        self._log_call()
+        return return_val
+
     def _log_call(self):
         rpc_method = self.auth_service_proxy_instance._service_name
 
@@ -66,6 +71,12 @@ class AuthServiceProxyWrapper():
         self._log_call()
         return self.auth_service_proxy_instance.get_request(*args, **kwargs)
 
+    def batch(self, rpc_call_list=None):
+        if rpc_call_list is None:
+            # Record the calls through this wrapper, so they are logged
+            return RPCBatch(self)
+        return self.auth_service_proxy_instance.batch(rpc_call_list)
+
 def get_filename(dirname, n_node):
     """
     Get a filename unique to the test process ID and node.
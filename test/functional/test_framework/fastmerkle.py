@@ -0,0 +1,170 @@
+# Copyright (c) 2023 The Elements Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Test-only pure Python implementation of the Elements fast merkle root.
+
+This mirrors ComputeFastMerkleRoot() in src/primitives/txwitness.cpp. Inner
+nodes are the raw SHA256 midstate of left || right (a single compression of
+one 64-byte block, without padding or length), so they cannot be computed with
+hashlib and need an explicit compression function.
+"""
+
+import struct
+import unittest
+
+# SHA256 round constants.
+K = [
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+]
+
+# SHA256 initial state.
+IV = (0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19)
+
+_BLOCK = struct.Struct(">16I")
+_STATE = struct.Struct(">8I")
+
+
+def sha256_compress(state, block):
+    """Apply one SHA256 compression of the 64-byte block to the 8-word state."""
+    w = list(_BLOCK.unpack(block))
+    for i in range(16, 64):
+        x, y = w[i - 15], w[i - 2]
+        s0 = ((x >> 7) | (x << 25)) ^ ((x >> 18) | (x << 14)) ^ (x >> 3)
+        s1 = ((y >> 17) | (y << 15)) ^ ((y >> 19) | (y << 13)) ^ (y >> 10)
+        w.append((w[i - 16] + (s0 & 0xffffffff) + w[i - 7] + (s1 & 0xffffffff)) & 0xffffffff)
+    a, b, c, d, e, f, g, h = state
+    for i in range(64):
+        s1 = ((e >> 6) | (e << 26)) ^ ((e >> 11) | (e << 21)) ^ ((e >> 25) | (e << 7))
+        ch = (e & f) ^ (~e & g)
+        t1 = h + (s1 & 0xffffffff) + ch + K[i] + w[i]
+        s0 = ((a >> 2) | (a << 30)) ^ ((a >> 13) | (a << 19)) ^ ((a >> 22) | (a << 10))
+        maj = (a & b) ^ (a & c) ^ (b & c)
+        t2 = (s0 & 0xffffffff) + maj
+        h, g, f, e, d, c, b, a = g, f, e, (d + t1) & 0xffffffff, c, b, a, (t1 + t2) & 0xffffffff
+    return tuple((x + y) & 0xffffffff for x, y in zip(state, (a, b, c, d, e, f, g, h)))
+
+
+def merkle_hash_midstate(left, right):
+    """Return the SHA256 midstate after writing left || right (32 bytes each)."""
+    return _STATE.pack(*sha256_compress(IV, left + right))
+
+
+def compute_fast_merkle_root(hashes):
+    """Compute the fast merkle root of a list of 32-byte hashes (internal byte order).
+
+    Returns 32 zero bytes for an empty list, like ComputeFastMerkleRoot()."""
+    if len(hashes) == 0:
+        return b'\x00' * 32
+    # inner[level] holds the eagerly computed subtree hash at that level, see
+    # the comments in ComputeFastMerkleRoot() for how count drives the walk.
+    inner = [None] * 32
+    count = 0
+    for leaf in hashes:
+        temp_hash = bytes(leaf)
+        count += 1
+        level = 0
+        while not (count & (1 << level)):
+            temp_hash = merkle_hash_midstate(inner[level], temp_hash)
+            level += 1
+        inner[level] = temp_hash
+
+    level = 0
+    while not (count & (1 << level)):
+        level += 1
+    result_hash = inner[level]
+    while count != (1 << level):
+        count += 1 << level
+        level += 1
+        while not (count & (1 << level)):
+            result_hash = merkle_hash_midstate(inner[level], result_hash)
+            level += 1
+    return result_hash
+
+
+class FastMerkleTree:
+    """Fast merkle tree that keeps its inner nodes between root computations.
+
+    Calling root() again with a list of the same length only rehashes the
+    paths above leaves that changed since the previous call. The tree is built
+    level by level; a node without a right sibling is carried up unchanged,
+    which yields the same root as ComputeFastMerkleRoot()."""
+
+    def __init__(self):
+        self.levels = []
+
+    def _build(self, hashes):
+        level = list(hashes)
+        self.levels = [level]
+        while len(level) > 1:
+            level = [merkle_hash_midstate(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                     for i in range(0, len(level), 2)]
+            self.levels.append(level)
+
+    def root(self, hashes):
+        """Return the fast merkle root of hashes, reusing unchanged subtrees."""
+        if len(hashes) == 0:
+            self.levels = []
+            return b'\x00' * 32
+        if not self.levels or len(self.levels[0]) != len(hashes):
+            self._build(hashes)
+            return self.levels[-1][0]
+        leaves = self.levels[0]
+        dirty = set()
+        for i, leaf in enumerate(hashes):
+            if leaf != leaves[i]:
+                leaves[i] = leaf
+                dirty.add(i)
+        for child, parent in zip(self.levels, self.levels[1:]):
+            dirty = {i >> 1 for i in dirty}
+            for i in dirty:
+                if 2 * i + 1 < len(child):
+                    parent[i] = merkle_hash_midstate(child[2 * i], child[2 * i + 1])
+                else:
+                    parent[i] = child[2 * i]
+        return self.levels[-1][0]
+
+
+class TestFrameworkFastMerkle(unittest.TestCase):
+    def test_sha256_compress(self):
+        # The single-block SHA256("abc") digest, with the padding done by hand.
+        block = b"abc" + b"\x80" + b"\x00" * 52 + (24).to_bytes(8, 'big')
+        self.assertEqual(_STATE.pack(*sha256_compress(IV, block)).hex(),
+                         "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad")
+
+    def test_fast_merkle_root(self):
+        # Vectors from fast_merkle_test in src/test/merkle_tests.cpp (uint256 hex order).
+        test_leaves = [
+            "b66b041650db0f297b53f8d93c0e8706925bf3323f8c59c14a6fac37bfdcd06f",
+            "99cb2fa68b2294ae133550a9f765fc755d71baa7b24389fed67d1ef3e5cb0255",
+            "257e1b2fa49dd15724c67bac4df7911d44f6689860aa9f65a881ae0a2f40a303",
+            "b67b0b9f093fa83d5e44b707ab962502b7ac58630e556951136196e65483bb80",
+        ]
+        test_roots = [
+            "0000000000000000000000000000000000000000000000000000000000000000",
+            "b66b041650db0f297b53f8d93c0e8706925bf3323f8c59c14a6fac37bfdcd06f",
+            "f752938da0cb71c051aabdd5a86658e8d0b7ac00e1c2074202d8d2a79d8a6cf6",
+            "245d364a28e9ad20d522c4a25ffc6a7369ab182f884e1c7dcd01aa3d32896bd3",
+            "317d6498574b6ca75ee0368ec3faec75e096e245bdd5f36e8726fa693f775dfc",
+        ]
+        leaves = [bytes.fromhex(leaf)[::-1] for leaf in test_leaves]
+        for i, root in enumerate(test_roots):
+            self.assertEqual(compute_fast_merkle_root(leaves[:i])[::-1].hex(), root)
+
+    def test_fast_merkle_tree(self):
+        leaves = [_STATE.pack(*sha256_compress(IV, bytes([i]) * 64)) for i in range(13)]
+        tree = FastMerkleTree()
+        for n in range(len(leaves) + 1):
+            self.assertEqual(tree.root(leaves[:n]), compute_fast_merkle_root(leaves[:n]))
+        # Update single leaves in place, then all of them at once.
+        for i in (0, 5, 12):
+            leaves[i] = bytes(32)
+            self.assertEqual(tree.root(leaves), compute_fast_merkle_root(leaves))
+        leaves.reverse()
+        self.assertEqual(tree.root(leaves), compute_fast_merkle_root(leaves))
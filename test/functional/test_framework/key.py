@@ -11,15 +11,22 @@ import hashlib
 import hmac
 import os
 import random
+from typing import Any, Dict
 import unittest
 
 from .util import modinv
 
+# SHA256 objects that have already consumed sha256(tag) || sha256(tag), per tag
+TAGGED_HASH_MIDSTATES: Dict[str, Any] = {}
+
 def TaggedHash(tag, data):
-    ss = hashlib.sha256(tag.encode('utf-8')).digest()
-    ss += ss
-    ss += data
-    return hashlib.sha256(ss).digest()
+    midstate = TAGGED_HASH_MIDSTATES.get(tag)
+    if midstate is None:
+        ss = hashlib.sha256(tag.encode('utf-8')).digest()
+        midstate = TAGGED_HASH_MIDSTATES[tag] = hashlib.sha256(ss + ss)
+    h = midstate.copy()
+    h.update(data)
+    return h.digest()
 
 def jacobi_symbol(n, k):
     """Compute the Jacobi symbol of n modulo k
@@ -60,12 +67,37 @@ def modsqrt(a, p):
         return sqrt
     return None
 
+def wnaf(n, w):
+    """Compute the width-w non-adjacent form of a non-negative integer n.
+
+    Returns the list of digits, least significant first. Every nonzero digit
+    is odd and smaller than 2**(w-1) in absolute value, and any w consecutive
+    digits contain at most one nonzero digit."""
+    digits = []
+    while n:
+        if n & 1:
+            d = n & ((1 << w) - 1)
+            if d >= 1 << (w - 1):
+                d -= 1 << w
+            n -= d
+        else:
+            d = 0
+        digits.append(d)
+        n >>= 1
+    return digits
+
 class EllipticCurve:
+    # Window sizes for the fixed-base tables and for the wNAF of variable points.
+    FIXED_WINDOW = 8
+    WNAF_WINDOW = 5
+
     def __init__(self, p, a, b):
         """Initialize elliptic curve y^2 = x^3 + a*x + b over GF(p)."""
         self.p = p
         self.a = a % p
         self.b = b % p
+        # Maps affine points to their fixed-base table (None until first use)
+        self.fixed_bases = {}
 
     def affine(self, p1):
         """Convert a Jacobian point tuple p1 to affine form, or None if at infinity.
@@ -79,6 +111,31 @@ class EllipticCurve:
         inv_3 = (inv_2 * inv) % self.p
         return ((inv_2 * x1) % self.p, (inv_3 * y1) % self.p, 1)
 
+    def affine_batch(self, ps):
+        """Convert a list of Jacobian point tuples to affine form using a single inversion.
+
+        Points at infinity are returned as None, like affine()."""
+        # Montgomery's trick: invert the product of all Z coordinates, then
+        # peel off the individual inverses from the prefix products.
+        prefix = []
+        acc = 1
+        for (_, _, z1) in ps:
+            prefix.append(acc)
+            if z1 != 0:
+                acc = (acc * z1) % self.p
+        inv = modinv(acc, self.p)
+        ret = [None] * len(ps)
+        for i in range(len(ps) - 1, -1, -1):
+            x1, y1, z1 = ps[i]
+            if z1 == 0:
+                continue
+            inv_1 = (inv * prefix[i]) % self.p
+            inv = (inv * z1) % self.p
+            inv_2 = (inv_1**2) % self.p
+            inv_3 = (inv_2 * inv_1) % self.p
+            ret[i] = ((inv_2 * x1) % self.p, (inv_3 * y1) % self.p, 1)
+        return ret
+
     def has_even_y(self, p1):
         """Whether the point p1 has an even Y coordinate when expressed in affine coordinates."""
         return not (p1[2] == 0 or self.affine(p1)[1] & 1)
@@ -199,24 +256,88 @@ class EllipticCurve:
         z3 = (h*z1*z2) % self.p
         return (x3, y3, z3)
 
+    def add_fixed_base(self, p1):
+        """Register the affine point p1 for fixed-base multiplication.
+
+        The table of window multiples is only built the first time mul() needs it."""
+        assert p1[2] == 1
+        self.fixed_bases.setdefault(p1, None)
+
+    def fixed_base_table(self, p1):
+        """Return the table for p1, with table[i][j - 1] = j * 2**(FIXED_WINDOW*i) * p1 in affine form."""
+        table = self.fixed_bases[p1]
+        if table is None:
+            table = []
+            size = 1 << self.FIXED_WINDOW
+            base = p1
+            for _ in range((256 + self.FIXED_WINDOW - 1) // self.FIXED_WINDOW):
+                row = [base]
+                for _ in range(size - 2):
+                    row.append(self.add_mixed(row[-1], base))
+                row = self.affine_batch(row)
+                table.append(row)
+                base = self.affine(self.double(row[size // 2 - 1]))
+            self.fixed_bases[p1] = table
+        return table
+
+    def odd_multiples(self, p1, w):
+        """Return [p1, 3*p1, ..., (2**(w-1) - 1)*p1] in affine form."""
+        p1_2 = self.double(p1)
+        ret = [p1]
+        for _ in range((1 << (w - 2)) - 1):
+            ret.append(self.add(ret[-1], p1_2))
+        return self.affine_batch(ret)
+
     def mul(self, ps):
         """Compute a (multi) point multiplication
 
         ps is a list of (Jacobian tuple, scalar) pairs.
+
+        Registered fixed bases use their precomputed table, which needs no
+        doublings at all. All other points are multiplied together (Strauss'
+        algorithm) using wNAF representations of their scalars, so the
+        doublings are shared between them.
         """
         r = (0, 1, 0)
-        for i in range(255, -1, -1):
-            r = self.double(r)
-            for (p, n) in ps:
-                if ((n >> i) & 1):
-                    r = self.add(r, p)
-        return r
+        wnafs = []
+        for (p, n) in ps:
+            if p[2] == 0 or n == 0:
+                continue
+            if n < 0:
+                p, n = self.negate(p), -n
+            if p in self.fixed_bases and n >> 256 == 0:
+                mask = (1 << self.FIXED_WINDOW) - 1
+                for row in self.fixed_base_table(p):
+                    if n & mask:
+                        r = self.add_mixed(r, row[(n & mask) - 1])
+                    n >>= self.FIXED_WINDOW
+                continue
+            p = self.affine(p)
+            if p is None:
+                continue
+            table = self.odd_multiples(p, self.WNAF_WINDOW)
+            wnafs.append((wnaf(n, self.WNAF_WINDOW), table, [self.negate(q) for q in table]))
+        if not wnafs:
+            return r
+
+        q = (0, 1, 0)
+        for i in range(max(len(digits) for digits, _, _ in wnafs) - 1, -1, -1):
+            q = self.double(q)
+            for (digits, table, neg_table) in wnafs:
+                if i < len(digits) and digits[i]:
+                    d = digits[i]
+                    if d > 0:
+                        q = self.add_mixed(q, table[d >> 1])
+                    else:
+                        q = self.add_mixed(q, neg_table[(-d) >> 1])
+        return self.add(q, r)
 
 SECP256K1_FIELD_SIZE = 2**256 - 2**32 - 977
 SECP256K1 = EllipticCurve(SECP256K1_FIELD_SIZE, 0, 7)
 SECP256K1_G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798, 0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8, 1)
 SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
 SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
+SECP256K1.add_fixed_base(SECP256K1_G)
 
 class ECPubKey():
     """A secp256k1 public key"""
@@ -486,6 +607,49 @@ def verify_schnorr(key, sig, msg):
         return False
     return True
 
+def verify_schnorr_batch(items):
+    """Verify a list of (key, sig, msg) Schnorr signatures at once (see BIP 340).
+
+    Returns True only if all signatures are valid. This checks a random
+    linear combination of the verification equations with a single
+    multi-scalar multiplication; it does not tell which signature is invalid.
+    """
+    ps = []
+    # Scalars of the public keys, combined for signatures by the same key.
+    key_scalars = {}
+    s_sum = 0
+    for i, (key, sig, msg) in enumerate(items):
+        assert len(key) == 32
+        assert len(msg) == 32
+        assert len(sig) == 64
+
+        x_coord = int.from_bytes(key, 'big')
+        if x_coord == 0 or x_coord >= SECP256K1_FIELD_SIZE:
+            return False
+        P = SECP256K1.lift_x(x_coord)
+        if P is None:
+            return False
+        r = int.from_bytes(sig[0:32], 'big')
+        if r >= SECP256K1_FIELD_SIZE:
+            return False
+        R = SECP256K1.lift_x(r)
+        if R is None:
+            return False
+        s = int.from_bytes(sig[32:64], 'big')
+        if s >= SECP256K1_ORDER:
+            return False
+        e = int.from_bytes(TaggedHash("BIP0340/challenge", sig[0:32] + key + msg), 'big') % SECP256K1_ORDER
+        # The first equation does not need a random factor, for the others
+        # 128 bits are enough and keep the R multiplications short.
+        a = 1 if i == 0 else random.randrange(1, 2**128)
+        s_sum += a * s
+        ps.append((SECP256K1.negate(R), a))
+        key_scalars[P] = (key_scalars.get(P, 0) + a * e) % SECP256K1_ORDER
+    for P, n in key_scalars.items():
+        ps.append((P, SECP256K1_ORDER - n))
+    ps.append((SECP256K1_G, s_sum % SECP256K1_ORDER))
+    return SECP256K1.mul(ps)[2] == 0
+
 def sign_schnorr(key, msg, aux=None, flip_p=False, flip_r=False):
     """Create a Schnorr signature (see BIP 340)."""
 
@@ -502,15 +666,59 @@ def sign_schnorr(key, msg, aux=None, flip_p=False, flip_r=False):
     P = SECP256K1.affine(SECP256K1.mul([(SECP256K1_G, sec)]))
     if SECP256K1.has_even_y(P) == flip_p:
         sec = SECP256K1_ORDER - sec
+    return _sign_schnorr(sec, P[0].to_bytes(32, 'big'), msg, aux, flip_r)
+
+def sign_schnorr_many(key, msgs, aux=None, flip_p=False, flip_r=False):
+    """Create Schnorr signatures for a list of messages with the same key.
+
+    The public key is only computed once. aux is used for all messages.
+    Returns None if the key is invalid."""
+
+    if aux is None:
+        aux = bytes(32)
+
+    assert len(key) == 32
+    assert len(aux) == 32
+
+    sec = int.from_bytes(key, 'big')
+    if sec == 0 or sec >= SECP256K1_ORDER:
+        return None
+    P = SECP256K1.affine(SECP256K1.mul([(SECP256K1_G, sec)]))
+    if SECP256K1.has_even_y(P) == flip_p:
+        sec = SECP256K1_ORDER - sec
+    px = P[0].to_bytes(32, 'big')
+    return [_sign_schnorr(sec, px, msg, aux, flip_r) for msg in msgs]
+
+def _sign_schnorr(sec, px, msg, aux, flip_r):
+    """Sign msg with the (already negated if needed) secret sec for x-only pubkey px."""
     t = (sec ^ int.from_bytes(TaggedHash("BIP0340/aux", aux), 'big')).to_bytes(32, 'big')
-    kp = int.from_bytes(TaggedHash("BIP0340/nonce", t + P[0].to_bytes(32, 'big') + msg), 'big') % SECP256K1_ORDER
+    kp = int.from_bytes(TaggedHash("BIP0340/nonce", t + px + msg), 'big') % SECP256K1_ORDER
     assert kp != 0
     R = SECP256K1.affine(SECP256K1.mul([(SECP256K1_G, kp)]))
     k = kp if SECP256K1.has_even_y(R) != flip_r else SECP256K1_ORDER - kp
-    e = int.from_bytes(TaggedHash("BIP0340/challenge", R[0].to_bytes(32, 'big') + P[0].to_bytes(32, 'big') + msg), 'big') % SECP256K1_ORDER
+    e = int.from_bytes(TaggedHash("BIP0340/challenge", R[0].to_bytes(32, 'big') + px + msg), 'big') % SECP256K1_ORDER
     return R[0].to_bytes(32, 'big') + ((k + e * sec) % SECP256K1_ORDER).to_bytes(32, 'big')
 
 class TestFrameworkKey(unittest.TestCase):
+    def test_mul(self):
+        """Compare the table/wNAF point multiplication with plain double-and-add."""
+        def mul_naive(ps):
+            r = (0, 1, 0)
+            for i in range(255, -1, -1):
+                r = SECP256K1.double(r)
+                for (p, n) in ps:
+                    if ((n >> i) & 1):
+                        r = SECP256K1.add(r, p)
+            return r
+        for _ in range(10):
+            a = random.randrange(1, SECP256K1_ORDER)
+            b = random.randrange(1, SECP256K1_ORDER)
+            P = SECP256K1.mul([(SECP256K1_G, random.randrange(1, SECP256K1_ORDER))])
+            for ps in ([(SECP256K1_G, a)], [(P, b)], [(SECP256K1_G, a), (P, b)],
+                       [(P, b), (SECP256K1.negate(P), b)], [(SECP256K1_G, SECP256K1_ORDER)],
+                       [(SECP256K1_G, 0), (P, 1)], [(SECP256K1_G, a), (SECP256K1_G, SECP256K1_ORDER - a)]):
+                self.assertEqual(SECP256K1.affine(SECP256K1.mul(ps)), SECP256K1.affine(mul_naive(ps)))
+
     def test_schnorr(self):
         """Test the Python Schnorr implementation."""
         byte_arrays = [generate_privkey() for _ in range(3)] + [v.to_bytes(32, 'big') for v in [0, SECP256K1_ORDER - 1, SECP256K1_ORDER, 2**256 - 1]]
@@ -533,6 +741,7 @@ class TestFrameworkKey(unittest.TestCase):
     def test_schnorr_testvectors(self):
         """Implement the BIP340 test vectors (read from bip340_test_vectors.csv)."""
         num_tests = 0
+        valid = []
         vectors_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'bip340_test_vectors.csv')
         with open(vectors_file, newline='', encoding='utf8') as csvfile:
             reader = csv.reader(csvfile)
@@ -555,9 +764,34 @@ class TestFrameworkKey(unittest.TestCase):
                     except RuntimeError as e:
                         self.fail("BIP340 test vector %i (%s): signing raised exception %s" % (i, comment, e))
                 result_actual = verify_schnorr(pubkey, sig, msg)
+                if result:
+                    valid.append((pubkey, sig, msg))
+                else:
+                    self.assertFalse(verify_schnorr_batch([(pubkey, sig, msg)]), "BIP340 test vector %i (%s): batch verification succeeded unexpectedly" % (i, comment))
                 if result:
                     self.assertEqual(result, result_actual, "BIP340 test vector %i (%s): verification failed" % (i, comment))
                 else:
                     self.assertEqual(result, result_actual, "BIP340 test vector %i (%s): verification succeeded unexpectedly" % (i, comment))
                 num_tests += 1
         self.assertTrue(num_tests >= 15) # expect at least 15 test vectors
+        self.assertTrue(verify_schnorr_batch(valid))
+
+    def test_schnorr_many(self):
+        """Test batch signing and batch verification against the single versions."""
+        key = generate_privkey()
+        pubkey, _ = compute_xonly_pubkey(key)
+        msgs = [random.getrandbits(256).to_bytes(32, 'big') for _ in range(5)]
+        aux = random.getrandbits(256).to_bytes(32, 'big')
+        for flip_p in (False, True):
+            for flip_r in (False, True):
+                sigs = sign_schnorr_many(key, msgs, aux, flip_p=flip_p, flip_r=flip_r)
+                self.assertEqual(sigs, [sign_schnorr(key, msg, aux, flip_p=flip_p, flip_r=flip_r) for msg in msgs])
+                self.assertEqual(verify_schnorr_batch([(pubkey, sig, msg) for sig, msg in zip(sigs, msgs)]), not (flip_p or flip_r))
+        items = [(pubkey, sig, msg) for sig, msg in zip(sign_schnorr_many(key, msgs), msgs)]
+        self.assertTrue(verify_schnorr_batch(items))
+        self.assertTrue(verify_schnorr_batch([]))
+        for i in range(len(items)):
+            # Swapping two messages breaks exactly two signatures.
+            broken = list(items)
+            broken[i], broken[i - 1] = (pubkey, items[i][1], items[i - 1][2]), (pubkey, items[i - 1][1], items[i][2])
+            self.assertFalse(verify_schnorr_batch(broken))
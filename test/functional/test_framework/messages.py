@@ -27,9 +27,12 @@ import random
 import socket
 import struct
 import time
+from typing import Dict, Tuple
+import unittest
 
+from test_framework.fastmerkle import FastMerkleTree, compute_fast_merkle_root
 from test_framework.siphash import siphash256
-from test_framework.util import calcfastmerkleroot, BITCOIN_ASSET_OUT, assert_equal
+from test_framework.util import BITCOIN_ASSET_OUT, assert_equal
 
 MAX_LOCATOR_SZ = 101
 MAX_BLOCK_WEIGHT = 4000000
@@ -65,6 +68,8 @@ FILTER_TYPE_BASIC = 0
 
 WITNESS_SCALE_FACTOR = 4
 
+UINT256_MASK = (1 << 256) - 1
+
 
 def sha256(s):
     return hashlib.sha256(s).digest()
@@ -103,6 +108,10 @@ def deser_string(f):
 def ser_string(s):
     return ser_compact_size(len(s)) + s
 
+def ser_string_into(buf, s):
+    buf += ser_compact_size(len(s))
+    buf += s
+
 def deser_uint256(f):
     r = 0
     for i in range(8):
@@ -112,11 +121,7 @@ def deser_uint256(f):
 
 
 def ser_uint256(u):
-    rs = b""
-    for _ in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    return (u & UINT256_MASK).to_bytes(32, 'little')
 
 
 def uint256_from_str(s):
@@ -148,17 +153,48 @@ def deser_vector(f, c, deser_function_name=None):
     return r
 
 
+# Cache for ser_into(), mapping (class, ser_function_name) to whether the
+# matching *_into method may be used.
+_ser_into_cache: Dict[Tuple[type, str], bool] = {}
+
+
+def ser_into(buf, obj, ser_function_name="serialize"):
+    """Append the serialization of obj to the bytearray buf.
+
+    This calls obj.<ser_function_name>_into(buf), unless a subclass overrides
+    <ser_function_name> without also overriding the *_into variant (like
+    tests that produce invalid serializations do), in which case the result
+    of the overriding method is appended instead."""
+    key = (type(obj), ser_function_name)
+    use_into = _ser_into_cache.get(key)
+    if use_into is None:
+        use_into = False
+        for cls in type(obj).__mro__:
+            if ser_function_name + "_into" in cls.__dict__:
+                use_into = True
+                break
+            if ser_function_name in cls.__dict__:
+                break
+        _ser_into_cache[key] = use_into
+    if use_into:
+        getattr(obj, ser_function_name + "_into")(buf)
+    else:
+        buf += getattr(obj, ser_function_name)()
+
+
 # ser_function_name: Allow for an alternate serialization function on the
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
+    buf = bytearray()
+    ser_vector_into(buf, l, ser_function_name)
+    return bytes(buf)
+
+
+def ser_vector_into(buf, l, ser_function_name=None):
+    buf += ser_compact_size(len(l))
     for i in l:
-        if ser_function_name:
-            r += getattr(i, ser_function_name)()
-        else:
-            r += i.serialize()
-    return r
+        ser_into(buf, i, ser_function_name or "serialize")
 
 
 def deser_uint256_vector(f):
@@ -171,10 +207,15 @@ def deser_uint256_vector(f):
 
 
 def ser_uint256_vector(l):
-    r = ser_compact_size(len(l))
+    buf = bytearray()
+    ser_uint256_vector_into(buf, l)
+    return bytes(buf)
+
+
+def ser_uint256_vector_into(buf, l):
+    buf += ser_compact_size(len(l))
     for i in l:
-        r += ser_uint256(i)
-    return r
+        buf += ser_uint256(i)
 
 
 def deser_string_vector(f):
@@ -187,10 +228,115 @@ def deser_string_vector(f):
 
 
 def ser_string_vector(l):
-    r = ser_compact_size(len(l))
+    buf = bytearray()
+    ser_string_vector_into(buf, l)
+    return bytes(buf)
+
+
+def ser_string_vector_into(buf, l):
+    buf += ser_compact_size(len(l))
     for sv in l:
-        r += ser_string(sv)
-    return r
+        ser_string_into(buf, sv)
+
+
+# Precompiled structs used by ByteReader
+STRUCT_U16 = struct.Struct("<H")
+STRUCT_I32 = struct.Struct("<i")
+STRUCT_U32 = struct.Struct("<I")
+STRUCT_U64 = struct.Struct("<Q")
+STRUCT_OUTPOINT = struct.Struct("<32sI")
+
+
+class ByteReader:
+    """Offset cursor over a memoryview, used by the deserialize_mv() methods.
+
+    deserialize_mv(r) mirrors deserialize(f) on the classes that implement it,
+    but unpacks fixed-size fields in place with precompiled structs instead of
+    reading every field out of a BytesIO first. read() behaves like
+    BytesIO.read(), so deserialize(f) still works on a ByteReader for classes
+    without a deserialize_mv() method."""
+    __slots__ = ("buf", "pos")
+
+    def __init__(self, data, pos=0):
+        self.buf = memoryview(data)
+        self.pos = pos
+
+    def read(self, n):
+        r = bytes(self.buf[self.pos:self.pos + n])
+        self.pos += len(r)
+        return r
+
+    def read_bytes(self, n):
+        """Like read(), but raise if fewer than n bytes are left."""
+        pos = self.pos
+        end = pos + n
+        if end > len(self.buf):
+            raise ValueError("unexpected end of data: %d bytes requested, %d left" % (n, len(self.buf) - pos))
+        self.pos = end
+        return bytes(self.buf[pos:end])
+
+    def read_u8(self):
+        r = self.buf[self.pos]
+        self.pos += 1
+        return r
+
+    def read_i32(self):
+        r = STRUCT_I32.unpack_from(self.buf, self.pos)[0]
+        self.pos += 4
+        return r
+
+    def read_u32(self):
+        r = STRUCT_U32.unpack_from(self.buf, self.pos)[0]
+        self.pos += 4
+        return r
+
+    def read_u64(self):
+        r = STRUCT_U64.unpack_from(self.buf, self.pos)[0]
+        self.pos += 8
+        return r
+
+    def read_uint256(self):
+        pos = self.pos
+        if pos + 32 > len(self.buf):
+            raise ValueError("unexpected end of data: 32 bytes requested, %d left" % (len(self.buf) - pos))
+        self.pos = pos + 32
+        return int.from_bytes(self.buf[pos:pos + 32], 'little')
+
+    def read_compact_size(self):
+        nit = self.buf[self.pos]
+        self.pos += 1
+        if nit == 253:
+            nit = STRUCT_U16.unpack_from(self.buf, self.pos)[0]
+            self.pos += 2
+        elif nit == 254:
+            nit = self.read_u32()
+        elif nit == 255:
+            nit = self.read_u64()
+        return nit
+
+    def read_string(self):
+        # Inlined single-byte compact size, which covers nearly all strings
+        n = self.buf[self.pos]
+        if n >= 253:
+            return self.read_bytes(self.read_compact_size())
+        pos = self.pos + 1
+        end = pos + n
+        if end > len(self.buf):
+            raise ValueError("unexpected end of data: %d bytes requested, %d left" % (n, len(self.buf) - pos))
+        self.pos = end
+        return bytes(self.buf[pos:end])
+
+    def read_string_vector(self):
+        return [self.read_string() for _ in range(self.read_compact_size())]
+
+    def read_uint256_vector(self):
+        return [self.read_uint256() for _ in range(self.read_compact_size())]
+
+    def read_vector(self, c):
+        r = [c() for _ in range(self.read_compact_size())]
+        for t in r:
+            t.deserialize_mv(self)
+        return r
 
 
 def from_hex(obj, hex_string):
@@ -199,7 +345,15 @@ def from_hex(obj, hex_string):
     Note that there is no complementary helper like e.g. `to_hex` for the
     inverse operation. To serialize a message object to a hex string, simply
     use obj.serialize().hex()"""
-    obj.deserialize(BytesIO(bytes.fromhex(hex_string)))
+    return from_bytes(obj, bytes.fromhex(hex_string))
+
+
+def from_bytes(obj, data):
+    """Deserialize from a bytes-like object, using deserialize_mv() if obj supports it"""
+    if hasattr(obj, "deserialize_mv"):
+        obj.deserialize_mv(ByteReader(data))
+    else:
+        obj.deserialize(BytesIO(data))
     return obj
 
 
@@ -254,16 +408,19 @@ class CAddress:
 
     def serialize(self, *, with_time=True):
         """Serialize in addrv1 format (pre-BIP155)"""
+        buf = bytearray()
+        self.serialize_into(buf, with_time=with_time)
+        return bytes(buf)
+
+    def serialize_into(self, buf, *, with_time=True):
         assert self.net == self.NET_IPV4
-        r = b""
         if with_time:
             # VERSION messages serialize CAddress objects without time
-            r += struct.pack("<I", self.time)
-        r += struct.pack("<Q", self.nServices)
-        r += b"\x00" * 10 + b"\xff" * 2
-        r += socket.inet_aton(self.ip)
-        r += struct.pack(">H", self.port)
-        return r
+            buf += struct.pack("<I", self.time)
+        buf += struct.pack("<Q", self.nServices)
+        buf += b"\x00" * 10 + b"\xff" * 2
+        buf += socket.inet_aton(self.ip)
+        buf += struct.pack(">H", self.port)
 
     def deserialize_v2(self, f):
         """Deserialize from addrv2 format (BIP155)"""
@@ -287,20 +444,23 @@ class CAddress:
 
     def serialize_v2(self):
         """Serialize in addrv2 format (BIP155)"""
+        buf = bytearray()
+        self.serialize_v2_into(buf)
+        return bytes(buf)
+
+    def serialize_v2_into(self, buf):
         assert self.net in (self.NET_IPV4, self.NET_I2P)
-        r = b""
-        r += struct.pack("<I", self.time)
-        r += ser_compact_size(self.nServices)
-        r += struct.pack("B", self.net)
-        r += ser_compact_size(self.ADDRV2_ADDRESS_LENGTH[self.net])
+        buf += struct.pack("<I", self.time)
+        buf += ser_compact_size(self.nServices)
+        buf += struct.pack("B", self.net)
+        buf += ser_compact_size(self.ADDRV2_ADDRESS_LENGTH[self.net])
         if self.net == self.NET_IPV4:
-            r += socket.inet_aton(self.ip)
+            buf += socket.inet_aton(self.ip)
         else:
             sfx = ".b32.i2p"
             assert self.ip.endswith(sfx)
-            r += b32decode(self.ip[0:-len(sfx)] + self.I2P_PAD, True)
-        r += struct.pack(">H", self.port)
-        return r
+            buf += b32decode(self.ip[0:-len(sfx)] + self.I2P_PAD, True)
+        buf += struct.pack(">H", self.port)
 
     def __repr__(self):
         return ("CAddress(nServices=%i net=%s addr=%s port=%i)"
@@ -330,10 +490,13 @@ class CInv:
         self.hash = deser_uint256(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<I", self.type)
-        r += ser_uint256(self.hash)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<I", self.type)
+        buf += ser_uint256(self.hash)
 
     def __repr__(self):
         return "CInv(type=%s hash=%064x)" \
@@ -354,10 +517,13 @@ class CBlockLocator:
         self.vHave = deser_uint256_vector(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", 0)  # Bitcoin Core ignores version field. Set it to 0.
-        r += ser_uint256_vector(self.vHave)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<i", 0)  # Bitcoin Core ignores version field. Set it to 0.
+        ser_uint256_vector_into(buf, self.vHave)
 
     def __repr__(self):
         return "CBlockLocator(vHave=%s)" % (repr(self.vHave))
@@ -377,11 +543,18 @@ class COutPoint:
         self.hash = deser_uint256(f)
         self.n = struct.unpack("<I", f.read(4))[0]
 
+    def deserialize_mv(self, r):
+        self.hash = r.read_uint256()
+        self.n = r.read_u32()
+
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += ser_uint256(self.hash)
+        buf += struct.pack("<I", self.n)
 
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
@@ -412,14 +585,26 @@ class CAssetIssuance():
         self.nInflationKeys.deserialize(f)
         self.denomination = deser_compact_size(f)
 
+    def deserialize_mv(self, r):
+        self.assetBlindingNonce = r.read_uint256()
+        self.assetEntropy = r.read_uint256()
+        self.nAmount = CTxOutValue()
+        self.nAmount.deserialize_mv(r)
+        self.nInflationKeys = CTxOutValue()
+        self.nInflationKeys.deserialize_mv(r)
+        self.denomination = r.read_compact_size()
+
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.assetBlindingNonce)
-        r += ser_uint256(self.assetEntropy)
-        r += self.nAmount.serialize()
-        r += self.nInflationKeys.serialize()
-        r += ser_compact_size(self.denomination)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += ser_uint256(self.assetBlindingNonce)
+        buf += ser_uint256(self.assetEntropy)
+        ser_into(buf, self.nAmount)
+        ser_into(buf, self.nInflationKeys)
+        buf += ser_compact_size(self.denomination)
 
     # serialization of asset issuance used in taproot sighash
     def taphash_asset_issuance_serialize(self):
@@ -465,7 +650,32 @@ class CTxIn:
             self.assetIssuance = CAssetIssuance()
             self.assetIssuance.deserialize(f)
 
+    def deserialize_mv(self, r):
+        prevout_hash, prevout_n = STRUCT_OUTPOINT.unpack_from(r.buf, r.pos)
+        r.pos += 36
+        self.prevout = COutPoint(int.from_bytes(prevout_hash, 'little'), prevout_n)
+
+        has_asset_issuance = False
+        if not self.prevout.isNull(): # ignore coinbase for issuance/pegin
+            if self.prevout.n & OUTPOINT_ISSUANCE_FLAG > 0:
+                has_asset_issuance = True
+            if self.prevout.n & OUTPOINT_PEGIN_FLAG > 0:
+                self.m_is_pegin = True
+            self.prevout.n = self.prevout.n & OUTPOINT_INDEX_MASK
+
+        self.scriptSig = r.read_string()
+        self.nSequence = r.read_u32()
+
+        if has_asset_issuance:
+            self.assetIssuance = CAssetIssuance()
+            self.assetIssuance.deserialize_mv(r)
+
     def serialize(self):
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
         outpoint = COutPoint()
         outpoint.hash = self.prevout.hash
         outpoint.n = self.prevout.n
@@ -476,13 +686,11 @@ class CTxIn:
             if self.m_is_pegin:
                 outpoint.n |= OUTPOINT_PEGIN_FLAG
 
-        r = b""
-        r += outpoint.serialize()
-        r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
+        outpoint.serialize_into(buf)
+        ser_string_into(buf, self.scriptSig)
+        buf += struct.pack("<I", self.nSequence)
         if self.prevout.n != 4294967295 and outpoint.n & OUTPOINT_ISSUANCE_FLAG:
-            r += self.assetIssuance.serialize()
-        return r
+            ser_into(buf, self.assetIssuance)
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i m_is_pegin=%s assetIssuance=%s)" \
@@ -511,10 +719,23 @@ class CTxOutAsset:
         else:
             raise 'invalid CTxOutAsset in deserialize'
 
+    def deserialize_mv(self, r):
+        version = r.read_u8()
+        if version == 0:
+            self.vchCommitment = b'\x00'
+        elif version in (1, 0xff, 10, 11):
+            r.pos -= 1
+            self.vchCommitment = r.read_bytes(33)
+        else:
+            raise ValueError('invalid CTxOutAsset in deserialize. version %d' % version)
+
     def serialize(self):
-        r = b""
-        r += self.vchCommitment
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += self.vchCommitment
 
     def setToAsset(self, val):
        if len(val) != 32:
@@ -551,12 +772,28 @@ class CTxOutValue:
         else:
             raise Exception('invalid CTxOutValue in deserialize. version %d' % version)
 
+    def deserialize_mv(self, r):
+        version = r.read_u8()
+        if version == 0:
+            self.vchCommitment = b'\x00'
+        elif version == 1 or version == 0xff:
+            r.pos -= 1
+            self.vchCommitment = r.read_bytes(9)
+        elif version == 8 or version == 9:
+            r.pos -= 1
+            self.vchCommitment = r.read_bytes(33)
+        else:
+            raise Exception('invalid CTxOutValue in deserialize. version %d' % version)
+
     def serialize(self):
-        r = b""
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
         if len(self.vchCommitment) < 1:
             raise ValueError('invalid commitment')
-        r += self.vchCommitment
-        return r
+        buf += self.vchCommitment
 
     def setToAmount(self, amount):
         if type(amount) == int:
@@ -603,10 +840,23 @@ class CTxOutNonce:
         else:
             raise ValueError('invalid CTxOutNonce in deserialize')
 
+    def deserialize_mv(self, r):
+        version = r.read_u8()
+        if version == 0:
+            self.vchCommitment = b'\x00'
+        elif version in (1, 0xff, 2, 3):
+            r.pos -= 1
+            self.vchCommitment = r.read_bytes(33)
+        else:
+            raise ValueError('invalid CTxOutNonce in deserialize')
+
     def serialize(self):
-        r = b""
-        r += self.vchCommitment
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += self.vchCommitment
 
     def __repr__(self):
         return "CTxOutNonce(vchCommitment=%s)" % self.vchCommitment
@@ -642,13 +892,25 @@ class CTxOut():
         self.nNonce.deserialize(f)
         self.scriptPubKey = deser_string(f)
 
+    def deserialize_mv(self, r):
+        self.nAsset = CTxOutAsset()
+        self.nAsset.deserialize_mv(r)
+        self.nValue = CTxOutValue()
+        self.nValue.deserialize_mv(r)
+        self.nNonce = CTxOutNonce()
+        self.nNonce.deserialize_mv(r)
+        self.scriptPubKey = r.read_string()
+
     def serialize(self):
-        r = b""
-        r += self.nAsset.serialize()
-        r += self.nValue.serialize()
-        r += self.nNonce.serialize()
-        r += ser_string(self.scriptPubKey)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        ser_into(buf, self.nAsset)
+        ser_into(buf, self.nValue)
+        ser_into(buf, self.nNonce)
+        ser_string_into(buf, self.scriptPubKey)
 
     def from_pegin_witness_data(self, peg_witness):
         self.nAsset = CTxOutAsset()
@@ -681,13 +943,14 @@ class CScriptWitness:
 
 class CTxInWitness:
     __slots__ = ("scriptWitness", "vchIssuanceAmountRangeproof",
-                 "vchInflationKeysRangeproof", "peginWitness")
+                 "vchInflationKeysRangeproof", "peginWitness", "_witness_root_cache")
 
     def __init__(self):
         self.vchIssuanceAmountRangeproof = b''
         self.vchInflationKeysRangeproof = b''
         self.scriptWitness = CScriptWitness()
         self.peginWitness = CScriptWitness()
+        self._witness_root_cache = None
 
     def deserialize(self, f):
         self.vchIssuanceAmountRangeproof = deser_string(f)
@@ -695,13 +958,22 @@ class CTxInWitness:
         self.scriptWitness.stack = deser_string_vector(f)
         self.peginWitness.stack = deser_string_vector(f)
 
+    def deserialize_mv(self, r):
+        self.vchIssuanceAmountRangeproof = r.read_string()
+        self.vchInflationKeysRangeproof = r.read_string()
+        self.scriptWitness.stack = r.read_string_vector()
+        self.peginWitness.stack = r.read_string_vector()
+
     def serialize(self):
-        r = b''
-        r += ser_string(self.vchIssuanceAmountRangeproof)
-        r += ser_string(self.vchInflationKeysRangeproof)
-        r += ser_string_vector(self.scriptWitness.stack)
-        r += ser_string_vector(self.peginWitness.stack)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        ser_string_into(buf, self.vchIssuanceAmountRangeproof)
+        ser_string_into(buf, self.vchInflationKeysRangeproof)
+        ser_string_vector_into(buf, self.scriptWitness.stack)
+        ser_string_vector_into(buf, self.peginWitness.stack)
 
     # Used in taproot sighash calculation
     def serialize_issuance_proofs(self):
@@ -710,14 +982,23 @@ class CTxInWitness:
         r += ser_string(self.vchInflationKeysRangeproof)
         return r
 
+    # The root is cached together with an immutable snapshot of the fields it
+    # was computed from, and only recomputed once one of them changes.
+    def calc_witness_root(self):
+        key = (bytes(self.vchIssuanceAmountRangeproof), bytes(self.vchInflationKeysRangeproof),
+               tuple(bytes(x) for x in self.scriptWitness.stack), tuple(bytes(x) for x in self.peginWitness.stack))
+        if self._witness_root_cache is None or self._witness_root_cache[0] != key:
+            leaves = [
+                hash256(ser_string(key[0])),
+                hash256(ser_string(key[1])),
+                hash256(ser_string_vector(key[2])),
+                hash256(ser_string_vector(key[3]))
+            ]
+            self._witness_root_cache = (key, compute_fast_merkle_root(leaves))
+        return self._witness_root_cache[1]
+
     def calc_witness_hash(self):
-        leaves = [
-            hash256(ser_string(self.vchIssuanceAmountRangeproof))[::-1].hex(),
-            hash256(ser_string(self.vchInflationKeysRangeproof))[::-1].hex(),
-            hash256(ser_string_vector(self.scriptWitness.stack))[::-1].hex(),
-            hash256(ser_string_vector(self.peginWitness.stack))[::-1].hex()
-        ]
-        return calcfastmerkleroot(leaves)
+        return self.calc_witness_root()[::-1].hex()
 
     def __repr__(self):
         return "CTxInWitness (%s, %s, %s %s)" % (self.vchIssuanceAmountRangeproof,
@@ -731,28 +1012,42 @@ class CTxInWitness:
 
 
 class CTxOutWitness:
-    __slots__ = ("vchSurjectionproof", "vchRangeproof")
+    __slots__ = ("vchSurjectionproof", "vchRangeproof", "_witness_root_cache")
 
     def __init__(self):
         self.vchSurjectionproof = b''
         self.vchRangeproof = b''
+        self._witness_root_cache = None
 
     def deserialize(self, f):
         self.vchSurjectionproof = deser_string(f)
         self.vchRangeproof = deser_string(f)
 
+    def deserialize_mv(self, r):
+        self.vchSurjectionproof = r.read_string()
+        self.vchRangeproof = r.read_string()
+
     def serialize(self):
-        r = b''
-        r += ser_string(self.vchSurjectionproof)
-        r += ser_string(self.vchRangeproof)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        ser_string_into(buf, self.vchSurjectionproof)
+        ser_string_into(buf, self.vchRangeproof)
+
+    def calc_witness_root(self):
+        key = (bytes(self.vchSurjectionproof), bytes(self.vchRangeproof))
+        if self._witness_root_cache is None or self._witness_root_cache[0] != key:
+            leaves = [
+                hash256(ser_string(key[0])),
+                hash256(ser_string(key[1]))
+            ]
+            self._witness_root_cache = (key, compute_fast_merkle_root(leaves))
+        return self._witness_root_cache[1]
 
     def calc_witness_hash(self):
-        leaves = [
-            hash256(ser_string(self.vchSurjectionproof))[::-1].hex(),
-            hash256(ser_string(self.vchRangeproof))[::-1].hex()
-        ]
-        return calcfastmerkleroot(leaves)
+        return self.calc_witness_root()[::-1].hex()
 
     def __repr__(self):
         return "CTxOutWitness (%s, %s)" % (self.vchSurjectionproof, self.vchRangeproof)
@@ -762,6 +1057,11 @@ class CTxOutWitness:
             and len(self.vchRangeproof) == 0
 
 
+# Witness roots of empty witnesses, used for inputs and outputs without one
+NULL_TXINWIT_ROOT = CTxInWitness().calc_witness_root()
+NULL_TXOUTWIT_ROOT = CTxOutWitness().calc_witness_root()
+
+
 class CTxWitness:
     __slots__ = ("vtxinwit", "vtxoutwit")
 
@@ -775,16 +1075,25 @@ class CTxWitness:
         for i in range(len(self.vtxoutwit)):
             self.vtxoutwit[i].deserialize(f)
 
+    def deserialize_mv(self, r):
+        for x in self.vtxinwit:
+            x.deserialize_mv(r)
+        for x in self.vtxoutwit:
+            x.deserialize_mv(r)
+
     def serialize(self):
-        r = b""
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
         # This is different than the usual vector serialization --
         # we omit the length of the vector, which is required to be
         # the same length as the transaction's vin vector.
         for x in self.vtxinwit:
-            r += x.serialize()
+            ser_into(buf, x)
         for x in self.vtxoutwit:
-            r += x.serialize()
-        return r
+            ser_into(buf, x)
 
     def __repr__(self):
         return "CTxWitness([%s], [%s])" % \
@@ -803,9 +1112,14 @@ class CTxWitness:
 
 class CTransaction:
     __slots__ = ("hash", "nLockTime", "nVersion", "sha256", "vin", "vout",
-                 "wit")
+                 "wit", "_cache", "_witness_trees")
 
     def __init__(self, tx=None):
+        # Trees for the input, output and top-level witness merkle roots
+        self._witness_trees = (FastMerkleTree(), FastMerkleTree(), FastMerkleTree())
+        # Serializations, ids and weight, only kept between mark_clean() and
+        # the next mark_dirty(), rehash() or deserialization
+        self._cache = None
         if tx is None:
             self.nVersion = 2
             self.vin = []
@@ -823,6 +1137,18 @@ class CTransaction:
             self.hash = tx.hash
             self.wit = copy.deepcopy(tx.wit)
 
+    def __deepcopy__(self, memo):
+        # Copies are made to be modified, so they start without a cache
+        cls = type(self)
+        dict_state, slot_state = self.__reduce_ex__(4)[2]
+        tx = cls.__new__(cls)
+        memo[id(self)] = tx
+        if dict_state:
+            tx.__dict__.update(copy.deepcopy(dict_state, memo))
+        for name, value in slot_state.items():
+            setattr(tx, name, None if name == "_cache" else copy.deepcopy(value, memo))
+        return tx
+
     def deserialize(self, f):
         self.nVersion = struct.unpack("<i", f.read(4))[0]
         flags = struct.unpack("<B", f.read(1))[0]
@@ -839,28 +1165,100 @@ class CTransaction:
             raise TypeError('Extra witness flags:' + str(flags))
         self.sha256 = None
         self.hash = None
+        if self._cache is not None:
+            self._cache.clear()
+
+    def deserialize_mv(self, r):
+        self.nVersion = r.read_i32()
+        flags = r.read_u8()
+        self.vin = r.read_vector(CTxIn)
+        self.vout = r.read_vector(CTxOut)
+        self.nLockTime = r.read_u32()
+        if flags & 1 > 0:
+            self.wit.vtxinwit = [CTxInWitness() for _ in range(len(self.vin))]
+            self.wit.vtxoutwit = [CTxOutWitness() for _ in range(len(self.vout))]
+            self.wit.deserialize_mv(r)
+        else:
+            self.wit = CTxWitness()
+        if flags > 1:
+            raise TypeError('Extra witness flags:' + str(flags))
+        self.sha256 = None
+        self.hash = None
+        if self._cache is not None:
+            self._cache.clear()
+
+    # The message objects are mutated in place all over the tests, so caching
+    # is only enabled on request, for transactions which are done being built.
+    def mark_clean(self):
+        """Cache serializations, txid, wtxid and weight until the transaction is modified.
+
+        Call mark_dirty() (or rehash()) after modifying a clean transaction."""
+        if self._cache is None:
+            self._cache = {}
+
+    def mark_dirty(self):
+        """Drop all cached values, and stop caching until mark_clean()."""
+        self._cache = None
+        self.sha256 = None
+        self.hash = None
+
+    def _cached(self, key, compute):
+        if self._cache is None:
+            return compute()
+        value = self._cache.get(key)
+        if value is None:
+            value = self._cache[key] = compute()
+        return value
 
     # Only applicable for non-CT, non-segwit transactions
     def serialize_without_witness(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("B", 0)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        return self._cached("ser", self._serialize_without_witness)
+
+    def _serialize_without_witness(self):
+        buf = bytearray()
+        self._serialize_without_witness_into(buf)
+        return bytes(buf)
+
+    def serialize_without_witness_into(self, buf):
+        if self._cache is not None:
+            buf += self.serialize_without_witness()
+        else:
+            self._serialize_without_witness_into(buf)
+
+    def _serialize_without_witness_into(self, buf):
+        buf += struct.pack("<i", self.nVersion)
+        buf += struct.pack("B", 0)
+        ser_vector_into(buf, self.vin)
+        ser_vector_into(buf, self.vout)
+        buf += struct.pack("<I", self.nLockTime)
 
     # Only serialize with witness when explicitly called for
     def serialize_with_witness(self):
+        return self._cached("ser_wit", self._serialize_with_witness)
+
+    def _serialize_with_witness(self):
+        buf = bytearray()
+        self._serialize_with_witness_into(buf)
+        return bytes(buf)
+
+    def serialize_with_witness_into(self, buf):
+        if self._cache is not None:
+            buf += self.serialize_with_witness()
+        else:
+            self._serialize_with_witness_into(buf)
+
+    # Returns the offset of the witness data in buf, which is where the
+    # equally long serialization without witness would end.
+    def _serialize_with_witness_into(self, buf):
         flags = 0
         if not self.wit.is_null():
             flags |= 1
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<B", flags)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
+        buf += struct.pack("<i", self.nVersion)
+        buf += struct.pack("<B", flags)
+        ser_vector_into(buf, self.vin)
+        ser_vector_into(buf, self.vout)
+        buf += struct.pack("<I", self.nLockTime)
+        witness_offset = len(buf)
         if flags & 1:
             if len(self.wit.vtxinwit) != len(self.vin):
                 # vtxinwit must have the same length as vin
@@ -872,8 +1270,8 @@ class CTransaction:
                 self.wit.vtxoutwit = self.wit.vtxoutwit[:len(self.vout)]
                 for i in range(len(self.wit.vtxoutwit), len(self.vout)):
                     self.wit.vtxoutwit.append(CTxOutWitness())
-            r += self.wit.serialize()
-        return r
+            ser_into(buf, self.wit)
+        return witness_offset
 
     def serialize(self, with_witness=True):
         if with_witness:
@@ -881,12 +1279,20 @@ class CTransaction:
         else:
             return self.serialize_without_witness()
 
+    def serialize_into(self, buf, with_witness=True):
+        if with_witness:
+            ser_into(buf, self, "serialize_with_witness")
+        else:
+            ser_into(buf, self, "serialize_without_witness")
+
     def getwtxid(self):
-        return hash256(self.serialize())[::-1].hex()
+        return self._cached("wtxid", lambda: hash256(self.serialize())[::-1].hex())
 
     # Recalculate the txid (transaction hash without witness)
     def rehash(self):
         self.sha256 = None
+        if self._cache is not None:
+            self._cache.clear()
         self.calc_sha256()
         return self.hash
 
@@ -897,28 +1303,35 @@ class CTransaction:
             # Don't cache the result, just return it
             return uint256_from_str(hash256(self.serialize_with_witness()))
 
+        txid = self._cached("txid", lambda: hash256(self.serialize_without_witness()))
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = hash256(self.serialize_without_witness())[::-1].hex()
+            self.sha256 = uint256_from_str(txid)
+        self.hash = txid[::-1].hex()
 
-    def calc_witness_hash(self):
+    # Per-witness roots are cached on the witness objects, and the merkle
+    # trees above them only rehash the paths of witnesses that changed.
+    def calc_witness_root(self):
         leaves = []
         for i in range(len(self.vin)):
             if i >= len(self.wit.vtxinwit) or self.vin[i].prevout.isNull():
-                wit = CTxInWitness()
+                leaves.append(NULL_TXINWIT_ROOT)
             else:
-                wit = self.wit.vtxinwit[i]
-            leaves.append(wit.calc_witness_hash())
-        inwitroot = calcfastmerkleroot(leaves)
+                leaves.append(self.wit.vtxinwit[i].calc_witness_root())
+        inwitroot = self._witness_trees[0].root(leaves)
 
         leaves = []
         for i in range(len(self.vout)):
-            wit = self.wit.vtxoutwit[i] if i < len(self.wit.vtxoutwit) else CTxOutWitness()
-            leaves.append(wit.calc_witness_hash())
-        outwitroot = calcfastmerkleroot(leaves)
+            if i < len(self.wit.vtxoutwit):
+                leaves.append(self.wit.vtxoutwit[i].calc_witness_root())
+            else:
+                leaves.append(NULL_TXOUTWIT_ROOT)
+        outwitroot = self._witness_trees[1].root(leaves)
+
+        return self._witness_trees[2].root([inwitroot, outwitroot])
 
+    def calc_witness_hash(self):
         # returns bitcoin hash print style string
-        return calcfastmerkleroot([inwitroot, outwitroot])
+        return self.calc_witness_root()[::-1].hex()
 
     def is_valid(self):
         self.calc_sha256()
@@ -930,8 +1343,20 @@ class CTransaction:
     # Calculate the transaction weight using witness and non-witness
     # serialization size (does NOT use sigops).
     def get_weight(self):
-        with_witness_size = len(self.serialize_with_witness())
-        without_witness_size = len(self.serialize_without_witness())
+        return self._cached("weight", self._get_weight)
+
+    def _get_weight(self):
+        cls = type(self)
+        if (cls.serialize_with_witness is not CTransaction.serialize_with_witness or
+                cls.serialize_without_witness is not CTransaction.serialize_without_witness):
+            with_witness_size = len(self.serialize_with_witness())
+            without_witness_size = len(self.serialize_without_witness())
+        else:
+            # Both serializations share everything up to the witness, so a
+            # single pass gives both sizes.
+            buf = bytearray()
+            without_witness_size = self._serialize_with_witness_into(buf)
+            with_witness_size = len(buf)
         return (WITNESS_SCALE_FACTOR - 1) * without_witness_size + with_witness_size
 
     def get_vsize(self):
@@ -958,11 +1383,18 @@ class CProof:
         self.challenge = deser_string(f)
         self.solution = deser_string(f)
 
+    def deserialize_mv(self, r):
+        self.challenge = r.read_string()
+        self.solution = r.read_string()
+
     def serialize(self):
-        r = b""
-        r += ser_string(self.challenge)
-        r += ser_string(self.solution)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        ser_string_into(buf, self.challenge)
+        ser_string_into(buf, self.solution)
 
     def serialize_for_hash(self):
         r = b""
@@ -1012,21 +1444,24 @@ class DynaFedParamEntry:
                 self.m_extension_space == []
 
     def serialize(self):
-        r = b""
-        r += struct.pack("B", self.m_serialize_type)
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += struct.pack("B", self.m_serialize_type)
         if self.m_serialize_type == 1:
-            r += ser_string(self.m_signblockscript)
-            r += struct.pack("<I", self.m_signblock_witness_limit)
-            r += ser_uint256(self.m_elided_root)
+            ser_string_into(buf, self.m_signblockscript)
+            buf += struct.pack("<I", self.m_signblock_witness_limit)
+            buf += ser_uint256(self.m_elided_root)
         elif self.m_serialize_type == 2:
-            r += ser_string(self.m_signblockscript)
-            r += struct.pack("<I", self.m_signblock_witness_limit)
-            r += ser_string(self.m_fedpeg_program)
-            r += ser_string(self.m_fedpegscript)
-            r += ser_string_vector(self.m_extension_space)
+            ser_string_into(buf, self.m_signblockscript)
+            buf += struct.pack("<I", self.m_signblock_witness_limit)
+            ser_string_into(buf, self.m_fedpeg_program)
+            ser_string_into(buf, self.m_fedpegscript)
+            ser_string_vector_into(buf, self.m_extension_space)
         elif self.m_serialize_type > 2:
             raise Exception("Invalid serialization type for DynaFedParamEntry")
-        return r
 
     def deserialize(self, f):
         self.m_serialize_type = struct.unpack("B", f.read(1))[0]
@@ -1041,6 +1476,19 @@ class DynaFedParamEntry:
             self.m_fedpegscript = deser_string(f)
             self.m_extension_space = deser_string_vector(f)
 
+    def deserialize_mv(self, r):
+        self.m_serialize_type = r.read_u8()
+        if self.m_serialize_type == 1:
+            self.m_signblockscript = r.read_string()
+            self.m_signblock_witness_limit = r.read_u32()
+            self.m_elided_root = r.read_uint256()
+        elif self.m_serialize_type == 2:
+            self.m_signblockscript = r.read_string()
+            self.m_signblock_witness_limit = r.read_u32()
+            self.m_fedpeg_program = r.read_string()
+            self.m_fedpegscript = r.read_string()
+            self.m_extension_space = r.read_string_vector()
+
     def __repr__(self):
         return "DynaFedParamEntry(m_signblockscript=%s m_fedpegscript=%s m_extension_space=%s)" \
                 % (self.m_signblockscript, self.m_fedpegscript, self.m_extension_space)
@@ -1060,15 +1508,22 @@ class DynaFedParams:
         return self.m_current.is_null() and self.m_proposed.is_null()
 
     def serialize(self):
-        r = b""
-        r += self.m_current.serialize()
-        r += self.m_proposed.serialize()
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        ser_into(buf, self.m_current)
+        ser_into(buf, self.m_proposed)
 
     def deserialize(self, f):
         self.m_current.deserialize(f)
         self.m_proposed.deserialize(f)
 
+    def deserialize_mv(self, r):
+        self.m_current.deserialize_mv(r)
+        self.m_proposed.deserialize_mv(r)
+
     def __repr__(self):
         return "DynaFedParams(m_current=%s m_proposed=%s)" \
                 % (self.m_current, self.m_proposed)
@@ -1129,25 +1584,49 @@ class CBlockHeader:
         self.sha256 = None
         self.hash = None
 
+    def deserialize_mv(self, r):
+        self.nVersion = r.read_i32()
+        is_dyna = False
+
+        if self.nVersion < 0:
+            is_dyna = True
+            self.nVersion = HEADER_DYNAFED_HF_MASK & self.nVersion
+
+        self.hashPrevBlock = r.read_uint256()
+        self.hashMerkleRoot = r.read_uint256()
+        self.nTime = r.read_u32()
+        self.block_height = r.read_u32()
+        if is_dyna:
+            self.m_dynafed_params.deserialize_mv(r)
+            self.m_signblock_witness.stack = r.read_string_vector()
+        else:
+            self.proof.deserialize_mv(r)
+        self.sha256 = None
+        self.hash = None
+
     def serialize(self):
-        r = b""
+        # Always header-only, also when called on a CBlock.
+        buf = bytearray()
+        CBlockHeader.serialize_into(self, buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
         nVersion = self.nVersion
         is_dyna = False
         if not self.m_dynafed_params.is_null():
             nVersion -= HEADER_HF_BIT
             is_dyna = True
 
-        r += struct.pack("<i", nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.block_height)
+        buf += struct.pack("<i", nVersion)
+        buf += ser_uint256(self.hashPrevBlock)
+        buf += ser_uint256(self.hashMerkleRoot)
+        buf += struct.pack("<I", self.nTime)
+        buf += struct.pack("<I", self.block_height)
         if is_dyna:
-            r += self.m_dynafed_params.serialize()
-            r += ser_string_vector(self.m_signblock_witness.stack)
+            ser_into(buf, self.m_dynafed_params)
+            ser_string_vector_into(buf, self.m_signblock_witness.stack)
         else:
-            r += self.proof.serialize()
-        return r
+            ser_into(buf, self.proof)
 
     def calc_sha256(self):
         if self.sha256 is None:
@@ -1184,24 +1663,32 @@ BLOCK_HEADER_SIZE = len(CBlockHeader().serialize())
 assert_equal(BLOCK_HEADER_SIZE, 79)
 
 class CBlock(CBlockHeader):
-    __slots__ = ("vtx",)
+    __slots__ = ("vtx", "_witness_tree")
 
     def __init__(self, header=None):
         super().__init__(header)
         self.vtx = []
+        self._witness_tree = FastMerkleTree()
 
     def deserialize(self, f):
         super().deserialize(f)
         self.vtx = deser_vector(f, CTransaction)
 
+    def deserialize_mv(self, r):
+        super().deserialize_mv(r)
+        self.vtx = r.read_vector(CTransaction)
+
     def serialize(self, with_witness=True):
-        r = b""
-        r += super().serialize()
+        buf = bytearray()
+        self.serialize_into(buf, with_witness)
+        return bytes(buf)
+
+    def serialize_into(self, buf, with_witness=True):
+        super().serialize_into(buf)
         if with_witness:
-            r += ser_vector(self.vtx, "serialize_with_witness")
+            ser_vector_into(buf, self.vtx, "serialize_with_witness")
         else:
-            r += ser_vector(self.vtx, "serialize_without_witness")
-        return r
+            ser_vector_into(buf, self.vtx, "serialize_without_witness")
 
     # Calculate the merkle root given a vector of transaction hashes
     @classmethod
@@ -1225,10 +1712,10 @@ class CBlock(CBlockHeader):
         hashes = []
         for tx in self.vtx:
             # Calculate the hashes with witness data
-            hashes.append(tx.calc_witness_hash())
+            hashes.append(tx.calc_witness_root())
 
         # returns bitcoin hash print order hex string
-        return calcfastmerkleroot(hashes)
+        return self._witness_tree.root(hashes)[::-1].hex()
 
     def is_valid(self):
         self.calc_sha256()
@@ -1276,13 +1763,16 @@ class PrefilledTransaction:
         self.tx.deserialize(f)
 
     def serialize(self, with_witness=True):
-        r = b""
-        r += ser_compact_size(self.index)
+        buf = bytearray()
+        self.serialize_into(buf, with_witness)
+        return bytes(buf)
+
+    def serialize_into(self, buf, with_witness=True):
+        buf += ser_compact_size(self.index)
         if with_witness:
-            r += self.tx.serialize_with_witness()
+            ser_into(buf, self.tx, "serialize_with_witness")
         else:
-            r += self.tx.serialize_without_witness()
-        return r
+            ser_into(buf, self.tx, "serialize_without_witness")
 
     def serialize_without_witness(self):
         return self.serialize(with_witness=False)
@@ -1290,6 +1780,12 @@ class PrefilledTransaction:
     def serialize_with_witness(self):
         return self.serialize(with_witness=True)
 
+    def serialize_without_witness_into(self, buf):
+        self.serialize_into(buf, with_witness=False)
+
+    def serialize_with_witness_into(self, buf):
+        self.serialize_into(buf, with_witness=True)
+
     def __repr__(self):
         return "PrefilledTransaction(index=%d, tx=%s)" % (self.index, repr(self.tx))
 
@@ -1320,18 +1816,21 @@ class P2PHeaderAndShortIDs:
 
     # When using version 2 compact blocks, we must serialize with_witness.
     def serialize(self, with_witness=False):
-        r = b""
-        r += self.header.serialize()
-        r += struct.pack("<Q", self.nonce)
-        r += ser_compact_size(self.shortids_length)
+        buf = bytearray()
+        P2PHeaderAndShortIDs.serialize_into(self, buf, with_witness)
+        return bytes(buf)
+
+    def serialize_into(self, buf, with_witness=False):
+        ser_into(buf, self.header)
+        buf += STRUCT_U64.pack(self.nonce)
+        buf += ser_compact_size(self.shortids_length)
         for x in self.shortids:
             # We only want the first 6 bytes
-            r += struct.pack("<Q", x)[0:6]
+            buf += STRUCT_U64.pack(x)[0:6]
         if with_witness:
-            r += ser_vector(self.prefilled_txn, "serialize_with_witness")
+            ser_vector_into(buf, self.prefilled_txn, "serialize_with_witness")
         else:
-            r += ser_vector(self.prefilled_txn, "serialize_without_witness")
-        return r
+            ser_vector_into(buf, self.prefilled_txn, "serialize_without_witness")
 
     def __repr__(self):
         return "P2PHeaderAndShortIDs(header=%s, nonce=%d, shortids_length=%d, shortids=%s, prefilled_txn_length=%d, prefilledtxn=%s" % (repr(self.header), self.nonce, self.shortids_length, repr(self.shortids), self.prefilled_txn_length, repr(self.prefilled_txn))
@@ -1344,6 +1843,9 @@ class P2PHeaderAndShortWitnessIDs(P2PHeaderAndShortIDs):
     def serialize(self):
         return super().serialize(with_witness=True)
 
+    def serialize_into(self, buf):
+        super().serialize_into(buf, with_witness=True)
+
 # Calculate the BIP 152-compact blocks shortid for a given transaction hash
 def calculate_shortid(k0, k1, tx_hash):
     expected_shortid = siphash256(k0, k1, tx_hash)
@@ -1432,12 +1934,15 @@ class BlockTransactionsRequest:
             self.indexes.append(deser_compact_size(f))
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.blockhash)
-        r += ser_compact_size(len(self.indexes))
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += ser_uint256(self.blockhash)
+        buf += ser_compact_size(len(self.indexes))
         for x in self.indexes:
-            r += ser_compact_size(x)
-        return r
+            buf += ser_compact_size(x)
 
     # helper to set the differentially encoded indexes from absolute ones
     def from_absolute(self, absolute_indexes):
@@ -1471,13 +1976,16 @@ class BlockTransactions:
         self.transactions = deser_vector(f, CTransaction)
 
     def serialize(self, with_witness=True):
-        r = b""
-        r += ser_uint256(self.blockhash)
+        buf = bytearray()
+        self.serialize_into(buf, with_witness)
+        return bytes(buf)
+
+    def serialize_into(self, buf, with_witness=True):
+        buf += ser_uint256(self.blockhash)
         if with_witness:
-            r += ser_vector(self.transactions, "serialize_with_witness")
+            ser_vector_into(buf, self.transactions, "serialize_with_witness")
         else:
-            r += ser_vector(self.transactions, "serialize_without_witness")
-        return r
+            ser_vector_into(buf, self.transactions, "serialize_without_witness")
 
     def __repr__(self):
         return "BlockTransactions(hash=%064x transactions=%s)" % (self.blockhash, repr(self.transactions))
@@ -1500,14 +2008,17 @@ class CPartialMerkleTree:
             self.vBits.append(vBytes[i//8] & (1 << (i % 8)) != 0)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nTransactions)
-        r += ser_uint256_vector(self.vHash)
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += STRUCT_I32.pack(self.nTransactions)
+        ser_uint256_vector_into(buf, self.vHash)
         vBytesArray = bytearray([0x00] * ((len(self.vBits) + 7)//8))
         for i in range(len(self.vBits)):
             vBytesArray[i // 8] |= self.vBits[i] << (i % 8)
-        r += ser_string(bytes(vBytesArray))
-        return r
+        ser_string_into(buf, vBytesArray)
 
     def __repr__(self):
         return "CPartialMerkleTree(nTransactions=%d, vHash=%s, vBits=%s)" % (self.nTransactions, repr(self.vHash), repr(self.vBits))
@@ -1525,10 +2036,13 @@ class CMerkleBlock:
         self.txn.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.header.serialize()
-        r += self.txn.serialize()
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        ser_into(buf, self.header)
+        ser_into(buf, self.txn)
 
     def __repr__(self):
         return "CMerkleBlock(header=%s, txn=%s)" % (repr(self.header), repr(self.txn))
@@ -1573,17 +2087,20 @@ class msg_version:
             self.relay = 0
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<Q", self.nServices)
-        r += struct.pack("<q", self.nTime)
-        r += self.addrTo.serialize(with_time=False)
-        r += self.addrFrom.serialize(with_time=False)
-        r += struct.pack("<Q", self.nNonce)
-        r += ser_string(self.strSubVer.encode('utf-8'))
-        r += struct.pack("<i", self.nStartingHeight)
-        r += struct.pack("<b", self.relay)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<i", self.nVersion)
+        buf += struct.pack("<Q", self.nServices)
+        buf += struct.pack("<q", self.nTime)
+        self.addrTo.serialize_into(buf, with_time=False)
+        self.addrFrom.serialize_into(buf, with_time=False)
+        buf += struct.pack("<Q", self.nNonce)
+        ser_string_into(buf, self.strSubVer.encode('utf-8'))
+        buf += struct.pack("<i", self.nStartingHeight)
+        buf += struct.pack("<b", self.relay)
 
     def __repr__(self):
         return 'msg_version(nVersion=%i nServices=%i nTime=%s addrTo=%s addrFrom=%s nNonce=0x%016X strSubVer=%s nStartingHeight=%i relay=%i)' \
@@ -1711,10 +2228,13 @@ class msg_getblocks:
         self.hashstop = deser_uint256(f)
 
     def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        ser_into(buf, self.locator)
+        buf += ser_uint256(self.hashstop)
 
     def __repr__(self):
         return "msg_getblocks(locator=%s hashstop=%064x)" \
@@ -1731,6 +2251,9 @@ class msg_tx:
     def deserialize(self, f):
         self.tx.deserialize(f)
 
+    def deserialize_mv(self, r):
+        self.tx.deserialize_mv(r)
+
     def serialize(self):
         return self.tx.serialize_with_witness()
 
@@ -1774,6 +2297,9 @@ class msg_block:
     def deserialize(self, f):
         self.block.deserialize(f)
 
+    def deserialize_mv(self, r):
+        self.block.deserialize_mv(r)
+
     def serialize(self):
         return self.block.serialize()
 
@@ -1831,9 +2357,12 @@ class msg_ping:
         self.nonce = struct.unpack("<Q", f.read(8))[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<Q", self.nonce)
 
     def __repr__(self):
         return "msg_ping(nonce=%08x)" % self.nonce
@@ -1850,9 +2379,12 @@ class msg_pong:
         self.nonce = struct.unpack("<Q", f.read(8))[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<Q", self.nonce)
 
     def __repr__(self):
         return "msg_pong(nonce=%08x)" % self.nonce
@@ -1927,10 +2459,13 @@ class msg_getheaders:
         self.hashstop = deser_uint256(f)
 
     def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        ser_into(buf, self.locator)
+        buf += ser_uint256(self.hashstop)
 
     def __repr__(self):
         return "msg_getheaders(locator=%s, stop=%064x)" \
@@ -1952,6 +2487,11 @@ class msg_headers:
         for x in blocks:
             self.headers.append(CBlockHeader(x))
 
+    def deserialize_mv(self, r):
+        blocks = r.read_vector(CBlock)
+        for x in blocks:
+            self.headers.append(CBlockHeader(x))
+
     def serialize(self):
         blocks = [CBlock(x) for x in self.headers]
         return ser_vector(blocks)
@@ -1997,12 +2537,15 @@ class msg_filterload:
         self.nFlags = struct.unpack("<B", f.read(1))[0]
 
     def serialize(self):
-        r = b""
-        r += ser_string(self.data)
-        r += struct.pack("<I", self.nHashFuncs)
-        r += struct.pack("<I", self.nTweak)
-        r += struct.pack("<B", self.nFlags)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        ser_string_into(buf, self.data)
+        buf += struct.pack("<I", self.nHashFuncs)
+        buf += struct.pack("<I", self.nTweak)
+        buf += struct.pack("<B", self.nFlags)
 
     def __repr__(self):
         return "msg_filterload(data={}, nHashFuncs={}, nTweak={}, nFlags={})".format(
@@ -2020,9 +2563,12 @@ class msg_filteradd:
         self.data = deser_string(f)
 
     def serialize(self):
-        r = b""
-        r += ser_string(self.data)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        ser_string_into(buf, self.data)
 
     def __repr__(self):
         return "msg_filteradd(data={})".format(self.data)
@@ -2056,9 +2602,12 @@ class msg_feefilter:
         self.feerate = struct.unpack("<Q", f.read(8))[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.feerate)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<Q", self.feerate)
 
     def __repr__(self):
         return "msg_feefilter(feerate=%08x)" % self.feerate
@@ -2077,10 +2626,13 @@ class msg_sendcmpct:
         self.version = struct.unpack("<Q", f.read(8))[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<?", self.announce)
-        r += struct.pack("<Q", self.version)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<?", self.announce)
+        buf += struct.pack("<Q", self.version)
 
     def __repr__(self):
         return "msg_sendcmpct(announce=%s, version=%lu)" % (self.announce, self.version)
@@ -2098,9 +2650,12 @@ class msg_cmpctblock:
         self.header_and_shortids.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.header_and_shortids.serialize()
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        ser_into(buf, self.header_and_shortids)
 
     def __repr__(self):
         return "msg_cmpctblock(HeaderAndShortIDs=%s)" % repr(self.header_and_shortids)
@@ -2118,9 +2673,12 @@ class msg_getblocktxn:
         self.block_txn_request.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.block_txn_request.serialize()
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        ser_into(buf, self.block_txn_request)
 
     def __repr__(self):
         return "msg_getblocktxn(block_txn_request=%s)" % (repr(self.block_txn_request))
@@ -2137,9 +2695,12 @@ class msg_blocktxn:
         self.block_transactions.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.block_transactions.serialize()
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        ser_into(buf, self.block_transactions)
 
     def __repr__(self):
         return "msg_blocktxn(block_transactions=%s)" % (repr(self.block_transactions))
@@ -2151,6 +2712,9 @@ class msg_no_witness_blocktxn(msg_blocktxn):
     def serialize(self):
         return self.block_transactions.serialize(with_witness=False)
 
+    def serialize_into(self, buf):
+        self.block_transactions.serialize_into(buf, with_witness=False)
+
 
 class msg_getcfilters:
     __slots__ = ("filter_type", "start_height", "stop_hash")
@@ -2167,11 +2731,14 @@ class msg_getcfilters:
         self.stop_hash = deser_uint256(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += struct.pack("<I", self.start_height)
-        r += ser_uint256(self.stop_hash)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<B", self.filter_type)
+        buf += struct.pack("<I", self.start_height)
+        buf += ser_uint256(self.stop_hash)
 
     def __repr__(self):
         return "msg_getcfilters(filter_type={:#x}, start_height={}, stop_hash={:x})".format(
@@ -2192,11 +2759,14 @@ class msg_cfilter:
         self.filter_data = deser_string(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.block_hash)
-        r += ser_string(self.filter_data)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<B", self.filter_type)
+        buf += ser_uint256(self.block_hash)
+        ser_string_into(buf, self.filter_data)
 
     def __repr__(self):
         return "msg_cfilter(filter_type={:#x}, block_hash={:x})".format(
@@ -2217,11 +2787,14 @@ class msg_getcfheaders:
         self.stop_hash = deser_uint256(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += struct.pack("<I", self.start_height)
-        r += ser_uint256(self.stop_hash)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<B", self.filter_type)
+        buf += struct.pack("<I", self.start_height)
+        buf += ser_uint256(self.stop_hash)
 
     def __repr__(self):
         return "msg_getcfheaders(filter_type={:#x}, start_height={}, stop_hash={:x})".format(
@@ -2244,12 +2817,15 @@ class msg_cfheaders:
         self.hashes = deser_uint256_vector(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.stop_hash)
-        r += ser_uint256(self.prev_header)
-        r += ser_uint256_vector(self.hashes)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<B", self.filter_type)
+        buf += ser_uint256(self.stop_hash)
+        buf += ser_uint256(self.prev_header)
+        ser_uint256_vector_into(buf, self.hashes)
 
     def __repr__(self):
         return "msg_cfheaders(filter_type={:#x}, stop_hash={:x})".format(
@@ -2268,10 +2844,13 @@ class msg_getcfcheckpt:
         self.stop_hash = deser_uint256(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.stop_hash)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<B", self.filter_type)
+        buf += ser_uint256(self.stop_hash)
 
     def __repr__(self):
         return "msg_getcfcheckpt(filter_type={:#x}, stop_hash={:x})".format(
@@ -2292,12 +2871,90 @@ class msg_cfcheckpt:
         self.headers = deser_uint256_vector(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<B", self.filter_type)
-        r += ser_uint256(self.stop_hash)
-        r += ser_uint256_vector(self.headers)
-        return r
+        buf = bytearray()
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def serialize_into(self, buf):
+        buf += struct.pack("<B", self.filter_type)
+        buf += ser_uint256(self.stop_hash)
+        ser_uint256_vector_into(buf, self.headers)
 
     def __repr__(self):
         return "msg_cfcheckpt(filter_type={:#x}, stop_hash={:x})".format(
             self.filter_type, self.stop_hash)
+
+
+class TestFrameworkMessages(unittest.TestCase):
+    def create_tx(self):
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(1, 0))]
+        tx.vout = [CTxOut(1000, b"\x51"), CTxOut(100)]
+        tx.wit.vtxinwit = [CTxInWitness()]
+        tx.wit.vtxinwit[0].scriptWitness.stack = [b"\x51"]
+        return tx
+
+    def check_ids(self, tx):
+        """Check the cached values of tx against a fresh copy."""
+        fresh = CTransaction()
+        fresh.deserialize(BytesIO(tx._serialize_with_witness()))
+        fresh.rehash()
+        self.assertEqual(tx.serialize(), fresh.serialize())
+        self.assertEqual(tx.serialize_without_witness(), fresh.serialize_without_witness())
+        self.assertEqual(tx.hash, fresh.hash)
+        self.assertEqual(tx.getwtxid(), fresh.getwtxid())
+        self.assertEqual(tx.get_weight(), fresh.get_weight())
+
+    def test_transaction_cache(self):
+        tx = self.create_tx()
+        tx.rehash()
+        self.check_ids(tx)
+        # Values are only cached once the transaction is marked clean
+        self.assertIsNot(tx.serialize(), tx.serialize())
+        tx.mark_clean()
+        self.assertIs(tx.serialize(), tx.serialize())
+        self.check_ids(tx)
+        # Blocks reuse the cached serializations of their clean transactions
+        block = CBlock()
+        block.vtx = [tx]
+        uncached = CBlock()
+        uncached.vtx = [copy.deepcopy(tx)]
+        self.assertEqual(block.serialize(), uncached.serialize())
+
+        # A mutation followed by rehash() gives fresh values, and keeps caching
+        txid, wtxid, weight = tx.hash, tx.getwtxid(), tx.get_weight()
+        tx.vout.append(CTxOut(0, b"\x6a"))
+        tx.rehash()
+        self.assertNotEqual(tx.hash, txid)
+        self.assertNotEqual(tx.getwtxid(), wtxid)
+        self.assertGreater(tx.get_weight(), weight)
+        self.check_ids(tx)
+        self.assertIs(tx.serialize(), tx.serialize())
+
+        # A mutation followed by mark_dirty() gives fresh values, and stops caching
+        wtxid = tx.getwtxid()
+        tx.wit.vtxinwit[0].scriptWitness.stack = [b"\x52"]
+        tx.mark_dirty()
+        self.assertNotEqual(tx.getwtxid(), wtxid)
+        tx.rehash()
+        self.check_ids(tx)
+        self.assertIsNot(tx.serialize(), tx.serialize())
+
+    def test_transaction_cache_copies(self):
+        tx = self.create_tx()
+        tx.mark_clean()
+        tx.rehash()
+        serialization = tx.serialize()
+        # Deserialization drops the cached values
+        tx.deserialize(BytesIO(self.create_tx().serialize_without_witness()))
+        self.assertNotEqual(tx.serialize(), serialization)
+        tx.rehash()
+        self.check_ids(tx)
+        # Copies do not share the cache of a clean transaction
+        tx_copy = copy.deepcopy(tx)
+        tx_copy.nLockTime = 1
+        tx_copy.rehash()
+        self.assertNotEqual(tx_copy.hash, tx.hash)
+        self.assertNotEqual(tx_copy.serialize(), tx.serialize())
+        self.check_ids(tx)
+        self.check_ids(tx_copy)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# Copyright (c) 2023 The Elements Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Pool of running nodes handed over between functional tests.
+
+With test_runner.py --reusenodes, tests setting reuse_nodes in
+set_test_params() do not stop their nodes when they pass. The nodes are reset
+to the height they were started at and left running in an entry of the pool
+directory, from which the next test with the same chain and node arguments
+leases them instead of starting new nodes. The datadirs of the nodes live in
+their entry, and the tests leasing them use the port seed they were started
+with.
+
+An entry is a directory holding the datadirs, a lock file while it is leased,
+and a description of the running nodes once it has been released.
+"""
+
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+POOL_INFO_FILENAME = "pool.json"
+LEASE_FILENAME = "lease"
+
+# Idle entries kept running at most; the least recently used ones are
+# stopped when tests with other arguments need new nodes
+MAX_IDLE_ENTRIES = 8
+
+# How long to wait for the nodes of an entry to shut down (seconds)
+STOP_TIMEOUT = 60
+
+
+def pid_exists(pid):
+    try:
+        # Reap the process if it is a child of this one
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            return False
+    except ChildProcessError:
+        pass
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class AttachedProcess():
+    """Stand-in for the Popen object of a node started by another test.
+
+    The process is not a child of this one, so it can only be polled for
+    existence, and its exit code is unknown (assumed to be 0)."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None and not pid_exists(self.pid):
+            self.returncode = 0
+        return self.returncode
+
+    def wait(self, timeout=None):
+        time_end = None if timeout is None else time.time() + timeout
+        while self.poll() is None:
+            if time_end is not None and time.time() > time_end:
+                raise TimeoutError("process {} still running after {}s".format(self.pid, timeout))
+            time.sleep(0.05)
+        return self.returncode
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+class NodeLease():
+    """An entry of the pool, leased by the current test."""
+
+    def __init__(self, path, info=None):
+        self.path = path
+        self.info = info
+
+    @property
+    def portseed(self):
+        return self.info['portseed']
+
+    @property
+    def nodes(self):
+        """The running nodes of the entry: their pid, stdout and stderr paths. Empty for a new entry."""
+        return self.info['nodes'] if self.info else []
+
+    def release(self, key, portseed, nodes):
+        """Hand the running nodes over to the next test leasing them."""
+        info = {'key': key, 'portseed': portseed, 'nodes': nodes, 'released': time.time()}
+        tmp_path = os.path.join(self.path, POOL_INFO_FILENAME + ".tmp")
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(info, f)
+        os.replace(tmp_path, os.path.join(self.path, POOL_INFO_FILENAME))
+        os.remove(os.path.join(self.path, LEASE_FILENAME))
+
+    def discard(self):
+        """Remove the entry, once its nodes are stopped."""
+        shutil.rmtree(self.path)
+
+
+class NodePool():
+    """Directory of running nodes shared by the tests of a test_runner.py run."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _entries(self):
+        """Yield the path and description of the released entries, leased or not."""
+        try:
+            names = sorted(os.listdir(self.path))
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.path, name)
+            try:
+                with open(os.path.join(path, POOL_INFO_FILENAME), encoding='utf8') as f:
+                    yield path, json.load(f)
+            except (OSError, ValueError):
+                continue
+
+    def _try_lease(self, path):
+        try:
+            os.close(os.open(os.path.join(path, LEASE_FILENAME), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except OSError:
+            return False
+
+    def _idle_entries(self):
+        return [(path, info) for path, info in self._entries() if not os.path.exists(os.path.join(path, LEASE_FILENAME))]
+
+    def lease(self, key):
+        """Lease an idle entry with the given key, or return None."""
+        for path, info in self._idle_entries():
+            if info['key'] == key and self._try_lease(path):
+                return NodeLease(path, info)
+        return None
+
+    def create(self):
+        """Create a leased entry for new nodes.
+
+        Idle entries beyond MAX_IDLE_ENTRIES are stopped, the least recently
+        used first."""
+        idle = sorted(self._idle_entries(), key=lambda entry: entry[1]['released'])
+        for path, info in idle[:max(0, len(idle) + 1 - MAX_IDLE_ENTRIES)]:
+            if self._try_lease(path):
+                self._stop(NodeLease(path, info))
+        os.makedirs(self.path, exist_ok=True)
+        path = tempfile.mkdtemp(dir=self.path)
+        leased = self._try_lease(path)
+        assert leased
+        return NodeLease(path)
+
+    def portseeds(self):
+        """Return the port seeds of the running nodes of the pool."""
+        return [info['portseed'] for _, info in self._entries()]
+
+    def _stop(self, lease):
+        pids = [node['pid'] for node in lease.nodes]
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        time_end = time.time() + STOP_TIMEOUT
+        while any(pid_exists(pid) for pid in pids) and time.time() < time_end:
+            time.sleep(0.05)
+        for pid in pids:
+            if pid_exists(pid):
+                AttachedProcess(pid).kill()
+        lease.discard()
+
+    def stop_all(self):
+        """Stop all the nodes of the pool and remove it."""
+        for path, info in self._entries():
+            self._stop(NodeLease(path, info))
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+@unittest.skipIf(os.name == 'nt', "the node pool is not supported on Windows")
+class TestFrameworkNodePool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pool = NodePool(os.path.join(self.tmpdir, "pool"))
+        self.procs = []
+
+    def tearDown(self):
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def start_node(self, lease):
+        """Start a dummy node process in the entry of the lease."""
+        proc = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+        self.procs.append(proc)
+        return {'pid': proc.pid, 'stdout': os.path.join(lease.path, "stdout"), 'stderr': os.path.join(lease.path, "stderr")}
+
+    def test_lease_release(self):
+        self.assertIsNone(self.pool.lease("key"))
+        lease = self.pool.create()
+        nodes = [self.start_node(lease), self.start_node(lease)]
+        # A new entry is leased, and has no running nodes yet
+        self.assertEqual(lease.nodes, [])
+        self.assertIsNone(self.pool.lease("key"))
+        self.assertEqual(self.pool.portseeds(), [])
+
+        lease.release("key", 42, nodes)
+        self.assertEqual(self.pool.portseeds(), [42])
+        self.assertIsNone(self.pool.lease("other"))
+        lease = self.pool.lease("key")
+        self.assertEqual(lease.nodes, nodes)
+        self.assertEqual(lease.portseed, 42)
+        # Leased entries are not leased twice, but keep their ports reserved
+        self.assertIsNone(self.pool.lease("key"))
+        self.assertEqual(self.pool.portseeds(), [42])
+        self.assertIsNone(AttachedProcess(nodes[0]['pid']).poll())
+
+        lease.release("key", 42, nodes)
+        self.pool.stop_all()
+        self.assertFalse(os.path.exists(self.pool.path))
+        for proc in self.procs:
+            self.assertIsNotNone(proc.poll())
+        self.assertEqual(AttachedProcess(nodes[0]['pid']).poll(), 0)
+
+    def test_recycle(self):
+        for i in range(MAX_IDLE_ENTRIES):
+            lease = self.pool.create()
+            lease.release("key{}".format(i), i, [self.start_node(lease)])
+        oldest = self.procs[0]
+        self.pool.create()
+        # The least recently used idle entry was stopped to make room
+        self.assertIsNotNone(oldest.poll())
+        self.assertEqual(sorted(self.pool.portseeds()), list(range(1, MAX_IDLE_ENTRIES)))
+        self.assertIsNone(self.pool.lease("key0"))
+        self.pool.stop_all()
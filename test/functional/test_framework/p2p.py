@@ -21,15 +21,16 @@ P2PTxInvStore: A p2p interface class that inherits from P2PDataStore, and keeps
               a count of how many times each txid has been announced."""
 
 import asyncio
-from collections import defaultdict
-from io import BytesIO
+from collections import Counter, defaultdict
 import logging
 import struct
 import sys
 import threading
+import unittest
 
 from test_framework.messages import (
     CBlockHeader,
+    from_bytes,
     MAX_HEADERS_RESULTS,
     msg_addr,
     msg_addrv2,
@@ -134,6 +135,9 @@ MAGIC_BYTES = {
     "elementsregtest": b"\x53\x19\xf2\x0e",
 }
 
+# P2P message header: magic bytes, msgtype (null padded), payload length, checksum
+MSG_HEADER = struct.Struct("<4s12sI4s")
+
 
 class P2PConnection(asyncio.Protocol):
     """A low-level connection object to a node's P2P interface.
@@ -164,7 +168,7 @@ class P2PConnection(asyncio.Protocol):
         self.dstport = dstport
         # The initial message to send after the connection was made:
         self.on_connection_send_msg = None
-        self.recvbuf = b""
+        self.recvbuf = bytearray()
         self.magic_bytes = MAGIC_BYTES[net]
 
     def peer_connect(self, dstaddr, dstport, *, net, timeout_factor):
@@ -196,6 +200,8 @@ class P2PConnection(asyncio.Protocol):
             self.send_message(self.on_connection_send_msg)
             self.on_connection_send_msg = None  # Never used again
         self.on_open()
+        with p2p_lock:
+            p2p_condition.notify_all()
 
     def connection_lost(self, exc):
         """asyncio callback when a connection is closed."""
@@ -204,8 +210,10 @@ class P2PConnection(asyncio.Protocol):
         else:
             logger.debug("Closed connection to: %s:%d" % (self.dstaddr, self.dstport))
         self._transport = None
-        self.recvbuf = b""
+        self.recvbuf = bytearray()
         self.on_close()
+        with p2p_lock:
+            p2p_condition.notify_all()
 
     # Socket read methods
 
@@ -220,36 +228,48 @@ class P2PConnection(asyncio.Protocol):
 
         This method reads data from the buffer in a loop. It deserializes,
         parses and verifies the P2P header, then passes the P2P payload to
-        the on_message callback for processing."""
+        the on_message callback for processing.
+
+        Complete messages are consumed by advancing an offset into the
+        buffer, and the consumed prefix is only dropped once no complete
+        message is left, so every received byte is copied a constant number
+        of times. Payloads are passed to the deserializers as memoryviews."""
+        buf = self.recvbuf
+        pos = 0
         try:
             while True:
-                if len(self.recvbuf) < 4:
+                if len(buf) - pos < 4:
                     return
-                if self.recvbuf[:4] != self.magic_bytes:
-                    raise ValueError("magic bytes mismatch: {} != {}".format(repr(self.magic_bytes), repr(self.recvbuf)))
-                if len(self.recvbuf) < 4 + 12 + 4 + 4:
+                if buf[pos:pos+4] != self.magic_bytes:
+                    raise ValueError("magic bytes mismatch: {} != {}".format(repr(self.magic_bytes), repr(bytes(buf[pos:]))))
+                if len(buf) - pos < MSG_HEADER.size:
                     return
-                msgtype = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                checksum = self.recvbuf[4+12+4:4+12+4+4]
-                if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
+                _, msgtype, msglen, checksum = MSG_HEADER.unpack_from(buf, pos)
+                msgtype = msgtype.split(b"\x00", 1)[0]
+                start = pos + MSG_HEADER.size
+                if len(buf) - start < msglen:
                     return
-                msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
-                th = sha256(msg)
-                h = sha256(th)
-                if checksum != h[:4]:
-                    raise ValueError("got bad checksum " + repr(self.recvbuf))
-                self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
-                if msgtype not in MESSAGEMAP:
-                    raise ValueError("Received unknown msgtype from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, msgtype, repr(msg)))
-                f = BytesIO(msg)
-                t = MESSAGEMAP[msgtype]()
-                t.deserialize(f)
+                # Both views are released before the buffer is resized, also
+                # when the message is rejected
+                with memoryview(buf) as view, view[start:start+msglen] as msg:
+                    th = sha256(msg)
+                    h = sha256(th)
+                    if checksum != h[:4]:
+                        raise ValueError("got bad checksum " + repr(bytes(buf[pos:])))
+                    pos = start + msglen
+                    if msgtype not in MESSAGEMAP:
+                        raise ValueError("Received unknown msgtype from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, msgtype, repr(bytes(msg))))
+                    t = from_bytes(MESSAGEMAP[msgtype](), msg)
                 self._log_message("receive", t)
                 self.on_message(t)
         except Exception as e:
-            logger.exception('Error reading message:', repr(e))
+            logger.exception('Error reading message: %r', e)
             raise
+        finally:
+            # Drop the consumed messages. Deleting a prefix of a bytearray
+            # does not move the remaining data on every call.
+            if pos:
+                del buf[:pos]
 
     def on_message(self, message):
         """Callback for processing a P2P payload. Must be overridden by derived class."""
@@ -284,15 +304,9 @@ class P2PConnection(asyncio.Protocol):
         """Build a serialized P2P message"""
         msgtype = message.msgtype
         data = message.serialize()
-        tmsg = self.magic_bytes
-        tmsg += msgtype
-        tmsg += b"\x00" * (12 - len(msgtype))
-        tmsg += struct.pack("<I", len(data))
         th = sha256(data)
         h = sha256(th)
-        tmsg += h[:4]
-        tmsg += data
-        return tmsg
+        return MSG_HEADER.pack(self.magic_bytes, msgtype, len(data), h[:4]) + data
 
     def _log_message(self, direction, msg):
         """Logs a message being sent or received over the connection."""
@@ -381,6 +395,9 @@ class P2PInterface(P2PConnection):
             except:
                 print("ERROR delivering %s (%s)" % (repr(message), sys.exc_info()[0]))
                 raise
+            finally:
+                # Wake up the wait_until() callers to re-check their predicates
+                p2p_condition.notify_all()
 
     # Callback methods. Can be overridden by subclasses in individual test
     # cases to provide custom message handling behaviour.
@@ -451,15 +468,15 @@ class P2PInterface(P2PConnection):
                 assert self.is_connected
             return test_function_in()
 
-        wait_until_helper(test_function, timeout=timeout, lock=p2p_lock, timeout_factor=self.timeout_factor)
+        wait_until_helper(test_function, timeout=timeout, condition=p2p_condition, timeout_factor=self.timeout_factor)
 
     def wait_for_connect(self, timeout=60):
         test_function = lambda: self.is_connected
-        wait_until_helper(test_function, timeout=timeout, lock=p2p_lock)
+        wait_until_helper(test_function, timeout=timeout, condition=p2p_condition)
 
     def wait_for_disconnect(self, timeout=60):
         test_function = lambda: not self.is_connected
-        self.wait_until(test_function, timeout=timeout, check_connected=False)
+        wait_until_helper(test_function, timeout=timeout, condition=p2p_condition, timeout_factor=self.timeout_factor)
 
     # Message receiving helper methods
 
@@ -568,6 +585,10 @@ class P2PInterface(P2PConnection):
 # This lock should be acquired in the thread running the test logic to synchronize
 # access to any data shared with the P2PInterface or P2PConnection.
 p2p_lock = threading.Lock()
+# Notified (with p2p_lock held) whenever a P2PInterface received a message or a
+# connection was opened or closed, so that waiting for a message does not have
+# to poll.
+p2p_condition = threading.Condition(p2p_lock)
 
 
 class NetworkThread(threading.Thread):
@@ -651,12 +672,18 @@ class P2PDataStore(P2PInterface):
         self.last_block_hash = ''
         # store of txs. key is txid, value is a CTransaction object
         self.tx_store = {}
-        self.getdata_requests = []
+        # number of getdata requests received, by hash
+        self.getdata_requests = Counter()
+        # index of the chain ending at last_block_hash, made of the blocks
+        # in block_store: the block hashes from the oldest, and their
+        # positions in that list
+        self._chain = []
+        self._chain_pos = {}
 
     def on_getdata(self, message):
         """Check for the tx/block in our stores and if found, reply with an inv message."""
         for inv in message.inv:
-            self.getdata_requests.append(inv.hash)
+            self.getdata_requests[inv.hash] += 1
             if (inv.type & MSG_TYPE_MASK) == MSG_TX and inv.hash in self.tx_store.keys():
                 self.send_message(msg_tx(self.tx_store[inv.hash]))
             elif (inv.type & MSG_TYPE_MASK) == MSG_BLOCK and inv.hash in self.block_store.keys():
@@ -664,8 +691,33 @@ class P2PDataStore(P2PInterface):
             else:
                 logger.debug('getdata message type {} received.'.format(hex(inv.type)))
 
+    def _update_chain(self):
+        """Update the chain index to end at last_block_hash.
+
+        Only the blocks which are not in the index yet are walked through,
+        so extending the chain (or a reorg) costs as many steps as blocks
+        added (or replaced)."""
+        new_hashes = []
+        block_hash = self.last_block_hash
+        while block_hash in self.block_store:
+            pos = self._chain_pos.get(block_hash)
+            if pos is not None and self._chain[pos] == block_hash:
+                break
+            new_hashes.append(block_hash)
+            block_hash = self.block_store[block_hash].hashPrevBlock
+        else:
+            logger.debug('block hash {} not found in block store'.format(hex(block_hash)))
+            pos = -1
+        # Drop the blocks after the fork point, and append the new ones
+        for stale_hash in self._chain[pos + 1:]:
+            del self._chain_pos[stale_hash]
+        del self._chain[pos + 1:]
+        for block_hash in reversed(new_hashes):
+            self._chain_pos[block_hash] = len(self._chain)
+            self._chain.append(block_hash)
+
     def on_getheaders(self, message):
-        """Search back through our block store for the locator, and reply with a headers message if found."""
+        """Look up the locator in our block store, and reply with a headers message if found."""
 
         locator, hash_stop = message.locator, message.hashstop
 
@@ -673,23 +725,20 @@ class P2PDataStore(P2PInterface):
         if not self.block_store:
             return
 
-        headers_list = [self.block_store[self.last_block_hash]]
-        while headers_list[-1].sha256 not in locator.vHave:
-            # Walk back through the block store, adding headers to headers_list
-            # as we go.
-            prev_block_hash = headers_list[-1].hashPrevBlock
-            if prev_block_hash in self.block_store:
-                prev_block_header = CBlockHeader(self.block_store[prev_block_hash])
-                headers_list.append(prev_block_header)
-                if prev_block_header.sha256 == hash_stop:
-                    # if this is the hashstop header, stop here
-                    break
-            else:
-                logger.debug('block hash {} not found in block store'.format(hex(prev_block_hash)))
-                break
+        if not self._chain or self._chain[-1] != self.last_block_hash:
+            self._update_chain()
+
+        # Start from the most recent block in the locator, or the hashstop
+        # block (if it is not the tip itself), or else the oldest block known
+        start = max((self._chain_pos[h] for h in locator.vHave if h in self._chain_pos), default=0)
+        stop_pos = self._chain_pos.get(hash_stop)
+        if stop_pos is not None and stop_pos < len(self._chain) - 1:
+            start = max(start, stop_pos)
 
-        # Truncate the list if there are too many headers
-        headers_list = headers_list[:-MAX_HEADERS_RESULTS - 1:-1]
+        # Truncate the list if there are too many headers. The headers are
+        # taken from the blocks currently in the store, which tests may
+        # replace or modify.
+        headers_list = [CBlockHeader(self.block_store[h]) for h in self._chain[start:start + MAX_HEADERS_RESULTS]]
         response = msg_headers(headers_list)
 
         if response is not None:
@@ -794,3 +843,89 @@ class P2PTxInvStore(P2PInterface):
         self.wait_until(lambda: set(self.tx_invs_received.keys()) == set([int(tx, 16) for tx in txns]), timeout=timeout)
         # Flush messages and wait for the getdatas to be processed
         self.sync_with_ping()
+
+
+class TestFrameworkP2P(unittest.TestCase):
+    class RawMessage:
+        """A message with an arbitrary msgtype and payload."""
+        def __init__(self, msgtype, data):
+            self.msgtype = msgtype
+            self.data = data
+
+        def serialize(self):
+            return self.data
+
+    class Receiver(P2PConnection):
+        def __init__(self):
+            super().__init__()
+            self.peer_connect_helper("127.0.0.1", 0, "elementsregtest", 1)
+            self.received = []
+
+        def on_message(self, message):
+            self.received.append(message)
+
+    def check_receive_error(self, message, exc_type):
+        conn = self.Receiver()
+        data = conn.build_message(msg_ping(1)) + conn.build_message(message)
+        conn.recvbuf += data
+        with self.assertLogs(logger, 'ERROR'), self.assertRaises(exc_type):
+            conn._on_data()
+        # The messages up to the bad one are consumed, and the ones before it delivered
+        self.assertEqual([m.nonce for m in conn.received], [1])
+        self.assertEqual(conn.recvbuf, b"")
+
+    def test_on_data(self):
+        conn = self.Receiver()
+        data = conn.build_message(msg_ping(1)) + conn.build_message(msg_ping(2))
+        # Incomplete messages are kept in the buffer until they are complete
+        conn.recvbuf += data[:-1]
+        conn._on_data()
+        self.assertEqual([m.nonce for m in conn.received], [1])
+        conn.recvbuf += data[-1:]
+        conn._on_data()
+        self.assertEqual([m.nonce for m in conn.received], [1, 2])
+        self.assertEqual(conn.recvbuf, b"")
+
+    def test_wait_for_disconnect(self):
+        conn = P2PInterface()
+        conn.peer_connect_helper("127.0.0.1", 0, "elementsregtest", 1)
+        conn._transport = object()
+        # Closing the connection from the network thread wakes the waiter
+        closer = threading.Timer(0.1, conn.connection_lost, (None,))
+        closer.start()
+        conn.wait_for_disconnect(timeout=10)
+        closer.join()
+        self.assertFalse(conn.is_connected)
+
+    def test_getheaders(self):
+        import copy
+        from .blocktools import create_block, create_coinbase
+        from .messages import CProof
+        store = P2PDataStore()
+        sent = []
+        store.send_message = sent.append
+        blocks = []
+        for height in range(1, 4):
+            blocks.append(create_block(blocks[-1].sha256 if blocks else 1, create_coinbase(height), 1000 + height))
+        for block in blocks:
+            store.block_store[block.sha256] = block
+            store.last_block_hash = block.sha256
+        getheaders = msg_getheaders()
+        getheaders.locator.vHave = [blocks[0].sha256]
+        store.on_getheaders(getheaders)
+        # The headers from the last block of the locator to the tip
+        self.assertEqual([h.sha256 for h in sent[-1].headers], [b.sha256 for b in blocks])
+
+        # A block replaced under the same hash (the block hash does not cover
+        # the signblock solution) is served as it is now
+        replacement = copy.deepcopy(blocks[1])
+        replacement.proof = CProof(bytearray.fromhex('51'), b"\x01")
+        replacement.rehash()
+        self.assertEqual(replacement.sha256, blocks[1].sha256)
+        store.block_store[replacement.sha256] = replacement
+        store.on_getheaders(getheaders)
+        self.assertEqual(sent[-1].headers[1].proof.solution, b"\x01")
+
+    def test_on_data_errors(self):
+        self.check_receive_error(self.RawMessage(b"bogus", b""), ValueError)
+        self.check_receive_error(self.RawMessage(b"ping", b"\x01"), struct.error)
@@ -15,15 +15,17 @@ from typing import List, Dict
 from .key import TaggedHash, tweak_add_pubkey
 
 from .messages import (
+    COutPoint,
     CTransaction,
+    CTxIn,
     CTxOut,
     CTxOutAsset,
+    CTxOutWitness,
     CTxOutValue,
     hash256,
     ser_compact_size,
     ser_string,
     ser_uint256,
-    ser_vector,
     sha256,
     uint256_from_str,
 )
@@ -722,75 +724,74 @@ def LegacySignatureMsg(script, txTo, inIdx, hashtype, enable_sighash_rangeproof=
 
     Returns either (None, err) to indicate error (which translates to sighash 1),
     or (msg, None).
+
+    The preimage is written directly from txTo; the transaction is not copied.
     """
 
     if inIdx >= len(txTo.vin):
         return (None, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
-    txtmp = CTransaction(txTo)
-
-    for txin in txtmp.vin:
-        txin.scriptSig = b''
-    txtmp.vin[inIdx].scriptSig = FindAndDelete(script, CScript([OP_CODESEPARATOR]))
 
+    outputs = txTo.vout
+    # Other inputs' sequence numbers are not committed to with NONE and SINGLE.
+    zero_sequences = False
     if (hashtype & 0x1f) == SIGHASH_NONE:
-        txtmp.vout = []
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
+        outputs = []
+        zero_sequences = True
 
     elif (hashtype & 0x1f) == SIGHASH_SINGLE:
         outIdx = inIdx
-        if outIdx >= len(txtmp.vout):
-            return (None, "outIdx %d out of range (%d)" % (outIdx, len(txtmp.vout)))
-
-        tmp = txtmp.vout[outIdx]
-        txtmp.vout = []
-        for _ in range(outIdx):
-            txtmp.vout.append(CTxOut(nValue=CTxOutValue(), nAsset=CTxOutAsset()))
-        txtmp.vout.append(tmp)
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
+        if outIdx >= len(txTo.vout):
+            return (None, "outIdx %d out of range (%d)" % (outIdx, len(txTo.vout)))
+        # Outputs before outIdx are replaced by null outputs.
+        outputs = [None] * outIdx + [txTo.vout[outIdx]]
+        zero_sequences = True
 
     if hashtype & SIGHASH_ANYONECANPAY:
-        tmp = txtmp.vin[inIdx]
-        txtmp.vin = []
-        txtmp.vin.append(tmp)
+        inputs = [inIdx]
+    else:
+        inputs = range(len(txTo.vin))
 
     # sighash serialization is different from non-witness serialization
     # do manual sighash serialization:
-    s = b""
-    s += struct.pack("<i", txtmp.nVersion)
+    s = bytearray()
+    s += struct.pack("<i", txTo.nVersion)
     # ELEMENTS: vin serialization is different from non-witness serialization (pegin/issuance
     #  flags are not set in the sighash)
-    s += ser_compact_size(len(txtmp.vin))
-    for i in range(len(txtmp.vin)):
-        s += txtmp.vin[i].prevout.serialize()
-        s += ser_string(txtmp.vin[i].scriptSig)
-        s += struct.pack("<I", txtmp.vin[i].nSequence)
-        if not txtmp.vin[i].assetIssuance.isNull():
-            s += txtmp.vin[i].assetIssuance.serialize()
-
-    # If SIGHASH_RANGEPROOF is set, we need to add the rangeproof serialization after each output
-    if enable_sighash_rangeproof and hashtype & SIGHASH_RANGEPROOF:
-        s += ser_compact_size(len(txtmp.vout))
-        for i in range(len(txtmp.vout)):
-            s += txtmp.vout[i].serialize()
-            if i < len(txtmp.wit.vtxoutwit):
-                s += ser_string(txtmp.wit.vtxoutwit[i].vchRangeproof)
-                s += ser_string(txtmp.wit.vtxoutwit[i].vchSurjectionproof)
+    s += ser_compact_size(len(inputs))
+    for i in inputs:
+        txin = txTo.vin[i]
+        s += txin.prevout.serialize()
+        if i == inIdx:
+            s += ser_string(FindAndDelete(script, CScript([OP_CODESEPARATOR])))
+            s += struct.pack("<I", txin.nSequence)
+        else:
+            s += b'\x00'
+            s += struct.pack("<I", 0 if zero_sequences else txin.nSequence)
+        if not txin.assetIssuance.isNull():
+            s += txin.assetIssuance.serialize()
+
+    null_output = None
+    s += ser_compact_size(len(outputs))
+    for i, txout in enumerate(outputs):
+        if txout is None:
+            if null_output is None:
+                null_output = CTxOut(nValue=CTxOutValue(), nAsset=CTxOutAsset()).serialize()
+            s += null_output
+        else:
+            s += txout.serialize()
+        # If SIGHASH_RANGEPROOF is set, we need to add the rangeproof serialization after each output
+        if enable_sighash_rangeproof and hashtype & SIGHASH_RANGEPROOF:
+            if i < len(txTo.wit.vtxoutwit):
+                s += ser_string(txTo.wit.vtxoutwit[i].vchRangeproof)
+                s += ser_string(txTo.wit.vtxoutwit[i].vchSurjectionproof)
             else:
                 s += bytes([0, 0])
-    else:
-        s += ser_vector(txtmp.vout)
-    s += struct.pack("<I", txtmp.nLockTime)
+    s += struct.pack("<I", txTo.nLockTime)
 
     # add sighash type
     s += struct.pack(b"<I", hashtype)
 
-    return (s, None)
+    return (bytes(s), None)
 
 def LegacySignatureHash(*args, **kwargs):
     """Consensus-correct SignatureHash
@@ -806,11 +807,86 @@ def LegacySignatureHash(*args, **kwargs):
     else:
         return (hash256(msg), err)
 
-# TODO: Allow cached hashPrevouts/hashSequence/hashOutputs to be provided.
-# Performance optimization probably not necessary for python tests, however.
+class PrecomputedTransactionData:
+    """Transaction-wide hashes used by the segwit v0 and taproot signature messages.
+
+    Like PrecomputedTransactionData in src/script/interpreter.h, this is meant
+    to be created once per transaction and passed (as txdata) to the signature
+    hash functions for each of its inputs, so that signing all inputs takes
+    linear rather than quadratic time. Each hash is computed on first use. The
+    object must not be reused once the transaction or spent_utxos change.
+    """
+
+    def __init__(self, txTo, spent_utxos=None):
+        self.txTo = txTo
+        self.spent_utxos = spent_utxos
+        self.hashes = {}
+
+    def _get(self, name, compute):
+        value = self.hashes.get(name)
+        if value is None:
+            value = self.hashes[name] = compute()
+        return value
+
+    # BIP143 (segwit v0) hashes, as serialized 32-byte double-SHA256 digests.
+
+    def hash_prevouts(self):
+        return self._get("hashPrevouts", lambda: hash256(b"".join(i.prevout.serialize() for i in self.txTo.vin)))
+
+    def hash_sequence(self):
+        return self._get("hashSequence", lambda: hash256(b"".join(struct.pack("<I", i.nSequence) for i in self.txTo.vin)))
+
+    def hash_issuance(self):
+        # TODO actually serialize issuances
+        return self._get("hashIssuance", lambda: hash256(b"".join(
+            b'\x00' if i.assetIssuance.isNull() else i.assetIssuance.serialize() for i in self.txTo.vin)))
+
+    def hash_outputs(self):
+        return self._get("hashOutputs", lambda: hash256(b"".join(o.serialize() for o in self.txTo.vout)))
+
+    def hash_rangeproofs(self):
+        return self._get("hashRangeproofs", lambda: hash256(b"".join(
+            ser_string(wit.vchRangeproof) + ser_string(wit.vchSurjectionproof) for wit in self.txTo.wit.vtxoutwit)))
+
+    # BIP341 (taproot) hashes, as single SHA256 digests.
+
+    def sha_outpoint_flags(self):
+        return self._get("sha_outpoint_flags", lambda: sha256(b"".join(
+            struct.pack("B", ((not i.assetIssuance.isNull()) << 7) + (i.m_is_pegin << 6)) for i in self.txTo.vin)))
+
+    def sha_prevouts(self):
+        return self._get("sha_prevouts", lambda: BIP341_sha_prevouts(self.txTo))
+
+    def sha_amounts(self):
+        return self._get("sha_amounts", lambda: BIP341_sha_amounts(self.spent_utxos))
+
+    def sha_scriptpubkeys(self):
+        return self._get("sha_scriptpubkeys", lambda: BIP341_sha_scriptpubkeys(self.spent_utxos))
+
+    def sha_sequences(self):
+        return self._get("sha_sequences", lambda: BIP341_sha_sequences(self.txTo))
+
+    def sha_issuances(self):
+        return self._get("sha_issuances", lambda: sha256(b"".join(
+            i.assetIssuance.taphash_asset_issuance_serialize() for i in self.txTo.vin)))
+
+    def sha_issuance_rangeproofs(self):
+        return self._get("sha_issuance_rangeproofs", lambda: sha256(b"".join(
+            iwit.serialize_issuance_proofs() for iwit in self.txTo.wit.vtxinwit)))
+
+    def sha_outputs(self):
+        return self._get("sha_outputs", lambda: BIP341_sha_outputs(self.txTo))
+
+    def sha_output_witnesses(self):
+        return self._get("sha_output_witnesses", lambda: sha256(b"".join(
+            owit.serialize() for owit in self.txTo.wit.vtxoutwit)))
+
 # Note that this corresponds to sigversion == 1 in EvalScript, which is used
 # for version 0 witnesses.
-def SegwitV0SignatureMsg(script, txTo, inIdx, hashtype, amount, enable_sighash_rangeproof=True):
+def SegwitV0SignatureMsg(script, txTo, inIdx, hashtype, amount, enable_sighash_rangeproof=True, txdata=None):
+    if txdata is None:
+        txdata = PrecomputedTransactionData(txTo)
+    assert txdata.txTo is txTo
 
     hashPrevouts = 0
     hashSequence = 0
@@ -819,38 +895,19 @@ def SegwitV0SignatureMsg(script, txTo, inIdx, hashtype, amount, enable_sighash_r
     hashRangeproofs = 0
 
     if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_prevouts = bytes()
-        for i in txTo.vin:
-            serialize_prevouts += i.prevout.serialize()
-        hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
+        hashPrevouts = uint256_from_str(txdata.hash_prevouts())
 
     if (not (hashtype & SIGHASH_ANYONECANPAY) and (hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_sequence = bytes()
-        for i in txTo.vin:
-            serialize_sequence += struct.pack("<I", i.nSequence)
-        hashSequence = uint256_from_str(hash256(serialize_sequence))
+        hashSequence = uint256_from_str(txdata.hash_sequence())
 
     if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_issuance = bytes()
-        # TODO actually serialize issuances
-        for inp in txTo.vin:
-            if inp.assetIssuance.isNull():
-                serialize_issuance += b'\x00'
-            else:
-                serialize_issuance += inp.assetIssuance.serialize()
-        hashIssuance = uint256_from_str(hash256(serialize_issuance))
+        hashIssuance = uint256_from_str(txdata.hash_issuance())
 
     if ((hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_outputs = bytes()
-        for o in txTo.vout:
-            serialize_outputs += o.serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
+        hashOutputs = uint256_from_str(txdata.hash_outputs())
 
         if enable_sighash_rangeproof and hashtype & SIGHASH_RANGEPROOF:
-            serialize_rangeproofs = bytes()
-            for wit in txTo.wit.vtxoutwit:
-                serialize_rangeproofs += ser_string(wit.vchRangeproof) + ser_string(wit.vchSurjectionproof)
-            hashRangeproofs = uint256_from_str(hash256(serialize_rangeproofs))
+            hashRangeproofs = uint256_from_str(txdata.hash_rangeproofs())
 
     elif ((hashtype & 0x1f) == SIGHASH_SINGLE and inIdx < len(txTo.vout)):
         serialize_outputs = txTo.vout[inIdx].serialize()
@@ -912,6 +969,24 @@ class TestFrameworkScript(unittest.TestCase):
         for value in values:
             self.assertEqual(CScriptNum.decode(CScriptNum.encode(CScriptNum(value))), value)
 
+    def test_precomputed_txdata(self):
+        # Sharing one PrecomputedTransactionData between inputs must not change any sighash
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(i + 1, i), nSequence=i) for i in range(3)]
+        tx.vout = [CTxOut(i + 1, CScript([OP_TRUE])) for i in range(2)]
+        tx.wit.vtxoutwit = [CTxOutWitness() for _ in range(2)]
+        utxos = [CTxOut(i + 1, CScript([OP_1, bytes(32)])) for i in range(3)]
+        txdata = PrecomputedTransactionData(tx, utxos)
+        for idx in range(3):
+            for hashtype in (SIGHASH_ALL, SIGHASH_NONE, SIGHASH_SINGLE, SIGHASH_ALL | SIGHASH_ANYONECANPAY):
+                self.assertEqual(SegwitV0SignatureHash(CScript([OP_TRUE]), tx, idx, hashtype, CTxOutValue(1), txdata=txdata),
+                                 SegwitV0SignatureHash(CScript([OP_TRUE]), tx, idx, hashtype, CTxOutValue(1)))
+                self.assertEqual(TaprootSignatureHash(tx, utxos, hashtype, 0, idx, txdata=txdata),
+                                 TaprootSignatureHash(tx, utxos, hashtype, 0, idx))
+        # Taproot signature messages need the spent outputs in txdata
+        with self.assertRaisesRegex(AssertionError, "spent_utxos"):
+            TaprootSignatureHash(tx, utxos, SIGHASH_ALL, 0, 0, txdata=PrecomputedTransactionData(tx))
+
 def BIP341_sha_prevouts(txTo):
     return sha256(b"".join(i.prevout.serialize() for i in txTo.vin))
 
@@ -927,9 +1002,13 @@ def BIP341_sha_sequences(txTo):
 def BIP341_sha_outputs(txTo):
     return sha256(b"".join(o.serialize() for o in txTo.vout))
 
-def TaprootSignatureMsg(txTo, spent_utxos, hash_type, genesis_hash, input_index = 0, scriptpath = False, script = CScript(), codeseparator_pos = -1, annex = None, leaf_ver = LEAF_VERSION_TAPSCRIPT):
+def TaprootSignatureMsg(txTo, spent_utxos, hash_type, genesis_hash, input_index = 0, scriptpath = False, script = CScript(), codeseparator_pos = -1, annex = None, leaf_ver = LEAF_VERSION_TAPSCRIPT, txdata = None):
     assert (len(txTo.vin) == len(spent_utxos))
     assert (input_index < len(txTo.vin))
+    if txdata is None:
+        txdata = PrecomputedTransactionData(txTo, spent_utxos)
+    assert txdata.txTo is txTo
+    assert txdata.spent_utxos is not None, "txdata for taproot signature messages needs the spent_utxos"
     out_type = SIGHASH_ALL if hash_type == 0 else hash_type & 3
     in_type = hash_type & SIGHASH_ANYONECANPAY
     spk = spent_utxos[input_index].scriptPubKey
@@ -940,16 +1019,16 @@ def TaprootSignatureMsg(txTo, spent_utxos, hash_type, genesis_hash, input_index
     ss += struct.pack("<i", txTo.nVersion)
     ss += struct.pack("<I", txTo.nLockTime)
     if in_type != SIGHASH_ANYONECANPAY:
-        ss += sha256(b"".join(struct.pack("B", ((not i.assetIssuance.isNull()) << 7) + (i.m_is_pegin << 6)) for i in txTo.vin))
-        ss += BIP341_sha_prevouts(txTo)
-        ss += BIP341_sha_amounts(spent_utxos)
-        ss += BIP341_sha_scriptpubkeys(spent_utxos)
-        ss += BIP341_sha_sequences(txTo)
-        ss += sha256(b"".join(i.assetIssuance.taphash_asset_issuance_serialize() for i in txTo.vin))
-        ss += sha256(b"".join(iwit.serialize_issuance_proofs() for iwit in txTo.wit.vtxinwit))
+        ss += txdata.sha_outpoint_flags()
+        ss += txdata.sha_prevouts()
+        ss += txdata.sha_amounts()
+        ss += txdata.sha_scriptpubkeys()
+        ss += txdata.sha_sequences()
+        ss += txdata.sha_issuances()
+        ss += txdata.sha_issuance_rangeproofs()
     if out_type == SIGHASH_ALL:
-        ss += BIP341_sha_outputs(txTo)
-        ss += sha256(b"".join(owit.serialize() for owit in txTo.wit.vtxoutwit))
+        ss += txdata.sha_outputs()
+        ss += txdata.sha_output_witnesses()
     spend_type = 0
     if annex is not None:
         spend_type |= 1
@@ -7,6 +7,8 @@
 import configparser
 from enum import Enum
 import argparse
+import hashlib
+import json
 import logging
 import os
 import pdb
@@ -21,6 +23,8 @@ import time
 from typing import List
 from .address import create_deterministic_address_bcrt1_p2tr_op_true
 from .authproxy import JSONRPCException
+from .chain_cache import ChainState, clone_datadir
+from .node_pool import NodePool
 from . import coverage
 from .p2p import NetworkThread
 from .test_node import TestNode
@@ -28,6 +32,7 @@ from .util import (
     MAX_NODES,
     PortSeed,
     assert_equal,
+    call_concurrently,
     check_json_precision,
     get_datadir_path,
     initialize_datadir,
@@ -48,6 +53,34 @@ TEST_EXIT_SKIPPED = 77
 TMPDIR_PREFIX = "bitcoin_func_test_"
 
 
+def generate_default_chain(test_framework, nodes):
+    """Generate the default pre-mined chain of the tests."""
+    cache_node = nodes[0]
+
+    # Set a time in the past, so that blocks don't end up in the future
+    cache_node.setmocktime(cache_node.getblockheader(cache_node.getbestblockhash())['time'])
+
+    # Create a 199-block-long chain; each of the 3 first nodes
+    # gets 25 mature blocks and 25 immature.
+    # The 4th address gets 25 mature and only 24 immature blocks so that the very last
+    # block in the cache does not age too much (have an old tip age).
+    # This is needed so that we are out of IBD when the test starts,
+    # see the tip age check in IsInitialBlockDownload().
+    gen_addresses = [k.address for k in TestNode.PRIV_KEYS][:3] + [create_deterministic_address_bcrt1_p2tr_op_true()[0]]
+    assert_equal(len(gen_addresses), 4)
+    for i in range(8):
+        test_framework.generatetoaddress(
+            cache_node,
+            nblocks=25 if i != 7 else 24,
+            address=gen_addresses[i % len(gen_addresses)],
+        )
+
+    assert_equal(cache_node.getblockchaininfo()["blocks"], 199)
+
+
+DEFAULT_CHAIN_STATE = ChainState("default", generate=generate_default_chain, extra_args=[['-disablewallet']])
+
+
 class SkipTest(Exception):
     """This exception is raised to skip a test"""
 
@@ -95,6 +128,16 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         """Sets test framework defaults. Do not override this method. Instead, override the set_test_params() method"""
         self.chain: str = 'elementsregtest'
         self.setup_clean_chain: bool = False
+        # Optional ChainState the nodes start from, which can be set in
+        # set_test_params. If unset, the nodes start from the default
+        # 199-block-long chain (unless setup_clean_chain is set).
+        self.chain_state = None
+        # Whether the nodes can be leased from, and handed over to, other
+        # tests with the same node arguments when running with
+        # test_runner.py --reusenodes. Only for tests which start their nodes
+        # once with self.extra_args, and leave no transactions in the mempool.
+        self.reuse_nodes = False
+        self._node_lease = None
         self.nodes: List[TestNode] = []
         self.network_thread = None
         self.rpc_timeout = 60  # Wait for up to 60 seconds for the RPC server to respond
@@ -167,6 +210,8 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         parser.add_argument("--cachedir", dest="cachedir", default=os.path.abspath(os.path.dirname(os.path.realpath(__file__)) + "/../../cache"),
                             help="Directory for caching pregenerated datadirs (default: %(default)s)")
         parser.add_argument("--tmpdir", dest="tmpdir", help="Root directory for datadirs")
+        parser.add_argument("--nodepool", dest="nodepool",
+                            help="Directory of running nodes shared with other tests setting reuse_nodes (see test_runner.py --reusenodes)")
         parser.add_argument("-l", "--loglevel", dest="loglevel", default="INFO",
                             help="log events at this level and higher to the console. Can be set to DEBUG, INFO, WARNING, ERROR or CRITICAL. Passing --loglevel DEBUG will output all logs to console. Note that logs at all levels are always written to the test_framework.log file in the temporary test directory.")
         parser.add_argument("--tracerpc", dest="trace_rpc", default=False, action="store_true",
@@ -284,7 +329,11 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
                 raise SkipTest("--usecli specified but test does not support using CLI")
             self.skip_if_no_cli()
         self.skip_test_if_missing_module()
-        self.setup_chain()
+        self._nodes_dir = self.options.tmpdir
+        if self._use_node_pool():
+            self._lease_nodes()
+        if self._node_lease is None or not self._node_lease.nodes:
+            self.setup_chain()
         self.setup_network()
 
         self.success = TestStatus.PASSED
@@ -300,7 +349,9 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         self.network_thread.close()
         if not self.options.noshutdown:
             self.log.info("Stopping nodes")
-            if self.nodes:
+            if self._node_lease is not None:
+                self._release_nodes()
+            elif self.nodes:
                 self.stop_nodes()
         else:
             for node in self.nodes:
@@ -407,7 +458,7 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         self.start_nodes()
         if self.requires_wallet:
             self.import_deterministic_coinbase_privkeys()
-        if not self.setup_clean_chain:
+        if not self.setup_clean_chain and self.chain_state is None:
             for n in self.nodes:
                 assert_equal(n.getblockchaininfo()["blocks"], 199)
             # To ensure that all nodes are out of IBD, the most recent block
@@ -496,7 +547,7 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
             numnode = len(self.nodes)
             test_node_i = TestNode(
                 numnode,
-                get_datadir_path(self.options.tmpdir, numnode),
+                get_datadir_path(self._nodes_dir, numnode),
                 chain=chain[i],
                 rpchost=rpchost,
                 timewait=self.rpc_timeout,
@@ -513,6 +564,8 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
                 use_valgrind=self.options.valgrind,
                 descriptors=self.options.descriptors,
             )
+            if self._node_lease is not None and numnode < len(self._node_lease.nodes):
+                test_node_i.lease = self._node_lease.nodes[numnode]
             self.nodes.append(test_node_i)
             if not test_node_i.version_is_at_least(170000):
                 # adjust conf for pre 17
@@ -542,8 +595,8 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         try:
             for i, node in enumerate(self.nodes):
                 node.start(extra_args[i], *args, **kwargs)
-            for node in self.nodes:
-                node.wait_for_rpc_connection()
+            # The nodes start up concurrently, so wait for them concurrently too
+            call_concurrently((node.wait_for_rpc_connection,) for node in self.nodes)
         except:
             # If one node failed to start, stop the others
             self.stop_nodes()
@@ -558,15 +611,25 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         self.nodes[i].stop_node(expected_stderr, wait=wait)
 
     def stop_nodes(self, wait=0):
-        """Stop multiple bitcoind test nodes"""
-        for node in self.nodes:
-            # Issue RPC to stop nodes
-            node.stop_node(wait=wait, wait_until_stopped=False)
+        """Stop multiple bitcoind test nodes
 
-        for node in self.nodes:
-            # Wait for nodes to stop
+        The nodes are stopped concurrently, and all of them are stopped (or
+        waited for) even if some fail. The failures are reported together."""
+        def stop(node):
+            # Issue RPC to stop node, and wait for it to stop
+            node.stop_node(wait=wait, wait_until_stopped=False)
             node.wait_until_stopped()
 
+        results = call_concurrently(((stop, node) for node in self.nodes), return_exceptions=True)
+        errors = [(node, e) for node, e in zip(self.nodes, results) if isinstance(e, Exception)]
+        if len(errors) == 1:
+            raise errors[0][1]
+        if errors:
+            raise AssertionError("Failed to stop {} nodes:{}".format(
+                len(errors),
+                "".join("\n  node {}: {!r}".format(node.index, e) for node, e in errors),
+            ))
+
     def restart_node(self, i, extra_args=None):
         """Stop and start a test node"""
         self.stop_node(i)
@@ -665,17 +728,36 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         sync_blocks needs to be called with an rpc_connections set that has least
         one node already synced to the latest, stable tip, otherwise there's a
         chance it might return before all nodes are stably synced.
+
+        Instead of sleeping between checks, the lagging nodes are long-polled
+        (for at most `wait` seconds) until they reach the highest tip.
         """
         rpc_connections = nodes or self.nodes
         timeout = int(timeout * self.options.timeout_factor)
         stop_time = time.time() + timeout
+
+        def get_state(node):
+            # Fetch the tip and (if needed) the peers in a single round trip
+            with node.batch() as batch:
+                best_hash = batch.getbestblockhash()
+                height = batch.getblockcount()
+                peers = None if expect_disconnected else batch.getpeerinfo()
+            return best_hash.result(), height.result(), peers and peers.result()
+
         while time.time() <= stop_time:
-            best_hash = [x.getbestblockhash() for x in rpc_connections]
+            state = call_concurrently((get_state, x) for x in rpc_connections)
+            best_hash = [h for h, _, _ in state]
             if best_hash.count(best_hash[0]) == len(rpc_connections):
                 return
             if not expect_disconnected:
-                assert (all([len(x.getpeerinfo()) for x in rpc_connections]))
-            time.sleep(wait)
+                assert (all([len(peers) for _, _, peers in state]))
+            # Wait until the lagging nodes reached the tip of the highest one.
+            # waitforblock returns as soon as the tip of the node is the
+            # target (or when the timeout expired), after which all nodes are
+            # checked again.
+            target = max(state, key=lambda s: s[1])[0]
+            wait_ms = max(1, int(min(wait, stop_time - time.time()) * 1000))
+            call_concurrently((x.waitforblock, target, wait_ms) for x, h in zip(rpc_connections, best_hash) if h != target)
         raise AssertionError("Block sync timed out after {}s:{}".format(
             timeout,
             "".join("\n  {!r}".format(b) for b in best_hash),
@@ -685,20 +767,33 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         """
         Wait until everybody has the same transactions in their memory
         pools
+
+        The mempools are checked again after a short delay, which is doubled
+        every round up to `wait` seconds.
         """
         rpc_connections = nodes or self.nodes
         timeout = int(timeout * self.options.timeout_factor)
         stop_time = time.time() + timeout
+        delay = min(0.05, wait)
+
+        def get_state(node):
+            # Fetch the mempool and the peers in a single round trip
+            with node.batch() as batch:
+                mempool = batch.getrawmempool()
+                peers = batch.getpeerinfo()
+            return set(mempool.result()), peers.result()
+
         while time.time() <= stop_time:
-            pool = [set(r.getrawmempool()) for r in rpc_connections]
+            state = call_concurrently((get_state, r) for r in rpc_connections)
+            pool = [m for m, _ in state]
             if pool.count(pool[0]) == len(rpc_connections):
                 if flush_scheduler:
-                    for r in rpc_connections:
-                        r.syncwithvalidationinterfacequeue()
+                    call_concurrently((r.syncwithvalidationinterfacequeue,) for r in rpc_connections)
                 return
             # Check that each peer has at least one connection
-            assert (all([len(x.getpeerinfo()) for x in rpc_connections]))
-            time.sleep(wait)
+            assert (all([len(peers) for _, peers in state]))
+            time.sleep(delay)
+            delay = min(delay * 2, wait)
         raise AssertionError("Mempool sync timed out after {}s:{}".format(
             timeout,
             "".join("\n  {!r}".format(m) for m in pool),
@@ -744,24 +839,40 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
     def _initialize_chain(self):
         """Initialize a pre-mined blockchain for use by the test.
 
-        Create a cache of a 199-block-long chain
-        Afterward, create num_nodes copies from the cache."""
-
-        CACHE_NODE_ID = 0  # Use node 0 to create the cache for all other nodes
-        cache_node_dir = get_datadir_path(self.options.cachedir, CACHE_NODE_ID)
+        Build the cached state declared in self.chain_state, or a
+        199-block-long chain by default, if it is not cached yet.
+        Afterward, create num_nodes clones from the cache."""
         assert self.num_nodes <= MAX_NODES
+        state = self.chain_state or DEFAULT_CHAIN_STATE
+        state_dir = os.path.join(self.options.cachedir, state.key(self.chain))
 
-        if not os.path.isdir(cache_node_dir):
-            self.log.debug("Creating cache directory {}".format(cache_node_dir))
+        if not os.path.isdir(state_dir):
+            self._build_chain_state(state, state_dir)
 
-            initialize_datadir(self.options.cachedir, CACHE_NODE_ID, self.chain, self.disable_autoconnect)
+        for i in range(self.num_nodes):
+            from_dir = get_datadir_path(state_dir, min(i, state.num_nodes - 1))
+            self.log.debug("Clone cache directory {} to node {}".format(from_dir, i))
+            clone_datadir(from_dir, get_datadir_path(self._nodes_dir, i))
+            initialize_datadir(self._nodes_dir, i, self.chain, self.disable_autoconnect)  # Overwrite port/rpcport in bitcoin.conf
+
+    def _build_chain_state(self, state, state_dir):
+        """Build a cached state of the nodes in state_dir.
+
+        The state is built in a temporary directory and moved in place at
+        the end, so that tests building the same state concurrently do not
+        see a partial one."""
+        self.log.debug("Creating cache directory {}".format(state_dir))
+        os.makedirs(self.options.cachedir, exist_ok=True)
+        build_dir = tempfile.mkdtemp(prefix=os.path.basename(state_dir) + ".", dir=self.options.cachedir)
+        for i in range(state.num_nodes):
+            initialize_datadir(build_dir, i, self.chain, self.disable_autoconnect)
             self.nodes.append(
                 TestNode(
-                    CACHE_NODE_ID,
-                    cache_node_dir,
+                    i,
+                    get_datadir_path(build_dir, i),
                     chain=self.chain,
                     extra_conf=["bind=127.0.0.1"],
-                    extra_args=['-disablewallet'],
+                    extra_args=state.extra_args[i],
                     rpchost=None,
                     timewait=self.rpc_timeout,
                     timeout_factor=self.options.timeout_factor,
@@ -771,49 +882,41 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
                     cwd=self.options.tmpdir,
                     descriptors=self.options.descriptors,
                 ))
-            self.start_node(CACHE_NODE_ID)
-            cache_node = self.nodes[CACHE_NODE_ID]
-
-            # Wait for RPC connections to be ready
-            cache_node.wait_for_rpc_connection()
-
-            # Set a time in the past, so that blocks don't end up in the future
-            cache_node.setmocktime(cache_node.getblockheader(cache_node.getbestblockhash())['time'])
-
-            # Create a 199-block-long chain; each of the 3 first nodes
-            # gets 25 mature blocks and 25 immature.
-            # The 4th address gets 25 mature and only 24 immature blocks so that the very last
-            # block in the cache does not age too much (have an old tip age).
-            # This is needed so that we are out of IBD when the test starts,
-            # see the tip age check in IsInitialBlockDownload().
-            gen_addresses = [k.address for k in TestNode.PRIV_KEYS][:3] + [create_deterministic_address_bcrt1_p2tr_op_true()[0]]
-            assert_equal(len(gen_addresses), 4)
-            for i in range(8):
-                self.generatetoaddress(
-                    cache_node,
-                    nblocks=25 if i != 7 else 24,
-                    address=gen_addresses[i % len(gen_addresses)],
-                )
-
-            assert_equal(cache_node.getblockchaininfo()["blocks"], 199)
-
-            # Shut it down, and clean up cache directories:
+        # Not start_nodes(), which starts self.num_nodes nodes rather than
+        # the nodes of the state
+        try:
+            for node in self.nodes:
+                node.start()
+            call_concurrently((node.wait_for_rpc_connection,) for node in self.nodes)
+        except:
             self.stop_nodes()
-            self.nodes = []
+            raise
 
-            def cache_path(*paths):
-                return os.path.join(cache_node_dir, self.chain, *paths)
+        state.generate(self, self.nodes)
 
-            os.rmdir(cache_path('wallets'))  # Remove empty wallets dir
-            for entry in os.listdir(cache_path()):
-                if entry not in ['chainstate', 'blocks', 'indexes']:  # Only indexes, chainstate and blocks folders
-                    os.remove(cache_path(entry))
+        # Shut them down, and clean up cache directories:
+        self.stop_nodes()
+        self.nodes = []
 
-        for i in range(self.num_nodes):
-            self.log.debug("Copy cache directory {} to node {}".format(cache_node_dir, i))
-            to_dir = get_datadir_path(self.options.tmpdir, i)
-            shutil.copytree(cache_node_dir, to_dir)
-            initialize_datadir(self.options.tmpdir, i, self.chain, self.disable_autoconnect)  # Overwrite port/rpcport in bitcoin.conf
+        for i in range(state.num_nodes):
+            chain_dir = os.path.join(get_datadir_path(build_dir, i), self.chain)
+            for entry in os.listdir(chain_dir):
+                path = os.path.join(chain_dir, entry)
+                if entry == 'wallets' and not os.listdir(path):
+                    os.rmdir(path)  # Remove empty wallets dir
+                elif entry not in ['chainstate', 'blocks', 'indexes', 'wallets']:  # Only indexes, chainstate, blocks and wallets folders
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+
+        try:
+            os.rename(build_dir, state_dir)
+        except OSError:
+            if not os.path.isdir(state_dir):
+                raise
+            # Built concurrently by another test
+            shutil.rmtree(build_dir)
 
     def _initialize_chain_clean(self):
         """Initialize empty blockchain for use by the test.
@@ -821,7 +924,104 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         Create an empty blockchain and num_nodes wallets.
         Useful if a test case wants complete control over initialization."""
         for i in range(self.num_nodes):
-            initialize_datadir(self.options.tmpdir, i, self.chain, self.disable_autoconnect)
+            initialize_datadir(self._nodes_dir, i, self.chain, self.disable_autoconnect)
+
+    def _use_node_pool(self):
+        """Whether the nodes of the test can be leased from the node pool."""
+        extra_args = getattr(self, "extra_args", [[]] * self.num_nodes)
+        return (
+            self.options.nodepool is not None and
+            self.reuse_nodes and
+            self.chain_state is None and
+            not self.options.perf and
+            not self.options.valgrind and
+            not any(arg.startswith("-wallet=") for args in extra_args for arg in args)
+        )
+
+    def _node_pool_key(self):
+        """Return the key of the nodes of the test in the node pool: a hash of everything they are started with."""
+        description = json.dumps([
+            self.chain,
+            self.num_nodes,
+            getattr(self, "extra_args", [[]] * self.num_nodes),
+            None if self.setup_clean_chain else DEFAULT_CHAIN_STATE.key(self.chain),
+            self.options.bitcoind,
+            self.options.descriptors,
+            self.bind_to_localhost_only,
+            self.disable_autoconnect,
+        ])
+        return hashlib.sha256(description.encode('utf8')).hexdigest()
+
+    def _lease_nodes(self):
+        """Lease running nodes from the node pool, or an entry of the pool to start new nodes in."""
+        pool = NodePool(self.options.nodepool)
+        self._node_lease = pool.lease(self._node_pool_key())
+        if self._node_lease is not None:
+            self.log.info("Leasing running nodes from {}".format(self._node_lease.path))
+            # The nodes listen on the ports of the test which started them
+            PortSeed.n = self._node_lease.portseed
+            if not self.setup_clean_chain:
+                # The block generated by setup_nodes() would be the one
+                # invalidated on release if generated in the same second
+                time.sleep(max(0, self._node_lease.info['released'] + 1 - time.time()))
+        else:
+            self._node_lease = pool.create()
+        self._nodes_dir = self._node_lease.path
+
+    def _reset_nodes(self):
+        """Reset the nodes to the state they were started in, and return whether they can be reused."""
+        if len(self.nodes) != self.num_nodes or not all(node.running and node.reusable for node in self.nodes):
+            return False
+        try:
+            for node in self.nodes:
+                for added_node in node.getaddednodeinfo():
+                    node.addnode(added_node['addednode'], 'remove')
+                for peer in node.getpeerinfo():
+                    node.disconnectnode(nodeid=peer['id'])
+                node.clearbanned()
+                node.setnetworkactive(True)
+                node.setmocktime(0)
+            for node in self.nodes:
+                wait_until_helper(lambda: not node.getpeerinfo(), timeout=10, timeout_factor=self.options.timeout_factor)
+                if node.getblockcount() > node.start_height:
+                    node.invalidateblock(node.getblockhash(node.start_height + 1))
+                if self.is_wallet_compiled() and "-disablewallet" not in node.extra_args:
+                    for wallet_name in node.listwallets():
+                        node.unloadwallet(wallet_name)
+                    wallets_dir = os.path.join(node.chain_path, "wallets")
+                    if os.path.isdir(wallets_dir):
+                        shutil.rmtree(wallets_dir)
+                        os.mkdir(wallets_dir)
+                node.stderr.seek(0)
+                if node.getblockcount() != node.start_height or node.getmempoolinfo()['size'] or node.stderr.read():
+                    return False
+        except (JSONRPCException, AssertionError):
+            self.log.exception("Failed to reset the nodes")
+            return False
+        return True
+
+    def _release_nodes(self):
+        """Hand the nodes over to the next test leasing them.
+
+        If they can not be reset, stop them and move their datadirs to the
+        test directory."""
+        lease = self._node_lease
+        if self.success == TestStatus.PASSED and self._reset_nodes():
+            for node in self.nodes:
+                node.cleanup_on_exit = False
+                node.stdout.close()
+                node.stderr.close()
+            lease.release(self._node_pool_key(), PortSeed.n, [
+                {'pid': node.process.pid, 'stdout': node.stdout.name, 'stderr': node.stderr.name} for node in self.nodes
+            ])
+            self.log.info("Nodes left running for the next test")
+            return
+        if self.nodes:
+            self.stop_nodes()
+        for name in os.listdir(lease.path):
+            if name.startswith("node"):
+                shutil.move(os.path.join(lease.path, name), self.options.tmpdir)
+        lease.discard()
 
     def skip_if_no_py3_zmq(self):
         """Attempt to import the zmq package and skip the test if the import fails."""
@@ -4,6 +4,7 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 """Class for bitcoind node under test"""
 
+import codecs
 import contextlib
 import decimal
 import errno
@@ -22,8 +23,13 @@ import shlex
 import sys
 from pathlib import Path
 
-from .authproxy import JSONRPCException
+from .authproxy import (
+    JSONRPCException,
+    RPCBatch,
+)
+from .async_rpc import AsyncAuthServiceProxy
 from .descriptors import descsum_create
+from .node_pool import AttachedProcess
 from .p2p import P2P_SUBVERSION
 from .util import (
     MAX_NODES,
@@ -45,6 +51,43 @@ class FailedToStartError(Exception):
     """Raised when a node fails to start correctly."""
 
 
+class DebugLogFollower():
+    """Follows a debug.log file from its current end.
+
+    Only the bytes appended since the previous read() are read and decoded.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as dl:
+            self.offset = dl.seek(0, 2)
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._chunks = []
+
+    def read(self, overlap=0):
+        """Return the text appended since the last read, preceded by the last `overlap` characters read before.
+
+        The overlap allows to find fragments which were split between two reads.
+        """
+        with open(self.path, 'rb') as dl:
+            dl.seek(self.offset)
+            data = dl.read()
+        self.offset += len(data)
+        prefix = ''
+        i = len(self._chunks)
+        while len(prefix) < overlap and i:
+            i -= 1
+            prefix = self._chunks[i][-(overlap - len(prefix)):] + prefix
+        new = self._decoder.decode(data)
+        if new:
+            self._chunks.append(new)
+        return prefix + new
+
+    @property
+    def log(self):
+        """All the text read so far."""
+        return ''.join(self._chunks)
+
+
 class ErrorMatch(Enum):
     FULL_TEXT = 1
     FULL_REGEX = 2
@@ -128,9 +171,18 @@ class TestNode():
         self.process = None
         self.rpc_connected = False
         self.rpc = None
+        self.async_rpc = None
         self.url = None
         self.log = logging.getLogger('TestFramework.node%d' % i)
         self.cleanup_on_exit = True # Whether to kill the node when this object goes away
+        # Running node of a previous test to take over on start() instead of
+        # starting a new one (see node_pool)
+        self.lease = None
+        # Whether the node was started once, with its default arguments, so
+        # that it can be handed over to the next test (see node_pool)
+        self.reusable = None
+        # Block height when the node was last started
+        self.start_height = None
         # Cache perf subprocesses here by their data output filename.
         self.perf_subprocesses = {}
 
@@ -202,6 +254,17 @@ class TestNode():
         """Start the node."""
         if extra_args is None:
             extra_args = self.extra_args
+        self.reusable = self.reusable is None and extra_args == self.extra_args and cwd is None and stdout is None and stderr is None and not kwargs
+
+        if self.lease is not None:
+            # Take over the node of a previous test, which is still running
+            self.process = AttachedProcess(self.lease['pid'])
+            self.stdout = open(self.lease['stdout'], 'rb')
+            self.stderr = open(self.lease['stderr'], 'rb')
+            self.lease = None
+            self.running = True
+            self.log.debug("bitcoind leased from a previous test, waiting for RPC to come up")
+            return
 
         # Add a new stdout and stderr file each time bitcoind is started
         if stderr is None:
@@ -232,9 +295,10 @@ class TestNode():
 
     def wait_for_rpc_connection(self):
         """Sets up an RPC connection to the bitcoind process. Returns False if unable to connect."""
-        # Poll at a rate of four times per second
-        poll_per_s = 4
-        for _ in range(poll_per_s * self.rpc_timeout):
+        # Poll quickly at first, backing off to a rate of four times per second
+        poll_delay = 0.02
+        stop_time = time.time() + self.rpc_timeout
+        while time.time() < stop_time:
             if self.process.poll() is not None:
                 raise FailedToStartError(self._node_msg(
                     'bitcoind exited with status {} during initialization'.format(self.process.returncode)))
@@ -245,7 +309,7 @@ class TestNode():
                     timeout=self.rpc_timeout // 2,  # Shorter timeout to allow for one retry in case of ETIMEDOUT
                     coveragedir=self.coverage_dir,
                 )
-                rpc.getblockcount()
+                height = rpc.getblockcount()
                 # If the call to getblockcount() succeeds then the RPC connection is up
                 if self.version_is_at_least(190000):
                     # getmempoolinfo.loaded is available since commit
@@ -269,11 +333,13 @@ class TestNode():
                     # overhead is trivial, and the added guarantees are worth
                     # the minimal performance cost.
                 self.log.debug("RPC successfully started")
+                self.start_height = height
                 if self.use_cli:
                     return
                 self.rpc = rpc
                 self.rpc_connected = True
                 self.url = self.rpc.rpc_url
+                self.async_rpc = AsyncAuthServiceProxy(self.url, timeout=self.rpc_timeout // 2)
                 return
             except JSONRPCException as e:  # Initialization phase
                 # -28 RPC in warmup
@@ -294,7 +360,8 @@ class TestNode():
             except ValueError as e:  # cookie file not found and no rpcuser or rpcpassword; bitcoind is still starting
                 if "No RPC credentials" not in str(e):
                     raise
-            time.sleep(1.0 / poll_per_s)
+            time.sleep(poll_delay)
+            poll_delay = min(poll_delay * 2, 0.25)
         self._raise_assertion_error("Unable to connect to bitcoind after {}s".format(self.rpc_timeout))
 
     def wait_for_cookie_credentials(self):
@@ -389,6 +456,7 @@ class TestNode():
         self.process = None
         self.rpc_connected = False
         self.rpc = None
+        self.async_rpc = None
         self.log.debug("Node stopped")
         return True
 
@@ -408,32 +476,46 @@ class TestNode():
             dl.seek(0, 2)
             return dl.tell()
 
+    def _wait_for_log_msgs(self, follower, expected_msgs, unexpected_msgs, time_end, re_flags, max_delay):
+        """Read the log appended to the follower until all expected messages were seen.
+
+        Each read only searches the newly appended text. Returns the print
+        formatted log on failure (timeout), and raises if an unexpected
+        message is seen.
+        """
+        expected = {msg: re.compile(re.escape(msg), re_flags) for msg in expected_msgs}
+        unexpected = [(msg, re.compile(re.escape(msg), re_flags)) for msg in unexpected_msgs]
+        overlap = max(map(len, [*expected, *unexpected_msgs]), default=1) - 1
+        delay = 0.001
+        while True:
+            log = follower.read(overlap)
+            for unexpected_msg, pattern in unexpected:
+                if pattern.search(log):
+                    print_log = " - " + "\n - ".join(follower.log.splitlines())
+                    self._raise_assertion_error('Unexpected message "{}" partially matches log:\n\n{}\n\n'.format(unexpected_msg, print_log))
+            for expected_msg in [msg for msg, pattern in expected.items() if pattern.search(log)]:
+                del expected[expected_msg]
+            if not expected:
+                return None
+            if time.time() >= time_end:
+                return " - " + "\n - ".join(follower.log.splitlines())
+            # Back off quickly from a short delay, to notice the messages
+            # early without spinning on the log file
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
     @contextlib.contextmanager
     def assert_debug_log(self, expected_msgs, unexpected_msgs=None, timeout=2):
         if unexpected_msgs is None:
             unexpected_msgs = []
         time_end = time.time() + timeout * self.timeout_factor
-        prev_size = self.debug_log_bytes()
+        follower = DebugLogFollower(self.debug_log_path)
 
         yield
 
-        while True:
-            found = True
-            with open(self.debug_log_path, encoding='utf-8') as dl:
-                dl.seek(prev_size)
-                log = dl.read()
-            print_log = " - " + "\n - ".join(log.splitlines())
-            for unexpected_msg in unexpected_msgs:
-                if re.search(re.escape(unexpected_msg), log, flags=re.MULTILINE):
-                    self._raise_assertion_error('Unexpected message "{}" partially matches log:\n\n{}\n\n'.format(unexpected_msg, print_log))
-            for expected_msg in expected_msgs:
-                if re.search(re.escape(expected_msg), log, flags=re.MULTILINE) is None:
-                    found = False
-            if found:
-                return
-            if time.time() >= time_end:
-                break
-            time.sleep(0.05)
+        print_log = self._wait_for_log_msgs(follower, expected_msgs, unexpected_msgs, time_end, re.MULTILINE, max_delay=0.05)
+        if print_log is None:
+            return
         self._raise_assertion_error('Expected messages "{}" does not partially match log:\n\n{}\n\n'.format(str(expected_msgs), print_log))
 
     @contextlib.contextmanager
@@ -444,30 +526,16 @@ class TestNode():
             the number of log lines we encountered when matching
         """
         time_end = time.time() + timeout * self.timeout_factor
-        prev_size = self.debug_log_bytes()
+        follower = DebugLogFollower(self.debug_log_path)
         re_flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
 
         yield
 
-        while True:
-            found = True
-            with open(self.debug_log_path, encoding='utf-8') as dl:
-                dl.seek(prev_size)
-                log = dl.read()
-
-            for expected_msg in expected_msgs:
-                if re.search(re.escape(expected_msg), log, flags=re_flags) is None:
-                    found = False
-
-            if found:
-                return
-
-            if time.time() >= time_end:
-                print_log = " - " + "\n - ".join(log.splitlines())
-                break
-
-            # No sleep here because we want to detect the message fragment as fast as
-            # possible.
+        # Keep the delay short, because we want to detect the message fragment
+        # as fast as possible.
+        print_log = self._wait_for_log_msgs(follower, expected_msgs, [], time_end, re_flags, max_delay=0.005)
+        if print_log is None:
+            return
 
         self._raise_assertion_error(
             'Expected messages "{}" does not partially match log:\n\n{}\n\n'.format(
@@ -713,7 +781,9 @@ class TestNodeCLI():
     def __getattr__(self, command):
         return TestNodeCLIAttr(self, command)
 
-    def batch(self, requests):
+    def batch(self, requests=None):
+        if requests is None:
+            return RPCBatch(self)
         results = []
         for request in requests:
             try:
@@ -7,6 +7,7 @@
 from base64 import b64encode
 from decimal import Decimal, ROUND_DOWN
 from subprocess import CalledProcessError
+import concurrent.futures
 import hashlib
 import inspect
 import json
@@ -17,6 +18,7 @@ import time
 import unittest
 
 from . import coverage
+from .fastmerkle import compute_fast_merkle_root
 from .authproxy import AuthServiceProxy, JSONRPCException
 from typing import Callable, Optional
 
@@ -27,12 +29,15 @@ BITCOIN_ASSET_BYTES = bytearray.fromhex(BITCOIN_ASSET)
 BITCOIN_ASSET_BYTES.reverse()
 BITCOIN_ASSET_OUT = b"\x01"+BITCOIN_ASSET_BYTES
 
-# This variable should be set to the node being used for CalcFastMerkleRoot calls
-node_fastmerkle = None
+def calcfastmerkleroot(leaves, *, check_node=None):
+    """Compute the fast merkle root of a list of uint256 hex strings.
 
-def calcfastmerkleroot(leaves):
-    global node_fastmerkle
-    return node_fastmerkle.calcfastmerkleroot(leaves)
+    The root is computed locally. If check_node is given, the result is
+    cross-checked against that node's calcfastmerkleroot RPC."""
+    root = compute_fast_merkle_root([bytes.fromhex(leaf)[::-1] for leaf in leaves])[::-1].hex()
+    if check_node is not None:
+        assert_equal(root, check_node.calcfastmerkleroot(leaves))
+    return root
 
 # Assert functions
 ##################
@@ -253,14 +258,19 @@ def satoshi_round(amount):
     return Decimal(amount).quantize(Decimal('0.00000001'), rounding=ROUND_DOWN)
 
 
-def wait_until_helper(predicate, *, attempts=float('inf'), timeout=float('inf'), lock=None, timeout_factor=1.0):
+def wait_until_helper(predicate, *, attempts=float('inf'), timeout=float('inf'), lock=None, condition=None, timeout_factor=1.0):
     """Sleep until the predicate resolves to be True.
 
+    If a threading.Condition is given, the predicate is evaluated while holding
+    it and re-evaluated as soon as the condition is notified, or after the usual
+    polling interval otherwise (for predicates that depend on state changing
+    without notification, like node RPC results).
+
     Warning: Note that this method is not recommended to be used in tests as it is
     not aware of the context of the test framework. Using the `wait_until()` members
     from `BitcoinTestFramework` or `P2PInterface` class ensures the timeout is
     properly scaled. Furthermore, `wait_until()` from `P2PInterface` class in
-    `p2p.py` has a preset lock.
+    `p2p.py` has a preset condition.
     """
     if attempts == float('inf') and timeout == float('inf'):
         timeout = 60
@@ -268,6 +278,13 @@ def wait_until_helper(predicate, *, attempts=float('inf'), timeout=float('inf'),
     attempt = 0
     time_end = time.time() + timeout
 
+    if condition:
+        with condition:
+            while attempt < attempts and time.time() < time_end:
+                if predicate():
+                    return
+                attempt += 1
+                condition.wait(max(0, min(0.05, time_end - time.time())))
     while attempt < attempts and time.time() < time_end:
         if lock:
             with lock:
@@ -339,6 +356,33 @@ def get_rpc_proxy(url: str, node_number: int, *, timeout: int=None, coveragedir:
     return coverage.AuthServiceProxyWrapper(proxy, url, coverage_logfile)
 
 
+def call_concurrently(calls, *, max_workers=None, return_exceptions=False):
+    """Issue independent RPC calls from worker threads.
+
+    Args:
+        calls: iterable of (function, *args) tuples, e.g.
+            [(node.getrawmempool,) for node in self.nodes]
+
+    Kwargs:
+        return_exceptions: return the exception raised by a call in place of
+            its result, instead of re-raising it
+
+    Returns:
+        the list of results, in the order of the calls. The first exception
+        raised by a call (in call order) is re-raised in the caller, after
+        all calls completed.
+    """
+    calls = list(calls)
+    if len(calls) <= 1 and not return_exceptions:
+        return [fn(*args) for fn, *args in calls]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or max(len(calls), 1)) as executor:
+        futures = [executor.submit(fn, *args) for fn, *args in calls]
+        concurrent.futures.wait(futures)
+    if return_exceptions:
+        return [f.exception() or f.result() for f in futures]
+    return [f.result() for f in futures]
+
+
 def p2p_port(n):
     assert n <= MAX_NODES
     return PORT_MIN + n + (MAX_NODES * PortSeed.n) % (PORT_RANGE - 1 - MAX_NODES)
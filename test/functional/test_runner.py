@@ -14,9 +14,13 @@ For a description of arguments recognized by test scripts, see
 
 import argparse
 from collections import deque
+import concurrent.futures
 import configparser
 import datetime
+import io
+import json
 import os
+import selectors
 import time
 import shutil
 import signal
@@ -27,6 +31,9 @@ import re
 import logging
 import unittest
 
+from test_framework.node_pool import NodePool
+from test_framework.util import MAX_NODES, PORT_RANGE
+
 # Formatting. Default colors to empty strings.
 BOLD, GREEN, RED, GREY = ("", ""), ("", ""), ("", ""), ("", "")
 try:
@@ -67,11 +74,23 @@ if os.name != 'nt' or sys.getwindowsversion() >= (10, 0, 14393): # type: ignore[
 TEST_EXIT_PASSED = 0
 TEST_EXIT_SKIPPED = 77
 
+# Durations of the tests in previous runs, kept in the build directory to schedule the longest tests first
+DURATIONS_FILENAME = "functional_test_durations.json"
+# Peak resident set size (in kB) of a process of each test in previous runs,
+# kept in the build directory to estimate the memory used by the tests
+MAXRSS_FILENAME = "functional_test_maxrss.json"
+
 TEST_FRAMEWORK_MODULES = [
     "address",
+    "async_rpc",
     "blocktools",
+    "chain_cache",
+    "fastmerkle",
     "muhash",
     "key",
+    "messages",
+    "node_pool",
+    "p2p",
     "script",
     "segwit_addr",
     "util",
@@ -402,6 +421,9 @@ def main():
     parser.add_argument('--extended', action='store_true', help='run the extended test suite in addition to the basic tests')
     parser.add_argument('--help', '-h', '-?', action='store_true', help='print help text and exit')
     parser.add_argument('--jobs', '-j', type=int, default=4, help='how many test scripts to run in parallel. Default=4.')
+    parser.add_argument('--maxnodes', type=int, default=4 * (os.cpu_count() or 1), help='how many nodes the test scripts run in parallel may start in total. Default=4 per CPU.')
+    parser.add_argument('--maxmemory', type=int, default=physical_memory_mb() * 8 // 10, help='how much memory (in MB) the test scripts run in parallel are expected to use in total. Default=80%% of the physical memory, if known.')
+    parser.add_argument('--reusenodes', action='store_true', help='hand the running nodes of the test scripts supporting it over to the next test script started with the same node arguments, instead of restarting them. Not supported on Windows.')
     parser.add_argument('--keepcache', '-k', action='store_true', help='the default behavior is to flush the cache directory on startup. --keepcache retains the cache from the previous testrun.')
     parser.add_argument('--quiet', '-q', action='store_true', help='only print dots, results summary and failure logs')
     parser.add_argument('--tmpdirprefix', '-t', default=tempfile.gettempdir(), help="Root directory for datadirs")
@@ -512,6 +534,9 @@ def main():
         build_dir=config["environment"]["BUILDDIR"],
         tmpdir=tmpdir,
         jobs=args.jobs,
+        max_nodes=args.maxnodes,
+        max_memory=args.maxmemory,
+        reuse_nodes=args.reusenodes and os.name != 'nt',
         enable_coverage=args.coverage,
         args=passon_args,
         combined_logs_len=args.combinedlogslen,
@@ -519,7 +544,7 @@ def main():
         use_term_control=args.ansi,
     )
 
-def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=False, args=None, combined_logs_len=0, failfast=False, use_term_control):
+def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, max_nodes=0, max_memory=0, reuse_nodes=False, enable_coverage=False, args=None, combined_logs_len=0, failfast=False, use_term_control):
     args = args or []
 
     # Warn if bitcoind is already running
@@ -536,20 +561,23 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
     if os.path.isdir(cache_dir):
         print("%sWARNING!%s There is a cache directory here: %s. If tests fail unexpectedly, try deleting the cache directory." % (BOLD[1], BOLD[0], cache_dir))
 
-    # Test Framework Tests
+    # Test Framework Tests, run in worker processes while the cache is
+    # created and the functional tests run
     print("Running Unit Tests for Test Framework Modules")
-    test_framework_tests = unittest.TestSuite()
-    for module in TEST_FRAMEWORK_MODULES:
-        test_framework_tests.addTest(unittest.TestLoader().loadTestsFromName("test_framework.{}".format(module)))
-    result = unittest.TextTestRunner(verbosity=1, failfast=True).run(test_framework_tests)
-    if not result.wasSuccessful():
-        logging.debug("Early exiting after failure in TestFramework unit tests")
-        sys.exit(False)
+    unit_test_pool = concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(jobs, len(TEST_FRAMEWORK_MODULES))))
+    unit_tests = {module: unit_test_pool.submit(run_unit_tests, module) for module in TEST_FRAMEWORK_MODULES}
+    unit_test_pool.shutdown(wait=False)
 
     tests_dir = src_dir + '/test/functional/'
 
     flags = ['--cachedir={}'.format(cache_dir)] + args
 
+    if reuse_nodes:
+        node_pool = NodePool(os.path.join(tmpdir, "nodepool"))
+        flags.append("--nodepool={}".format(node_pool.path))
+    else:
+        node_pool = None
+
     if enable_coverage:
         coverage = RPCCoverage()
         flags.append(coverage.flag)
@@ -565,6 +593,13 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
             sys.stdout.buffer.write(e.output)
             raise
 
+    # Start the longest tests first, to favor running tests in parallel
+    durations_file = os.path.join(build_dir, "test", DURATIONS_FILENAME)
+    durations = load_stats(durations_file)
+    test_list = schedule_tests(test_list, durations)
+    maxrss_file = os.path.join(build_dir, "test", MAXRSS_FILENAME)
+    maxrss = load_stats(maxrss_file)
+
     #Run Tests
     job_queue = TestHandler(
         num_tests_parallel=jobs,
@@ -573,15 +608,43 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
         test_list=test_list,
         flags=flags,
         use_term_control=use_term_control,
+        max_nodes=max_nodes,
+        max_memory=max_memory,
+        maxrss=maxrss,
+        node_pool=node_pool,
     )
     start_time = time.time()
     test_results = []
 
-    max_len_name = len(max(test_list, key=len))
+    max_len_name = len(max(test_list + ["test_framework." + module for module in unit_tests], key=len))
     test_count = len(test_list)
     all_passed = True
+
+    def collect_unit_tests(wait):
+        """Add the results of the finished unit tests of the test framework modules."""
+        nonlocal all_passed
+        for module, future in list(unit_tests.items()):
+            if not wait and not future.done():
+                continue
+            del unit_tests[module]
+            if future.cancelled():
+                continue
+            try:
+                passed, duration, output = future.result()
+            except Exception as e:
+                passed, duration, output = False, 0, repr(e)
+            name = "test_framework." + module
+            test_results.append(TestResult(name, "Passed" if passed else "Failed", duration))
+            if passed:
+                logging.debug("%s%s%s unit tests passed, Duration: %s s" % (BOLD[1], name, BOLD[0], duration))
+            else:
+                all_passed = False
+                print("%s%s%s unit tests failed, Duration: %s s\n" % (BOLD[1], name, BOLD[0], duration))
+                print(BOLD[1] + 'output:\n' + BOLD[0] + output + '\n')
+
     i = 0
     while i < test_count:
+        collect_unit_tests(wait=False)
         if failfast and not all_passed:
             break
         for test_result, testdir, stdout, stderr in job_queue.get_next():
@@ -613,6 +676,20 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
                     logging.debug("Early exiting after test failure")
                     break
 
+    if failfast and not all_passed:
+        for future in unit_tests.values():
+            future.cancel()
+    collect_unit_tests(wait=True)
+
+    if node_pool:
+        logging.debug("Stopping the nodes left running by the tests")
+        node_pool.stop_all()
+
+    durations.update(job_queue.durations)
+    save_stats(durations_file, durations)
+    maxrss.update(job_queue.maxrss)
+    save_stats(maxrss_file, maxrss)
+
     print_results(test_results, max_len_name, (int(time.time() - start_time)))
 
     if coverage:
@@ -637,6 +714,56 @@ def run_tests(*, test_list, src_dir, build_dir, tmpdir, jobs=1, enable_coverage=
 
     sys.exit(not all_passed)
 
+def run_unit_tests(module):
+    """Run the unit tests of a test framework module, in a worker process.
+
+    Return whether they passed, their duration and their output."""
+    start_time = time.time()
+    stream = io.StringIO()
+    suite = unittest.TestLoader().loadTestsFromName("test_framework.{}".format(module))
+    result = unittest.TextTestRunner(stream=stream, verbosity=1, failfast=True).run(suite)
+    return result.wasSuccessful(), int(time.time() - start_time), stream.getvalue()
+
+def load_stats(path):
+    """Load the per test statistics (like durations) recorded by previous runs."""
+    try:
+        with open(path, encoding="utf8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_stats(path, stats):
+    try:
+        with open(path, "w", encoding="utf8") as f:
+            json.dump(stats, f, indent=0, sort_keys=True)
+    except OSError as e:
+        logging.debug("Unable to save test statistics: %s" % e)
+
+def physical_memory_mb():
+    """Return the physical memory of the machine in MB, or 0 if unknown."""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2**20
+    except (AttributeError, ValueError, OSError):
+        return 0
+
+PORT_SLOTS = PORT_RANGE - 1 - MAX_NODES
+
+def port_slot(portseed):
+    """Return the offset of the port ranges used by a test, see p2p_port() in test_framework/util.py"""
+    return (MAX_NODES * portseed) % PORT_SLOTS
+
+def port_slots_overlap(slot, other_slot):
+    """Whether the port ranges at two offsets may overlap, with the offsets compared modulo their range."""
+    distance = abs(slot - other_slot) % PORT_SLOTS
+    return min(distance, PORT_SLOTS - distance) <= MAX_NODES
+
+def schedule_tests(test_list, durations):
+    """Order the tests longest first, by their duration in previous runs.
+
+    Tests without a recorded duration go first, in their original order
+    (which puts the longest tests first by hand)."""
+    return sorted(test_list, key=lambda test: -durations.get(test, float('inf')))
+
 def print_results(test_results, max_len_name, runtime):
     results = "\n" + BOLD[1] + "%s | %s | %s\n\n" % ("TEST".ljust(max_len_name), "STATUS   ", "DURATION") + BOLD[0]
 
@@ -664,9 +791,22 @@ class TestHandler:
     Trigger the test scripts passed in via the list.
     """
 
-    def __init__(self, *, num_tests_parallel, tests_dir, tmpdir, test_list, flags, use_term_control):
+    def __init__(self, *, num_tests_parallel, tests_dir, tmpdir, test_list, flags, use_term_control, max_nodes=0, max_memory=0, maxrss=None, node_pool=None):
         assert num_tests_parallel >= 1
         self.num_jobs = num_tests_parallel
+        # Budget of nodes and memory (in MB) for the running tests, 0 for no limit
+        self.max_nodes = max_nodes
+        self.max_memory = max_memory
+        # Peak resident set size (in kB) of a process of each test, from
+        # previous runs, updated as tests finish
+        self.maxrss = dict(maxrss or {})
+        # Number of nodes declared by each test script
+        self.num_nodes = {}
+        # Nodes, memory and port seed used by each running test process
+        self.resources = {}
+        self.used_portseeds = set()
+        # Running nodes handed over between tests, which keep their ports
+        self.node_pool = node_pool
         self.tests_dir = tests_dir
         self.tmpdir = tmpdir
         self.test_list = test_list
@@ -674,25 +814,109 @@ class TestHandler:
         self.num_running = 0
         self.jobs = []
         self.use_term_control = use_term_control
+        # Durations of the finished tests, in seconds
+        self.durations = {}
+        # Wake up when a child process exits, instead of polling at a fixed
+        # rate, where SIGCHLD is supported
+        self.selector = None
+        if hasattr(signal, 'SIGCHLD'):
+            read_fd, write_fd = os.pipe()
+            os.set_blocking(read_fd, False)
+            os.set_blocking(write_fd, False)
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(read_fd, selectors.EVENT_READ)
+            signal.set_wakeup_fd(write_fd)
+            signal.signal(signal.SIGCHLD, lambda *_: None)
+
+    def wait_for_child(self, timeout):
+        """Sleep until a child process may have exited, or the timeout expired.
+
+        Returns False on timeout."""
+        if self.selector is None:
+            time.sleep(timeout)
+            return False
+        events = self.selector.select(timeout)
+        for key, _ in events:
+            try:
+                while os.read(key.fd, 512):
+                    pass
+            except BlockingIOError:
+                pass
+        return bool(events)
+
+    def get_resources(self, test):
+        """Return the number of nodes and the memory (in MB) a test is expected to use."""
+        script = test.split()[0]
+        if script not in self.num_nodes:
+            # Test scripts declare their number of nodes in set_test_params()
+            try:
+                with open(self.tests_dir + script, encoding="utf8") as f:
+                    declared = [int(n) for n in re.findall(r"self\.num_nodes = (\d+)", f.read())]
+            except OSError:
+                declared = []
+            self.num_nodes[script] = max(declared, default=1)
+        nodes = self.num_nodes[script]
+        # The peak RSS is the one of the largest process of the test: assume
+        # it for the test itself and each of its nodes
+        memory = self.maxrss.get(test, 0) * (nodes + 1) // 1024
+        return nodes, memory
+
+    def can_start(self, nodes, memory):
+        """Whether a test using the given resources fits in the budget, with the running tests."""
+        used_nodes = sum(r[0] for r in self.resources.values())
+        used_memory = sum(r[1] for r in self.resources.values())
+        return ((not self.max_nodes or used_nodes + nodes <= self.max_nodes) and
+                (not self.max_memory or used_memory + memory <= self.max_memory))
+
+    def get_portseed(self, portseed):
+        """Return a new port seed from the given one, whose ports do not overlap with those of the running tests (and nodes)."""
+        used_slots = [port_slot(r[2]) for r in self.resources.values()]
+        if self.node_pool:
+            used_slots += [port_slot(seed) for seed in self.node_pool.portseeds()]
+        while portseed in self.used_portseeds or any(port_slots_overlap(port_slot(portseed), slot) for slot in used_slots):
+            portseed += 1
+        self.used_portseeds.add(portseed)
+        return portseed
+
+    def poll(self, proc):
+        """Return the exit code of a test process if it finished, and record its peak RSS."""
+        if not hasattr(os, 'wait4'):
+            return proc.poll()
+        try:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        except ChildProcessError:
+            return proc.poll()
+        if pid == 0:
+            return None
+        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        # ru_maxrss is in kB, except on macOS where it is in bytes
+        self.last_maxrss = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+        return proc.returncode
 
     def get_next(self):
         while self.num_running < self.num_jobs and self.test_list:
-            # Add tests
+            # Add tests, in order, as long as they fit in the budget. The first
+            # test is always started, even if it does not fit on its own.
+            nodes, memory = self.get_resources(self.test_list[0])
+            if self.jobs and not self.can_start(nodes, memory):
+                break
             self.num_running += 1
             test = self.test_list.pop(0)
-            portseed = len(self.test_list)
+            portseed = self.get_portseed(len(self.test_list))
             portseed_arg = ["--portseed={}".format(portseed)]
             log_stdout = tempfile.SpooledTemporaryFile(max_size=2**16)
             log_stderr = tempfile.SpooledTemporaryFile(max_size=2**16)
             test_argv = test.split()
             testdir = "{}/{}_{}".format(self.tmpdir, re.sub(".py$", "", test_argv[0]), portseed)
             tmpdir_arg = ["--tmpdir={}".format(testdir)]
+            proc = subprocess.Popen([sys.executable, self.tests_dir + test_argv[0]] + test_argv[1:] + self.flags + portseed_arg + tmpdir_arg,
+                                    universal_newlines=True,
+                                    stdout=log_stdout,
+                                    stderr=log_stderr)
+            self.resources[proc] = (nodes, memory, portseed)
             self.jobs.append((test,
                               time.time(),
-                              subprocess.Popen([sys.executable, self.tests_dir + test_argv[0]] + test_argv[1:] + self.flags + portseed_arg + tmpdir_arg,
-                                               universal_newlines=True,
-                                               stdout=log_stdout,
-                                               stderr=log_stderr),
+                              proc,
                               testdir,
                               log_stdout,
                               log_stderr))
@@ -706,11 +930,14 @@ class TestHandler:
         dot_count = 0
         while True:
             # Return all procs that have finished, if any. Otherwise sleep until there is one.
-            time.sleep(.5)
             ret = []
-            for job in self.jobs:
+            for job in list(self.jobs):
                 (name, start_time, proc, testdir, log_out, log_err) = job
-                if proc.poll() is not None:
+                self.last_maxrss = None
+                if self.poll(proc) is not None:
+                    del self.resources[proc]
+                    if self.last_maxrss:
+                        self.maxrss[name] = self.last_maxrss
                     log_out.seek(0), log_err.seek(0)
                     [stdout, stderr] = [log_file.read().decode('utf-8') for log_file in (log_out, log_err)]
                     log_out.close(), log_err.close()
@@ -726,9 +953,13 @@ class TestHandler:
                         clearline = '\r' + (' ' * dot_count) + '\r'
                         print(clearline, end='', flush=True)
                     dot_count = 0
-                    ret.append((TestResult(name, status, int(time.time() - start_time)), testdir, stdout, stderr))
+                    duration = time.time() - start_time
+                    self.durations[name] = round(duration, 1)
+                    ret.append((TestResult(name, status, int(duration)), testdir, stdout, stderr))
             if ret:
                 return ret
+            if self.wait_for_child(.5):
+                continue
             if self.use_term_control:
                 print('.', end='', flush=True)
             dot_count += 1
@@ -31,7 +31,6 @@ from test_framework.util import (
     assert_greater_than,
     assert_raises_rpc_error,
 )
-from test_framework import util
 from test_framework.wallet import MiniWallet
 
 
@@ -64,7 +63,6 @@ class BumpFeeTest(BitcoinTestFramework):
         self.generate(self.nodes[1], 1)
 
     def run_test(self):
-        util.node_fastmerkle = self.nodes[0]
         # Encrypt wallet for test_locked_wallet_fails test
         self.nodes[1].encryptwallet(WALLET_PASSPHRASE)
         self.nodes[1].walletpassphrase(WALLET_PASSPHRASE, WALLET_PASSPHRASE_TIMEOUT)